@@ -295,6 +295,46 @@ async def vector_search(request: Request) -> Response:
     logger.debug(response)
     return web.Response(body=response, status=200, content_type='application/json')
 
+# federated_vector_search
+@routes.post('/api/federated_vector_search')
+async def federated_vector_search(request: Request) -> Response:
+    request_json = await request.text()
+    response = await ai_app_wrapper.federated_vector_search(request_json)
+    logger.debug(response)
+    return web.Response(body=response, status=200, content_type='application/json')
+
+# migrate_embedding_dimensions
+@routes.post('/api/migrate_embedding_dimensions')
+async def migrate_embedding_dimensions(request: Request) -> Response:
+    request_json = await request.text()
+    response = await ai_app_wrapper.migrate_embedding_dimensions(request_json)
+    logger.debug(response)
+    return web.Response(body=response, status=200, content_type='application/json')
+
+# create_vector_index
+@routes.post('/api/create_vector_index')
+async def create_vector_index(request: Request) -> Response:
+    request_json = await request.text()
+    response = await ai_app_wrapper.create_vector_index(request_json)
+    logger.debug(response)
+    return web.Response(body=response, status=200, content_type='application/json')
+
+# get_vector_index_status
+@routes.post('/api/get_vector_index_status')
+async def get_vector_index_status(request: Request) -> Response:
+    request_json = await request.text()
+    response = await ai_app_wrapper.get_vector_index_status(request_json)
+    logger.debug(response)
+    return web.Response(body=response, status=200, content_type='application/json')
+
+# drop_vector_index
+@routes.post('/api/drop_vector_index')
+async def drop_vector_index(request: Request) -> Response:
+    request_json = await request.text()
+    response = await ai_app_wrapper.drop_vector_index(request_json)
+    logger.debug(response)
+    return web.Response(body=response, status=200, content_type='application/json')
+
 # delete_collection
 @routes.post('/api/delete_collection')
 async def delete_collection(request: Request) -> Response:
@@ -311,6 +351,30 @@ async def delete_embeddings_by_folder(request: Request) -> Response:
     logger.debug(response)
     return web.Response(body=response, status=200, content_type='application/json')
 
+# delete_embeddings_by_folder_tree
+@routes.post('/api/delete_embeddings_by_folder_tree')
+async def delete_embeddings_by_folder_tree(request: Request) -> Response:
+    request_json = await request.text()
+    response = await ai_app_wrapper.delete_embeddings_by_folder_tree(request_json)
+    logger.debug(response)
+    return web.Response(body=response, status=200, content_type='application/json')
+
+# patch_embeddings_metadata
+@routes.post('/api/patch_embeddings_metadata')
+async def patch_embeddings_metadata(request: Request) -> Response:
+    request_json = await request.text()
+    response = await ai_app_wrapper.patch_embeddings_metadata(request_json)
+    logger.debug(response)
+    return web.Response(body=response, status=200, content_type='application/json')
+
+# update_folder_embeddings_metadata
+@routes.post('/api/update_folder_embeddings_metadata')
+async def update_folder_embeddings_metadata(request: Request) -> Response:
+    request_json = await request.text()
+    response = await ai_app_wrapper.update_folder_embeddings_metadata(request_json)
+    logger.debug(response)
+    return web.Response(body=response, status=200, content_type='application/json')
+
 # delete_embeddings
 @routes.post('/api/delete_embeddings')
 async def delete_embeddings(request: Request) -> Response:
@@ -327,6 +391,26 @@ async def update_embeddings(request: Request) -> Response:
     logger.debug(response)
     return web.Response(body=response, status=200, content_type='application/json')
 
+# get_embedding_cache_stats
+@routes.post('/api/get_embedding_cache_stats')
+async def get_embedding_cache_stats(request: Request) -> Response:
+    response = ai_app_wrapper.get_embedding_cache_stats()
+    logger.debug(response)
+    return web.Response(body=response, status=200, content_type='application/json')
+
+# get_vector_search_stats
+@routes.post('/api/get_vector_search_stats')
+async def get_vector_search_stats(request: Request) -> Response:
+    response = ai_app_wrapper.get_vector_search_stats()
+    logger.debug(response)
+    return web.Response(body=response, status=200, content_type='application/json')
+
+# get_vector_search_cache_stats
+@routes.post('/api/get_vector_search_cache_stats')
+async def get_vector_search_cache_stats(request: Request) -> Response:
+    response = ai_app_wrapper.get_vector_search_cache_stats()
+    logger.debug(response)
+    return web.Response(body=response, status=200, content_type='application/json')
 
 # get_mime_type
 @routes.post('/api/get_mime_type')
@@ -251,6 +251,29 @@ async def get_vector_db_item_by_name(request_json: str):
 async def vector_search(request_json: str):
     return await LangChainUtil.vector_search_api(request_json)
 
+# 複数のコレクションを並行して検索し、結果をランク統合する
+@capture_stdout_stderr_async
+async def federated_vector_search(request_json: str):
+    return await LangChainUtil.federated_vector_search_api(request_json)
+
+# Embeddingの次元数を変更し、コレクションを再Embeddingする
+@capture_stdout_stderr_async
+async def migrate_embedding_dimensions(request_json: str):
+    return await LangChainUtil.migrate_embedding_dimensions_api(request_json)
+
+# PGVectorのANNインデックス(HNSW/IVFFlat)を作成・削除し、状態を取得する
+@capture_stdout_stderr_async
+async def create_vector_index(request_json: str):
+    return await LangChainUtil.create_vector_index_api(request_json)
+
+@capture_stdout_stderr_async
+async def get_vector_index_status(request_json: str):
+    return await LangChainUtil.get_vector_index_status_api(request_json)
+
+@capture_stdout_stderr_async
+async def drop_vector_index(request_json: str):
+    return await LangChainUtil.drop_vector_index_api(request_json)
+
 @capture_stdout_stderr
 def update_collection(request_json: str):
     return LangChainUtil.update_collection_api(request_json)
@@ -264,6 +287,21 @@ async def delete_collection(request_json: str):
 async def delete_embeddings_by_folder(request_json: str):
     return await LangChainUtil.delete_embeddings_by_folder_api(request_json)
 
+# ベクトルDBのインデックスをフォルダとその子孫フォルダ単位で削除する
+@capture_stdout_stderr_async
+async def delete_embeddings_by_folder_tree(request_json: str):
+    return await LangChainUtil.delete_embeddings_by_folder_tree_api(request_json)
+
+# ベクトルDBのインデックスのmetadataを、Embeddingを作成せずに更新する
+@capture_stdout_stderr_async
+async def patch_embeddings_metadata(request_json: str):
+    return await LangChainUtil.patch_embeddings_metadata_api(request_json)
+
+# フォルダの名前の変更・移動の後に、ベクトルDBのインデックスのフォルダ情報を更新する
+@capture_stdout_stderr_async
+async def update_folder_embeddings_metadata(request_json: str):
+    return await LangChainUtil.update_folder_embeddings_metadata_api(request_json)
+
 # ベクトルDBのインデックスを削除する
 @capture_stdout_stderr_async
 async def delete_embeddings(request_json: str):
@@ -274,6 +312,21 @@ async def delete_embeddings(request_json: str):
 async def update_embeddings(request_json: str) -> dict:
     return await LangChainUtil.update_embeddings_api(request_json)
 
+# Embeddingキャッシュの統計情報を取得する
+@capture_stdout_stderr
+def get_embedding_cache_stats():
+    return LangChainUtil.get_embedding_cache_stats_api()
+
+# ベクトル検索の実行状況を取得する
+@capture_stdout_stderr
+def get_vector_search_stats():
+    return LangChainUtil.get_vector_search_stats_api()
+
+# ベクトル検索結果キャッシュの統計情報を取得する
+@capture_stdout_stderr
+def get_vector_search_cache_stats():
+    return LangChainUtil.get_vector_search_cache_stats_api()
+
 ########################
 # ファイル関連
 ########################
@@ -0,0 +1,82 @@
+"""
+chroma_server.py
+
+複数のプロセス(APIサーバー、MCPサーバー、アップローダー等)で共有するChromaサーバーを起動するツール。
+- 既存のPersistentClientのディレクトリをそのまま利用できる
+- 起動後、VectorDBItemのvector_db_urlに http://host:port を設定すると、LangChainVectorDBChromaはHttpClientで接続する
+- サーバーが停止するまで待機し、Ctrl+Cで停止する
+
+利用例:
+    python -m ai_chat_lib.cmd_tools.chroma_server --path <APP_DATA_PATH>/server/vector_db/default_vector_db --port 8000
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import chromadb
+import chromadb.config
+from dotenv import load_dotenv
+
+def parse_args():
+    default_path = os.path.join(os.getenv("APP_DATA_PATH", ""), "server", "vector_db", "default_vector_db")
+    parser = argparse.ArgumentParser(description="Run a shared Chroma server for multi-process deployments")
+    parser.add_argument("-p", "--path", type=str, default=default_path, help="Chroma persistent directory")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for the server to become ready")
+    return parser.parse_args()
+
+def get_chroma_command() -> list[str]:
+    # chromadbに同梱されているCLI(chroma run)を利用する
+    executable = shutil.which("chroma")
+    if executable is None:
+        candidate = os.path.join(os.path.dirname(sys.executable), "chroma")
+        if os.path.exists(candidate):
+            executable = candidate
+    if executable is None:
+        raise RuntimeError("chroma command is not found. Install chromadb with the server dependencies.")
+    return [executable]
+
+def wait_for_server(host: str, port: int, process: subprocess.Popen, timeout: float) -> bool:
+    settings = chromadb.config.Settings(anonymized_telemetry=False)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            chromadb.HttpClient(host=host, port=port, settings=settings).heartbeat()
+            return True
+        except Exception:
+            time.sleep(0.5)
+    return False
+
+def main():
+    # 環境変数を読み込む
+    load_dotenv()
+    args = parse_args()
+    os.makedirs(args.path, exist_ok=True)
+
+    command = get_chroma_command() + ["run", "--path", args.path, "--host", args.host, "--port", str(args.port)]
+    print(" ".join(command))
+    process = subprocess.Popen(command)
+    try:
+        if not wait_for_server(args.host, args.port, process, args.timeout):
+            raise RuntimeError(f"Chroma server did not start within {args.timeout} seconds.")
+        print(f"Chroma server is ready. Set vector_db_url to http://{args.host}:{args.port}")
+        process.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import os
+from dotenv import load_dotenv
+
+from ai_chat_lib.db_modules.vector_db_item import VectorDBItem
+from ai_chat_lib.langchain_modules.langchain_doc_store import SQLDocStore
+from ai_chat_lib.cmd_tools.client_util import init_app
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Doc Store Compaction Tool (rewrite JSON rows to the compressed format)")
+    parser.add_argument("-n", "--name", type=str, default="", help="Name of the VectorDBItem")
+    parser.add_argument("-u", "--url", type=str, default="", help="URL of the doc store (overrides --name)")
+    parser.add_argument("-b", "--batch_size", type=int, default=500, help="Number of rows rewritten per transaction")
+    parser.add_argument("-d", "--app_data_path", type=str, default=os.getenv("APP_DATA_PATH", ""), help="Path to the application data directory (default: APP_DATA_PATH environment variable)")
+    return parser.parse_args()
+
+async def get_doc_store_url(name: str) -> str:
+    # アプリケーションの初期化
+    await init_app()
+    vector_db_item = await VectorDBItem.get_vector_db_by_name(name)
+    if vector_db_item is None:
+        raise ValueError(f"VectorDBItem not found: {name}")
+    if not vector_db_item.doc_store_url:
+        raise ValueError(f"VectorDBItem has no doc store: {name}")
+    return vector_db_item.doc_store_url
+
+async def main():
+    # 環境変数を読み込む
+    load_dotenv()
+    args = parse_args()
+
+    if args.app_data_path:
+        os.environ["APP_DATA_PATH"] = args.app_data_path
+
+    url = args.url
+    if not url:
+        if not args.name:
+            raise ValueError("Either --name or --url must be specified.")
+        url = await get_doc_store_url(args.name)
+
+    def print_progress(rewritten: int, total: int):
+        print(f"\rRewritten: {rewritten}/{total}", end="", flush=True)
+
+    doc_store = SQLDocStore.from_url(url, storage_format=SQLDocStore.storage_format_compressed)
+    result = doc_store.compact(batch_size=args.batch_size, progress_callback=print_progress)
+    print()
+    print(f"Rows: {result['rows']}")
+    if result["bytes_before"] > 0:
+        ratio = result["bytes_after"] / result["bytes_before"]
+        print(f"Size: {result['bytes_before']} -> {result['bytes_after']} bytes ({ratio:.2f}x)")
+
+if __name__ == "__main__":
+    import asyncio
+    asyncio.run(main())
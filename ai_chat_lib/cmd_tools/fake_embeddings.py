@@ -0,0 +1,111 @@
+"""
+fake_embeddings.py
+
+ネットワークを利用せずに決定的なEmbeddingを作成するモジュール(ベンチマーク・モックサーバー用)。
+- 単語毎にハッシュ値をシードとした固定の乱数ベクトルを割り当て、その和を正規化したベクトルをEmbeddingとする
+- 共通の単語が多いテキスト同士ほど類似度が高くなるため、近傍検索の再現率を評価できる
+"""
+
+import re
+import threading
+import zlib
+from typing import ClassVar, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    単語のハッシュ値による決定的なEmbedding
+    """
+
+    _shared: ClassVar[dict[tuple[int, int], "HashingEmbeddings"]] = {}
+    _shared_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, dim: int = 256, seed: int = 0):
+        self.dim = dim
+        self.seed = seed
+        self._word_vectors: dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_shared(cls, dim: int = 256, seed: int = 0) -> "HashingEmbeddings":
+        # 単語ベクトルのキャッシュを共有するため、次元数とシード毎に1つのインスタンスを利用する
+        with cls._shared_lock:
+            embeddings = cls._shared.get((dim, seed), None)
+            if embeddings is None:
+                embeddings = HashingEmbeddings(dim, seed)
+                cls._shared[(dim, seed)] = embeddings
+            return embeddings
+
+    def _word_vector(self, word: str) -> np.ndarray:
+        vector = self._word_vectors.get(word, None)
+        if vector is None:
+            rng = np.random.default_rng(zlib.crc32(word.encode("utf-8")) ^ self.seed)
+            vector = rng.standard_normal(self.dim).astype(np.float32)
+            with self._lock:
+                self._word_vectors[word] = vector
+        return vector
+
+    def embed_matrix(self, texts: list[str]) -> np.ndarray:
+        """
+        テキストのEmbeddingを(件数, 次元数)の行列で返す。
+        """
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = re.findall(r"\w+", text.lower())
+            if len(words) == 0:
+                words = [text]
+            matrix[i] = np.sum([self._word_vector(word) for word in words], axis=0)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_matrix(texts).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_matrix([text])[0].tolist()
+
+
+class SyntheticCorpus:
+    """
+    トピック毎に出現しやすい単語が異なる、決定的な合成コーパス
+    """
+
+    def __init__(self, size: int, seed: int = 0, vocabulary_size: int = 20000, topics: int = 100, words_per_doc: int = 24):
+        self.size = size
+        self.seed = seed
+        self.vocabulary = [f"w{i}" for i in range(vocabulary_size)]
+        self.topics = topics
+        self.words_per_doc = words_per_doc
+        rng = np.random.default_rng(seed)
+        # トピック毎に200語の語彙を割り当てる
+        self.topic_words = rng.integers(0, vocabulary_size, size=(topics, 200))
+
+    def get_texts(self, start: int, end: int) -> list[str]:
+        """
+        start番目からend番目(含まない)のテキストを返す。同じ位置のテキストは常に同じになる。
+        """
+        texts = []
+        for i in range(start, min(end, self.size)):
+            rng = np.random.default_rng((self.seed, i))
+            topic = int(rng.integers(0, self.topics))
+            topic_part = rng.choice(self.topic_words[topic], size=self.words_per_doc * 2 // 3)
+            common_part = rng.zipf(1.3, size=self.words_per_doc - len(topic_part)) % len(self.vocabulary)
+            texts.append(" ".join(self.vocabulary[int(index)] for index in np.concatenate([topic_part, common_part])))
+        return texts
+
+    def get_queries(self, count: int, seed: Optional[int] = None) -> list[str]:
+        """
+        コーパスのテキストの一部の単語と、ランダムな単語からクエリを作成する。
+        """
+        rng = np.random.default_rng(self.seed + 1 if seed is None else seed)
+        queries = []
+        for index in rng.integers(0, self.size, size=count):
+            words = self.get_texts(int(index), int(index) + 1)[0].split(" ")
+            picked = list(rng.choice(words, size=min(8, len(words)), replace=False))
+            picked += [self.vocabulary[int(i)] for i in rng.integers(0, len(self.vocabulary), size=2)]
+            queries.append(" ".join(picked))
+        return queries
@@ -0,0 +1,51 @@
+import argparse
+import os
+from dotenv import load_dotenv
+
+from ai_chat_lib.db_modules.content_folder import ContentFolder
+from ai_chat_lib.db_modules.vector_db_item import VectorDBItem
+from ai_chat_lib.llm_modules.openai_util import OpenAIProps
+from ai_chat_lib.langchain_modules.langchain_util import LangChainUtil
+from ai_chat_lib.cmd_tools.client_util import init_app
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Folder Metadata Backfill Tool (set folder ancestor keys on existing chunks)")
+    parser.add_argument("-n", "--name", type=str, default="default", help="Name of the VectorDBItem")
+    parser.add_argument("-f", "--folder_path", type=str, default="", help="Folder path to update (default: all root folders)")
+    parser.add_argument("-m", "--model", type=str, default="", help="Embedding model (default: default_embedding_model of the environment)")
+    parser.add_argument("-d", "--app_data_path", type=str, default=os.getenv("APP_DATA_PATH", ""), help="Path to the application data directory (default: APP_DATA_PATH environment variable)")
+    return parser.parse_args()
+
+async def main():
+    # 環境変数を読み込む
+    load_dotenv()
+    args = parse_args()
+
+    if args.app_data_path:
+        os.environ["APP_DATA_PATH"] = args.app_data_path
+
+    # アプリケーションの初期化
+    await init_app()
+    vector_db_item = await VectorDBItem.get_vector_db_by_name(args.name)
+    if vector_db_item is None:
+        raise ValueError(f"VectorDBItem not found: {args.name}")
+    openai_props = OpenAIProps.create_from_env()
+    vector_db = LangChainUtil.get_vector_db(openai_props, vector_db_item, args.model or openai_props.default_embedding_model)
+
+    if args.folder_path:
+        folder = await ContentFolder.get_content_folder_by_path(args.folder_path)
+        if folder is None or not folder.id:
+            raise ValueError(f"Folder not found: {args.folder_path}")
+        folders = [folder]
+    else:
+        folders = await ContentFolder.get_root_content_folders()
+
+    # フォルダと子孫フォルダのチャンクに、folder_pathと祖先フォルダのキーを設定する(Embeddingは作成しない)
+    for folder in folders:
+        result = await vector_db.update_folder_metadata(folder.id)
+        print(f"{folder.folder_name}: folders:{result['folders']} chunks:{result['chunks']}")
+    print("Backfill completed. Set SUBFOLDER_FILTER_FALLBACK=false to search subfolders by the ancestor keys only.")
+
+if __name__ == "__main__":
+    import asyncio
+    asyncio.run(main())
@@ -0,0 +1,54 @@
+import argparse
+import os
+from dotenv import load_dotenv
+
+from ai_chat_lib.db_modules.vector_db_item import VectorDBItem
+from ai_chat_lib.langchain_modules.langchain_vector_db_numpy import NumpyVectorStore
+from ai_chat_lib.cmd_tools.client_util import init_app
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="NumPy Vector DB Compaction Tool (remove logically deleted rows)")
+    parser.add_argument("-n", "--name", type=str, default="", help="Name of the VectorDBItem")
+    parser.add_argument("-p", "--path", type=str, default="", help="Directory of the collection (overrides --name)")
+    parser.add_argument("--min_deleted_ratio", type=float, default=0.0, help="Skip compaction when the ratio of deleted rows is below this value")
+    parser.add_argument("-d", "--app_data_path", type=str, default=os.getenv("APP_DATA_PATH", ""), help="Path to the application data directory (default: APP_DATA_PATH environment variable)")
+    return parser.parse_args()
+
+async def get_collection_path(name: str) -> str:
+    # アプリケーションの初期化
+    await init_app()
+    vector_db_item = await VectorDBItem.get_vector_db_by_name(name)
+    if vector_db_item is None:
+        raise ValueError(f"VectorDBItem not found: {name}")
+    if vector_db_item.vector_db_type != 3:
+        raise ValueError(f"VectorDBItem is not a NumPy vector db: {name}")
+    # LangChainVectorDBNumpyと同じディレクトリ
+    return os.path.join(vector_db_item.vector_db_url, vector_db_item.collection_name or "default")
+
+async def main():
+    # 環境変数を読み込む
+    load_dotenv()
+    args = parse_args()
+
+    if args.app_data_path:
+        os.environ["APP_DATA_PATH"] = args.app_data_path
+
+    path = args.path
+    if not path:
+        if not args.name:
+            raise ValueError("Either --name or --path must be specified.")
+        path = await get_collection_path(args.name)
+
+    store = NumpyVectorStore(path=path, embedding=None)
+    stats = store.get_row_stats()
+    ratio = stats["deleted"] / stats["rows"] if stats["rows"] > 0 else 0.0
+    print(f"Rows: {stats['rows']} Deleted: {stats['deleted']} ({ratio:.2f})")
+    if stats["deleted"] == 0 or ratio < args.min_deleted_ratio:
+        print("Compaction skipped.")
+        return
+    result = store.compact()
+    print(f"Rows: {result['rows_before']} -> {result['rows_after']}")
+
+if __name__ == "__main__":
+    import asyncio
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""
+openai_mock_load_test.py
+
+openai_mock_server.pyのシナリオを利用して、アプリケーションのOpenAIクライアントのリトライ・並列度を確認するツール。
+- モックサーバーを同一プロセスで起動し、OPENAI_BASE_URLをモックサーバーに向けて実行する
+- OpenAIClient(chat)とLangChainOpenAIClient(embeddings)からconcurrency件ずつ並列にリクエストを送信する
+- 成功・失敗件数、レイテンシ、モックサーバーが返した429の件数をJSONで出力する
+
+利用例:
+    python -m ai_chat_lib.cmd_tools.openai_mock_load_test --scenario retry -n 100 --concurrency 16
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Any
+
+import numpy as np
+from aiohttp import web
+
+from ai_chat_lib.llm_modules.openai_util import OpenAIProps, OpenAIClient
+from ai_chat_lib.langchain_modules.langchain_client import LangChainOpenAIClient
+from ai_chat_lib.cmd_tools.openai_mock_server import OpenAIMockServer, SCENARIOS
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run retry/concurrency scenarios against the OpenAI mock server")
+    parser.add_argument("-s", "--scenario", type=str, default="retry", choices=list(SCENARIOS.keys()), help="Mock server scenario")
+    parser.add_argument("-n", "--num_requests", type=int, default=50, help="Number of requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of concurrent requests")
+    parser.add_argument("--port", type=int, default=8901, help="Port of the in-process mock server")
+    parser.add_argument("--stream", action="store_true", help="Use streaming chat completions")
+    parser.add_argument("--embedding_batch", type=int, default=16, help="Number of texts per embeddings request")
+    parser.add_argument("-o", "--output", type=str, default="", help="Path to the JSON result file")
+    return parser.parse_args()
+
+async def run_requests(name: str, count: int, concurrency: int, func) -> dict[str, Any]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    errors: dict[str, int] = {}
+
+    async def run(index: int):
+        async with semaphore:
+            begin = time.perf_counter()
+            try:
+                await func(index)
+                latencies.append(time.perf_counter() - begin)
+            except Exception as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+
+    begin = time.perf_counter()
+    await asyncio.gather(*[run(i) for i in range(count)])
+    elapsed = time.perf_counter() - begin
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "name": name,
+        "requests": count,
+        "succeeded": len(latencies),
+        "errors": errors,
+        "elapsed_sec": elapsed,
+        "requests_per_sec": count / elapsed if elapsed > 0 else 0.0,
+        "latency_p50_ms": float(np.percentile(latencies_ms, 50)) if len(latencies_ms) else 0.0,
+        "latency_p95_ms": float(np.percentile(latencies_ms, 95)) if len(latencies_ms) else 0.0,
+    }
+
+async def main():
+    args = parse_args()
+    server = OpenAIMockServer(OpenAIMockServer.create_settings(args.scenario))
+    runner = web.AppRunner(server.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+
+    # アプリケーションと同じ方法でクライアントを作成する
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["OPENAI_API_KEY"] = "mock"
+    os.environ["AZURE_OPENAI"] = "false"
+    props = OpenAIProps.create_from_env()
+    completion_client = OpenAIClient(props).get_completion_client()
+    embedding_client = LangChainOpenAIClient(props=props, use_embedding_cache=False).get_embedding_client()
+
+    async def chat(index: int):
+        params = OpenAIProps.create_openai_chat_parameter_dict_simple(props.default_completion_model, f"request {index}")
+        if args.stream:
+            stream = await completion_client.chat.completions.create(**params, stream=True)
+            async for _ in stream:
+                pass
+        else:
+            await completion_client.chat.completions.create(**params)
+
+    async def embeddings(index: int):
+        await embedding_client.aembed_documents([f"request {index} text {i}" for i in range(args.embedding_batch)])
+
+    results = []
+    try:
+        for name, func in (("chat.completions", chat), ("embeddings", embeddings)):
+            result = await run_requests(name, args.num_requests, args.concurrency, func)
+            results.append(result)
+            print(
+                f"{name:16} ok:{result['succeeded']}/{result['requests']} errors:{result['errors']} "
+                f"p50:{result['latency_p50_ms']:.1f}ms p95:{result['latency_p95_ms']:.1f}ms"
+            )
+    finally:
+        await runner.cleanup()
+
+    report = {"scenario": args.scenario, "settings": server.settings.model_dump(), "results": results, "server_stats": server.stats.to_dict()}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Result: {args.output}")
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,455 @@
+"""
+openai_mock_server.py
+
+負荷試験・回帰試験用のOpenAI互換のモックサーバー。
+- /v1/chat/completions(stream対応)、/v1/embeddings、/v1/models を提供する
+- Azure OpenAIのパス(/openai/deployments/{deployment}/...)にも対応する
+- Embeddingはfake_embeddings.HashingEmbeddingsによる決定的な値を返す(encoding_format=base64にも対応)
+- 応答の遅延(fixed/uniform/normal/lognormal)、429(Retry-After付き)、500の発生を設定できる
+- 同時実行数の上限を超えたリクエストには429を返す
+- 設定はシナリオ名(--scenario)、JSONファイル(--config)、コマンドライン引数の順に上書きする
+- /mock/stats で統計情報、/mock/settings で設定の取得・変更、/mock/reset で統計情報のリセットを行う
+
+利用例:
+    python -m ai_chat_lib.cmd_tools.openai_mock_server --port 8900 --scenario retry
+    OPENAI_BASE_URL=http://localhost:8900/v1 OPENAI_API_KEY=dummy AZURE_OPENAI=false python ...
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+from typing import Any, ClassVar, Optional
+
+import numpy as np
+from aiohttp import web
+from aiohttp.web import Request, Response, StreamResponse
+from pydantic import BaseModel, Field
+
+from ai_chat_lib.cmd_tools.fake_embeddings import HashingEmbeddings
+
+import ai_chat_lib.log_modules.log_settings as log_settings
+logger = log_settings.getLogger(__name__)
+
+
+class LatencySettings(BaseModel):
+    """
+    応答の遅延の分布。値はミリ秒。
+    - fixed: mean_ms
+    - uniform: min_ms 〜 max_ms
+    - normal: 平均mean_ms、標準偏差stddev_ms(min_ms未満は切り上げる)
+    - lognormal: 中央値mean_ms、対数の標準偏差sigma
+    """
+    distribution: str = Field(default="fixed")
+    mean_ms: float = Field(default=0.0)
+    min_ms: float = Field(default=0.0)
+    max_ms: float = Field(default=0.0)
+    stddev_ms: float = Field(default=0.0)
+    sigma: float = Field(default=0.5)
+
+    distributions: ClassVar[list[str]] = ["fixed", "uniform", "normal", "lognormal"]
+
+    def sample_ms(self, rng: random.Random) -> float:
+        if self.distribution == "fixed":
+            value = self.mean_ms
+        elif self.distribution == "uniform":
+            value = rng.uniform(self.min_ms, max(self.min_ms, self.max_ms))
+        elif self.distribution == "normal":
+            value = rng.gauss(self.mean_ms, self.stddev_ms)
+        elif self.distribution == "lognormal":
+            value = self.mean_ms * rng.lognormvariate(0.0, self.sigma)
+        else:
+            raise ValueError(f"Unknown latency distribution: {self.distribution}")
+        if self.max_ms > 0:
+            value = min(value, self.max_ms)
+        return max(value, self.min_ms, 0.0)
+
+
+class MockSettings(BaseModel):
+    """
+    モックサーバーの設定
+    """
+    # 応答開始までの遅延
+    latency: LatencySettings = Field(default_factory=LatencySettings)
+    # stream時のチャンク間の遅延(ミリ秒)
+    stream_chunk_delay_ms: float = Field(default=0.0)
+    # 429を返す確率(0〜1)
+    rate_limit_rate: float = Field(default=0.0)
+    # N件毎に429を返す(0の場合は無効)
+    rate_limit_every: int = Field(default=0)
+    # 429のRetry-Afterヘッダーの値(秒)
+    retry_after_sec: float = Field(default=1.0)
+    # 同時実行数の上限。超えたリクエストには429を返す(0の場合は無制限)
+    max_concurrency: int = Field(default=0)
+    # 500を返す確率(0〜1)
+    error_rate: float = Field(default=0.0)
+    # Embeddingの次元数(リクエストにdimensionsがない場合)
+    embedding_dim: int = Field(default=1536)
+    # チャットの応答。空の場合は最後のユーザーメッセージを含む応答を返す
+    response_text: str = Field(default="")
+    # 乱数のシード(遅延・エラーの発生を再現するため)
+    seed: int = Field(default=0)
+
+
+# シナリオ名 -> MockSettingsの値
+SCENARIOS: dict[str, dict[str, Any]] = {
+    # 遅延・エラーなし(回帰試験用)
+    "default": {},
+    # 実際のAPIに近い遅延
+    "realistic": {
+        "latency": {"distribution": "lognormal", "mean_ms": 400, "sigma": 0.6, "max_ms": 5000},
+        "stream_chunk_delay_ms": 20,
+    },
+    # 遅い応答(タイムアウトの確認用)
+    "slow": {
+        "latency": {"distribution": "uniform", "min_ms": 3000, "max_ms": 10000},
+        "stream_chunk_delay_ms": 200,
+    },
+    # 429が頻発する(リトライ処理の確認用)
+    "retry": {
+        "latency": {"distribution": "normal", "mean_ms": 100, "stddev_ms": 30},
+        "rate_limit_every": 3,
+        "retry_after_sec": 1,
+    },
+    # 同時実行数の制限(並列度の確認用)
+    "concurrency": {
+        "latency": {"distribution": "normal", "mean_ms": 500, "stddev_ms": 100},
+        "max_concurrency": 8,
+        "retry_after_sec": 0.5,
+    },
+    # 500と429が一定の確率で発生する
+    "flaky": {
+        "latency": {"distribution": "lognormal", "mean_ms": 200, "sigma": 0.8, "max_ms": 3000},
+        "rate_limit_rate": 0.1,
+        "error_rate": 0.05,
+    },
+}
+
+
+class MockServerStats:
+    """
+    エンドポイント毎の統計情報
+    """
+    def __init__(self):
+        self.started_at = time.time()
+        self.requests: dict[str, int] = {}
+        self.rate_limited: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+        self.latencies_ms: dict[str, list[float]] = {}
+        self.current_concurrency = 0
+        self.max_concurrency = 0
+        self.total_requests = 0
+
+    def to_dict(self) -> dict[str, Any]:
+        endpoints = {}
+        for endpoint, count in self.requests.items():
+            latencies = np.array(self.latencies_ms.get(endpoint, []))
+            endpoints[endpoint] = {
+                "requests": count,
+                "rate_limited": self.rate_limited.get(endpoint, 0),
+                "errors": self.errors.get(endpoint, 0),
+                "succeeded": len(latencies),
+                "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+                "latency_p95_ms": float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+            }
+        elapsed = time.time() - self.started_at
+        return {
+            "elapsed_sec": elapsed,
+            "total_requests": self.total_requests,
+            "requests_per_sec": self.total_requests / elapsed if elapsed > 0 else 0.0,
+            "current_concurrency": self.current_concurrency,
+            "max_concurrency": self.max_concurrency,
+            "endpoints": endpoints,
+        }
+
+
+class OpenAIMockServer:
+    """
+    OpenAI互換のモックサーバー
+    """
+
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.stats = MockServerStats()
+        self.rng = random.Random(settings.seed)
+
+    @classmethod
+    def create_settings(cls, scenario: str = "default", config: Optional[dict[str, Any]] = None, overrides: Optional[dict[str, Any]] = None) -> MockSettings:
+        if scenario not in SCENARIOS:
+            raise ValueError(f"Unknown scenario: {scenario}. Available: {', '.join(SCENARIOS)}")
+        values: dict[str, Any] = json.loads(json.dumps(SCENARIOS[scenario]))
+        for update in (config or {}, overrides or {}):
+            for key, value in update.items():
+                if key == "latency":
+                    values["latency"] = {**values.get("latency", {}), **value}
+                else:
+                    values[key] = value
+        return MockSettings.model_validate(values)
+
+    def create_app(self) -> web.Application:
+        app = web.Application(client_max_size=1024*1024*100) # 100MB
+        app.add_routes([
+            web.post("/v1/chat/completions", self.chat_completions),
+            web.post("/v1/embeddings", self.embeddings),
+            web.get("/v1/models", self.models),
+            # AzureOpenAIClient(base_urlの指定なし)のパス
+            web.post("/openai/deployments/{deployment}/chat/completions", self.chat_completions),
+            web.post("/openai/deployments/{deployment}/embeddings", self.embeddings),
+            # base_urlにv1を含めない場合
+            web.post("/chat/completions", self.chat_completions),
+            web.post("/embeddings", self.embeddings),
+            web.get("/mock/stats", self.get_stats),
+            web.post("/mock/reset", self.reset_stats),
+            web.get("/mock/settings", self.get_settings),
+            web.post("/mock/settings", self.update_settings),
+        ])
+        return app
+
+    ########################
+    # 遅延・エラーの発生
+    ########################
+    def _check_failure(self, endpoint: str) -> Optional[Response]:
+        # 同時実行数、N件毎、確率の順に429を判定し、次に500を判定する
+        settings = self.settings
+        headers = {"Retry-After": f"{settings.retry_after_sec:g}", "retry-after-ms": str(int(settings.retry_after_sec * 1000))}
+        rate_limited = (
+            (settings.max_concurrency > 0 and self.stats.current_concurrency > settings.max_concurrency)
+            or (settings.rate_limit_every > 0 and self.stats.total_requests % settings.rate_limit_every == 0)
+            or (settings.rate_limit_rate > 0 and self.rng.random() < settings.rate_limit_rate)
+        )
+        if rate_limited:
+            self.stats.rate_limited[endpoint] = self.stats.rate_limited.get(endpoint, 0) + 1
+            return self._error_response(429, "rate_limit_exceeded", "Rate limit reached (mock).", headers)
+        if settings.error_rate > 0 and self.rng.random() < settings.error_rate:
+            self.stats.errors[endpoint] = self.stats.errors.get(endpoint, 0) + 1
+            return self._error_response(500, "server_error", "Internal server error (mock).")
+        return None
+
+    def _error_response(self, status: int, code: str, message: str, headers: Optional[dict[str, str]] = None) -> Response:
+        body = {"error": {"message": message, "type": code, "param": None, "code": code}}
+        return web.json_response(body, status=status, headers=headers)
+
+    async def _handle(self, endpoint: str, request: Request, handler) -> StreamResponse:
+        # 統計情報の記録と、遅延・エラーの発生を共通で行う
+        self.stats.total_requests += 1
+        self.stats.requests[endpoint] = self.stats.requests.get(endpoint, 0) + 1
+        self.stats.current_concurrency += 1
+        self.stats.max_concurrency = max(self.stats.max_concurrency, self.stats.current_concurrency)
+        begin = time.perf_counter()
+        try:
+            failure = self._check_failure(endpoint)
+            if failure is not None:
+                return failure
+            try:
+                body = await request.json()
+            except json.JSONDecodeError:
+                return self._error_response(400, "invalid_request_error", "Request body is not valid JSON.")
+            await asyncio.sleep(self.settings.latency.sample_ms(self.rng) / 1000)
+            response = await handler(request, body)
+            self.stats.latencies_ms.setdefault(endpoint, []).append((time.perf_counter() - begin) * 1000)
+            return response
+        finally:
+            self.stats.current_concurrency -= 1
+
+    ########################
+    # Chat Completions
+    ########################
+    async def chat_completions(self, request: Request) -> StreamResponse:
+        return await self._handle("chat.completions", request, self._chat_completions)
+
+    def _create_content(self, body: dict[str, Any]) -> str:
+        if self.settings.response_text:
+            content = self.settings.response_text
+        else:
+            last_message = ""
+            for message in reversed(body.get("messages", [])):
+                if message.get("role") == "user":
+                    last_message = self._get_message_text(message.get("content", ""))
+                    break
+            content = f"This is a mock response to: {last_message[:200]}"
+        response_format = body.get("response_format") or {}
+        if response_format.get("type") in ("json_object", "json_schema"):
+            content = json.dumps({"result": content}, ensure_ascii=False)
+        return content
+
+    @staticmethod
+    def _get_message_text(content: Any) -> str:
+        # contentは文字列、または{"type": "text", "text": ...}のリスト
+        if isinstance(content, str):
+            return content
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict) and part.get("type") == "text")
+
+    @staticmethod
+    def _count_tokens(text: str) -> int:
+        # 厳密なトークン数は不要なため、4文字を1トークンとして概算する
+        return max(1, len(text) // 4)
+
+    def _create_usage(self, body: dict[str, Any], content: str) -> dict[str, int]:
+        prompt_text = "".join(self._get_message_text(message.get("content", "")) for message in body.get("messages", []))
+        prompt_tokens = self._count_tokens(prompt_text)
+        completion_tokens = self._count_tokens(content)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    async def _chat_completions(self, request: Request, body: dict[str, Any]) -> StreamResponse:
+        model = body.get("model") or request.match_info.get("deployment", "mock-model")
+        content = self._create_content(body)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        if not body.get("stream", False):
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop", "logprobs": None}],
+                "usage": self._create_usage(body, content),
+            })
+
+        # Server-Sent Events。単語毎にチャンクを返す
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        async def send(delta: dict[str, Any], finish_reason: Optional[str] = None, usage: Optional[dict[str, int]] = None):
+            chunk: dict[str, Any] = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [] if usage is not None else [{"index": 0, "delta": delta, "finish_reason": finish_reason, "logprobs": None}],
+            }
+            if usage is not None:
+                chunk["usage"] = usage
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        await send({"role": "assistant", "content": ""})
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            if self.settings.stream_chunk_delay_ms > 0:
+                await asyncio.sleep(self.settings.stream_chunk_delay_ms / 1000)
+            await send({"content": word if i == 0 else f" {word}"})
+        await send({}, finish_reason="stop")
+        if (body.get("stream_options") or {}).get("include_usage", False):
+            await send({}, usage=self._create_usage(body, content))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    ########################
+    # Embeddings
+    ########################
+    async def embeddings(self, request: Request) -> StreamResponse:
+        return await self._handle("embeddings", request, self._embeddings)
+
+    async def _embeddings(self, request: Request, body: dict[str, Any]) -> StreamResponse:
+        model = body.get("model") or request.match_info.get("deployment", "mock-embedding")
+        inputs = body.get("input", [])
+        if isinstance(inputs, str) or (isinstance(inputs, list) and len(inputs) > 0 and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        # トークンIDのリストで送信された場合は、IDを単語として扱う
+        texts = [text if isinstance(text, str) else " ".join(f"t{token}" for token in text) for text in inputs]
+        dim = int(body.get("dimensions") or self.settings.embedding_dim)
+        matrix = await asyncio.to_thread(HashingEmbeddings.get_shared(dim).embed_matrix, texts)
+
+        use_base64 = body.get("encoding_format", "float") == "base64"
+        data = []
+        for i, vector in enumerate(matrix):
+            embedding: Any = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii") if use_base64 else vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        prompt_tokens = sum(self._count_tokens(text) for text in texts)
+        return web.json_response({
+            "object": "list",
+            "data": data,
+            "model": model,
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        })
+
+    ########################
+    # Models / 管理用API
+    ########################
+    async def models(self, request: Request) -> Response:
+        model_ids = ["gpt-4o", "gpt-4o-mini", "text-embedding-3-small", "text-embedding-3-large"]
+        return web.json_response({
+            "object": "list",
+            "data": [{"id": model_id, "object": "model", "created": 0, "owned_by": "mock"} for model_id in model_ids],
+        })
+
+    async def get_stats(self, request: Request) -> Response:
+        return web.json_response(self.stats.to_dict())
+
+    async def reset_stats(self, request: Request) -> Response:
+        self.stats = MockServerStats()
+        return web.json_response({"result": "ok"})
+
+    async def get_settings(self, request: Request) -> Response:
+        return web.json_response(self.settings.model_dump())
+
+    async def update_settings(self, request: Request) -> Response:
+        # {"scenario": "retry", ...}の形式。scenarioを省略した場合は現在の設定を上書きする
+        body = await request.json()
+        scenario = body.pop("scenario", None)
+        try:
+            if scenario is not None:
+                self.settings = self.create_settings(scenario, body)
+            else:
+                current = self.settings.model_dump()
+                current["latency"] = {**current["latency"], **body.pop("latency", {})}
+                self.settings = MockSettings.model_validate({**current, **body})
+        except ValueError as e:
+            return self._error_response(400, "invalid_request_error", str(e))
+        self.rng = random.Random(self.settings.seed)
+        logger.info(f"mock settings updated: {self.settings.model_dump_json()}")
+        return web.json_response(self.settings.model_dump())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="OpenAI compatible mock server for load and regression testing")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind")
+    parser.add_argument("-p", "--port", type=int, default=8900, help="Port to listen on")
+    parser.add_argument("-s", "--scenario", type=str, default="default", choices=list(SCENARIOS.keys()), help="Predefined scenario")
+    parser.add_argument("-c", "--config", type=str, default="", help="Path to a JSON file with mock settings (overrides the scenario)")
+    parser.add_argument("--latency", type=str, default="", choices=[""] + LatencySettings.distributions, help="Latency distribution")
+    parser.add_argument("--latency_ms", type=float, default=None, help="Mean (fixed/normal) or median (lognormal) latency in ms")
+    parser.add_argument("--latency_min_ms", type=float, default=None, help="Minimum latency in ms")
+    parser.add_argument("--latency_max_ms", type=float, default=None, help="Maximum latency in ms")
+    parser.add_argument("--latency_stddev_ms", type=float, default=None, help="Standard deviation for the normal distribution")
+    parser.add_argument("--latency_sigma", type=float, default=None, help="Sigma for the lognormal distribution")
+    parser.add_argument("--rate_limit_rate", type=float, default=None, help="Probability of returning 429 (0-1)")
+    parser.add_argument("--rate_limit_every", type=int, default=None, help="Return 429 for every N-th request")
+    parser.add_argument("--retry_after", type=float, default=None, help="Retry-After header value in seconds")
+    parser.add_argument("--max_concurrency", type=int, default=None, help="Return 429 when concurrent requests exceed this value")
+    parser.add_argument("--error_rate", type=float, default=None, help="Probability of returning 500 (0-1)")
+    parser.add_argument("--stream_chunk_delay_ms", type=float, default=None, help="Delay between streamed chunks in ms")
+    parser.add_argument("--embedding_dim", type=int, default=None, help="Default embedding dimensions")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    return parser.parse_args()
+
+def create_overrides(args) -> dict[str, Any]:
+    latency_options = {
+        "distribution": args.latency or None, "mean_ms": args.latency_ms, "min_ms": args.latency_min_ms,
+        "max_ms": args.latency_max_ms, "stddev_ms": args.latency_stddev_ms, "sigma": args.latency_sigma,
+    }
+    options = {
+        "rate_limit_rate": args.rate_limit_rate, "rate_limit_every": args.rate_limit_every, "retry_after_sec": args.retry_after,
+        "max_concurrency": args.max_concurrency, "error_rate": args.error_rate, "stream_chunk_delay_ms": args.stream_chunk_delay_ms,
+        "embedding_dim": args.embedding_dim, "seed": args.seed,
+    }
+    overrides: dict[str, Any] = {key: value for key, value in options.items() if value is not None}
+    latency = {key: value for key, value in latency_options.items() if value is not None}
+    if latency:
+        overrides["latency"] = latency
+    return overrides
+
+def main():
+    args = parse_args()
+    config: dict[str, Any] = {}
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config = json.load(f)
+    settings = OpenAIMockServer.create_settings(args.scenario, config, create_overrides(args))
+    server = OpenAIMockServer(settings)
+    logger.info(f"scenario={args.scenario} settings={settings.model_dump_json()}")
+    print(f"OPENAI_BASE_URL=http://{args.host}:{args.port}/v1")
+    web.run_app(server.create_app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+from dotenv import load_dotenv
+
+from ai_chat_lib.db_modules.vector_db_item import VectorDBItem
+from ai_chat_lib.langchain_modules.langchain_vector_db_numpy import NumpyVectorStore
+from ai_chat_lib.cmd_tools.client_util import init_app
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Vector Precision Report Tool (NumPy vector db)")
+    parser.add_argument("-n", "--name", type=str, default="", help="Name of the VectorDBItem")
+    parser.add_argument("-p", "--path", type=str, default="", help="Path to the NumPy collection directory (overrides --name)")
+    parser.add_argument("-k", "--top_k", type=int, default=10, help="Number of results for recall@k")
+    parser.add_argument("-q", "--num_queries", type=int, default=100, help="Number of sampled queries")
+    parser.add_argument("-m", "--max_vectors", type=int, default=0, help="Maximum number of vectors to evaluate (0: all)")
+    parser.add_argument("-d", "--app_data_path", type=str, default=os.getenv("APP_DATA_PATH", ""), help="Path to the application data directory (default: APP_DATA_PATH environment variable)")
+    return parser.parse_args()
+
+async def get_collection_path(name: str) -> str:
+    # アプリケーションの初期化
+    await init_app()
+    vector_db_item = await VectorDBItem.get_vector_db_by_name(name)
+    if vector_db_item is None:
+        raise ValueError(f"VectorDBItem not found: {name}")
+    if vector_db_item.vector_db_type != 3:
+        raise ValueError(f"VectorDBItem is not NumPy vector db: {name}")
+    return os.path.join(vector_db_item.vector_db_url, vector_db_item.collection_name or "default")
+
+async def main():
+    # 環境変数を読み込む
+    load_dotenv()
+    args = parse_args()
+
+    if args.app_data_path:
+        os.environ["APP_DATA_PATH"] = args.app_data_path
+
+    path = args.path
+    if not path:
+        if not args.name:
+            raise ValueError("Either --name or --path must be specified.")
+        path = await get_collection_path(args.name)
+    if not os.path.exists(path):
+        print(f"Error: collection directory '{path}' does not exist.")
+        return
+
+    # vector_dtypeを指定せずに開き、既存の保存形式を変更しない
+    store = NumpyVectorStore(path=path, embedding=None)
+    report = store.create_precision_report(k=args.top_k, num_queries=args.num_queries, max_vectors=args.max_vectors)
+
+    print(f"Collection: {path}")
+    print(f"Vectors: {report['vectors']}  Queries: {report.get('queries', 0)}  k: {args.top_k}")
+    print("--------------------------------------------------")
+    for result in report["results"]:
+        print(
+            f"{result['vector_dtype']:8} rescore:{str(result['rescore']):5} "
+            f"recall@{args.top_k}:{result[f'recall_at_{args.top_k}']:.4f} "
+            f"p50:{result['latency_p50_ms']:.2f}ms p95:{result['latency_p95_ms']:.2f}ms "
+            f"memory:{result['memory_bytes'] / 1024 / 1024:.1f}MB ({result['memory_ratio']:.2f}x) "
+            f"disk:{result['disk_bytes'] / 1024 / 1024:.1f}MB ({result['disk_ratio']:.2f}x)"
+        )
+    print("--------------------------------------------------")
+    if "disk_bytes" in report:
+        print(
+            f"Current: {report['vector_dtype']} keep_full_precision:{report['keep_full_precision']} "
+            f"disk:{report['disk_bytes'] / 1024 / 1024:.1f}MB"
+        )
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    import asyncio
+    asyncio.run(main())
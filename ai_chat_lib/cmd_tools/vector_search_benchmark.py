@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import resource
+from typing import Any, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from ai_chat_lib.llm_modules.openai_util import OpenAIProps
+from ai_chat_lib.langchain_modules.langchain_client import LangChainOpenAIClient
+from ai_chat_lib.langchain_modules.langchain_vector_db import LangChainVectorDB
+from ai_chat_lib.cmd_tools.fake_embeddings import HashingEmbeddings, SyntheticCorpus
+
+class BenchmarkEmbeddingClient(LangChainOpenAIClient):
+    """
+    ベンチマーク用のクライアント。OpenAIのAPIの代わりにHashingEmbeddingsを利用する
+    """
+    def get_embedding_model_key(self) -> str:
+        return f"hashing:{self.embedding_dimensions}"
+
+    def get_embedding_client(self):
+        return HashingEmbeddings.get_shared(self.embedding_dimensions)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Vector Search Benchmark Tool (synthetic corpus, no network)")
+    parser.add_argument("-s", "--sizes", type=str, default="10000", help="Comma separated corpus sizes (e.g. 10000,100000,1000000)")
+    parser.add_argument("-b", "--backends", type=str, default="numpy,chroma", help="Comma separated backends (numpy, chroma, pgvector)")
+    parser.add_argument("-k", "--top_k", type=int, default=10, help="Number of results for recall@k")
+    parser.add_argument("-q", "--num_queries", type=int, default=100, help="Number of queries")
+    parser.add_argument("--dim", type=int, default=256, help="Embedding dimensions")
+    parser.add_argument("--batch_size", type=int, default=1000, help="Number of chunks added per call")
+    parser.add_argument("--search_kwargs", type=str, default="{}", help="Additional search_kwargs as JSON (e.g. '{\"ef_search\": 100}')")
+    parser.add_argument("--chroma_hnsw", type=str, default="{}", help="Chroma HNSW settings as JSON (e.g. '{\"hnsw:M\": 16}')")
+    parser.add_argument("--pg_url", type=str, default=os.getenv("BENCHMARK_PGVECTOR_URL", ""), help="PostgreSQL URL for the pgvector backend")
+    parser.add_argument("--work_dir", type=str, default="", help="Directory for the benchmark collections (default: temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark collections after the run")
+    parser.add_argument("-o", "--output", type=str, default="", help="Path to the JSON result file")
+    return parser.parse_args()
+
+def get_rss_mb() -> float:
+    # 現在の常駐メモリ(Linux以外ではピーク値)
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return get_peak_rss_mb()
+
+def get_peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOSはバイト、Linuxはキロバイト
+    return peak / 1024 / 1024 if os.uname().sysname == "Darwin" else peak / 1024
+
+def get_directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def create_vector_db(backend: str, client: LangChainOpenAIClient, work_dir: str, collection_name: str, args) -> LangChainVectorDB:
+    if backend == "numpy":
+        from ai_chat_lib.langchain_modules.langchain_vector_db_numpy import LangChainVectorDBNumpy
+        return LangChainVectorDBNumpy(
+            langchain_openai_client=client, vector_db_url=os.path.join(work_dir, "numpy"), collection_name=collection_name)
+    if backend == "chroma":
+        from ai_chat_lib.langchain_modules.langchain_vector_db_chroma import LangChainVectorDBChroma
+        vector_db = LangChainVectorDBChroma(
+            langchain_openai_client=client, vector_db_url=os.path.join(work_dir, "chroma", collection_name),
+            collection_name=collection_name)
+        hnsw_params = json.loads(args.chroma_hnsw)
+        if hnsw_params:
+            # HNSWの設定はコレクション作成時のみ有効のため、設定を変更して作り直す
+            vector_db._delete_collection()
+            vector_db.hnsw_params = {**vector_db.hnsw_params, **hnsw_params}
+            vector_db.db = vector_db._load()
+        return vector_db
+    if backend == "pgvector":
+        if not args.pg_url:
+            raise ValueError("--pg_url is required for the pgvector backend.")
+        from ai_chat_lib.langchain_modules.langchain_vector_db_pgvector import LangChainVectorDBPGVector
+        return LangChainVectorDBPGVector(langchain_openai_client=client, vector_db_url=args.pg_url, collection_name=collection_name)
+    raise ValueError(f"Unknown backend: {backend}")
+
+def get_disk_bytes(backend: str, work_dir: str, collection_name: str) -> Optional[int]:
+    if backend == "numpy":
+        return get_directory_size(os.path.join(work_dir, "numpy", collection_name))
+    if backend == "chroma":
+        return get_directory_size(os.path.join(work_dir, "chroma", collection_name))
+    # pgvectorは共有テーブルのため、コレクション単位のサイズは取得しない
+    return None
+
+def percentile_ms(latencies: list[float], q: float) -> float:
+    return float(np.percentile(np.array(latencies) * 1000, q)) if latencies else 0.0
+
+async def run_benchmark(backend: str, size: int, args, work_dir: str) -> dict[str, Any]:
+    corpus = SyntheticCorpus(size)
+    embeddings = HashingEmbeddings.get_shared(args.dim)
+    client = BenchmarkEmbeddingClient(props=OpenAIProps(), embedding_model="hashing", embedding_dimensions=args.dim, use_embedding_cache=False)
+    collection_name = f"benchmark_{size}"
+    vector_db = create_vector_db(backend, client, work_dir, collection_name, args)
+    if vector_db.db is None:
+        raise ValueError("db is None")
+
+    rss_before = get_rss_mb()
+    # 1. 登録(Embeddingの作成を含む)
+    ingest_sec = 0.0
+    corpus_matrix = np.zeros((size, args.dim), dtype=np.float32)
+    for start in range(0, size, args.batch_size):
+        texts = corpus.get_texts(start, start + args.batch_size)
+        ids = [f"chunk-{i}" for i in range(start, start + len(texts))]
+        metadatas = [{"bench_id": i, "folder_id": "", "source_id": f"source-{i}"} for i in range(start, start + len(texts))]
+        begin = time.perf_counter()
+        vector_db.db.add_texts(texts, metadatas=metadatas, ids=ids)
+        ingest_sec += time.perf_counter() - begin
+        # 正解の計算用に同じEmbeddingを保持する(計測時間には含めない)
+        corpus_matrix[start:start + len(texts)] = embeddings.embed_matrix(texts)
+        print(f"\r[{backend} {size}] ingested {start + len(texts)}/{size}", end="", flush=True)
+    print()
+    rss_after_ingest = get_rss_mb()
+
+    # 2. 検索
+    search_kwargs = {"k": args.top_k, **json.loads(args.search_kwargs)}
+    queries = corpus.get_queries(args.num_queries)
+    for query in queries[:min(5, len(queries))]:
+        # ウォームアップ
+        await vector_db.vector_search(query, dict(search_kwargs))
+    latencies: list[float] = []
+    recalls: list[float] = []
+    query_matrix = embeddings.embed_matrix(queries)
+    for query, query_vector in zip(queries, query_matrix):
+        begin = time.perf_counter()
+        documents = await vector_db.vector_search(query, dict(search_kwargs))
+        latencies.append(time.perf_counter() - begin)
+        # 全件の総当たりによる上位k件との一致率
+        scores = corpus_matrix @ query_vector
+        k = min(args.top_k, size)
+        expected = set(int(i) for i in np.argpartition(-scores, k - 1)[:k])
+        found = set(int(doc.metadata.get("bench_id", -1)) for doc in documents)
+        recalls.append(len(expected & found) / k)
+
+    result = {
+        "backend": backend,
+        "size": size,
+        "dim": args.dim,
+        "top_k": args.top_k,
+        "queries": len(queries),
+        "search_kwargs": search_kwargs,
+        "ingest_sec": ingest_sec,
+        "ingest_chunks_per_sec": size / ingest_sec if ingest_sec > 0 else 0.0,
+        "latency_p50_ms": percentile_ms(latencies, 50),
+        "latency_p95_ms": percentile_ms(latencies, 95),
+        "latency_mean_ms": float(np.mean(latencies) * 1000) if latencies else 0.0,
+        f"recall_at_{args.top_k}": float(np.mean(recalls)) if recalls else 0.0,
+        "rss_before_mb": rss_before,
+        "rss_after_ingest_mb": rss_after_ingest,
+        "peak_rss_mb": get_peak_rss_mb(),
+        "disk_bytes": get_disk_bytes(backend, work_dir, collection_name),
+    }
+    if backend == "chroma":
+        result["chroma_hnsw"] = vector_db.hnsw_params # type: ignore
+    if not args.keep:
+        # アプリケーションのデータ(検索結果キャッシュの世代)を更新しないよう、ベクトルDB固有の削除のみ行う
+        vector_db._delete_collection()
+    return result
+
+async def main():
+    # 環境変数を読み込む
+    load_dotenv()
+    args = parse_args()
+
+    # キーワードインデックスを作成しないよう、アプリケーションのデータは参照しない
+    os.environ.pop("APP_DATA_PATH", None)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="vector_benchmark_")
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    try:
+        for size in [int(size) for size in args.sizes.split(",") if size]:
+            for backend in [backend.strip() for backend in args.backends.split(",") if backend.strip()]:
+                result = await run_benchmark(backend, size, args, work_dir)
+                results.append(result)
+                print(
+                    f"{backend:9} size:{size:>8} ingest:{result['ingest_chunks_per_sec']:.0f}/s "
+                    f"p50:{result['latency_p50_ms']:.2f}ms p95:{result['latency_p95_ms']:.2f}ms "
+                    f"recall@{args.top_k}:{result[f'recall_at_{args.top_k}']:.4f} rss:{result['rss_after_ingest_mb']:.0f}MB"
+                )
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Result: {args.output}")
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    import asyncio
+    asyncio.run(main())
@@ -1,6 +1,7 @@
 import aiosqlite
 import json
-from typing import List, Union, Optional, ClassVar
+import os
+from typing import Any, List, Union, Optional, ClassVar
 import uuid
 from pydantic import BaseModel, field_validator
 from typing import Optional, List, Union
@@ -36,6 +37,17 @@ class ContentFolder(BaseModel):
 
     get_content_folder_requests_name: ClassVar[str] = "content_folder_requests"
 
+    # フォルダパスのキャッシュ(folder_id -> folder_path)
+    folder_path_generation_name: ClassVar[str] = "folder_path_generation"
+    max_folder_depth: ClassVar[int] = 64
+    folder_path_cache: ClassVar[dict[str, str]] = {}
+    folder_path_cache_generation: ClassVar[int] = -1
+    # 祖先フォルダのidのキャッシュ(folder_id -> ルートから自身までのidのリスト). フォルダパスのキャッシュと同時に更新する
+    folder_ancestor_cache: ClassVar[dict[str, list[str]]] = {}
+
+    # Embeddingのmetadataに設定する祖先フォルダのキー. folder_ancestor_{深さ}にその深さの祖先フォルダのidを設定する(ルートは0)
+    folder_ancestor_key_prefix: ClassVar[str] = "folder_ancestor_"
+
     @field_validator("is_root_folder", mode="before")
     @classmethod
     def parse_is_root_folder(cls, v):
@@ -105,51 +117,139 @@ class ContentFolder(BaseModel):
         result = self.model_dump()
         return result
 
-    # idを指定して、idとfolder_nameとparent_idを取得する.再帰的に親フォルダを辿り、folderのパスを生成する
+    # idを指定して、folderのパスを生成する
     @classmethod
     async def get_content_folder_path_by_id(cls, folder_id: Optional[str]) -> str:
         if not folder_id:
             logger.info("folder_id is not set.")
             return ""
 
-        async def get_folder_name_recursively(folder_id: str, paths: list[str]) -> list[str]:
-            # データベースへ接続
-            async with aiosqlite.connect(MainDB.get_main_db_path()) as conn:
-                conn.row_factory = aiosqlite.Row
-                async with conn.cursor() as cur:
+        folder_paths = await cls.get_content_folder_paths_by_ids([folder_id])
+        folder_path = folder_paths.get(folder_id, "")
+        logger.debug(f"get_content_folder_path_by_id: Folder path: {folder_path}")
+        return folder_path
 
-                    await cur.execute("SELECT * FROM ContentFoldersCatalog WHERE id=?", (folder_id,))
-                    row = await cur.fetchone()
+    @classmethod
+    async def get_content_folder_paths_by_ids(cls, folder_ids: list[str]) -> dict[str, str]:
+        """
+        複数のfolder_idのパスを1回の再帰CTEでまとめて取得する。
+        取得したパスはプロセス内でキャッシュし、フォルダの更新・削除時に無効化する。
 
-                    # データが存在しない場合はNoneを返す
-                    if row is None:
-                        logger.info(f"Folder with id {folder_id} not found.")
-                        return paths
-                    
-                    logger.info(f"Folder with id {folder_id} found.")
+        Args:
+            folder_ids (list[str]): folder_idのリスト
 
-                    folder_dict = dict(row)
-                    folder_name = folder_dict.get("folder_name", "")
-                    parent_id = folder_dict.get("parent_id", "")
+        Returns:
+            dict[str, str]: folder_id -> folder_path。存在しないフォルダは空文字
+        """
+        target_ids = {folder_id for folder_id in folder_ids if folder_id}
+        if len(target_ids) == 0:
+            return {}
 
-                    logger.info(f"Folder name: {folder_name}, Parent id: {parent_id}")
-                    paths.append(folder_name)
+        async with aiosqlite.connect(MainDB.get_main_db_path()) as conn:
+            # 他プロセスでフォルダが更新されている場合はキャッシュを破棄する
+            await cls._load_folder_ancestry(conn, target_ids)
 
-                    # 親フォルダが存在する場合は再帰的に取得する
-                    if parent_id:
-                        paths = await get_folder_name_recursively(parent_id, paths)
+        return {folder_id: cls.folder_path_cache.get(folder_id, "") for folder_id in target_ids}
 
-            return paths
+    @classmethod
+    async def get_content_folder_ancestor_ids_by_ids(cls, folder_ids: list[str]) -> dict[str, list[str]]:
+        """
+        複数のfolder_idについて、ルートから自身までのフォルダのidを1回の再帰CTEでまとめて取得する。
 
-        # フォルダのパスを取得する
-        paths = await get_folder_name_recursively(folder_id, [])
-        if len(paths) == 0:
-            logger.info(f"Folder with id {folder_id} not found.")
-            return ""
-        # フォルダのパスを生成する
-        folder_path = "/".join(reversed(paths))
-        logger.info(f"get_content_folder_path_by_id: Folder path: {folder_path}")
-        return folder_path
+        Args:
+            folder_ids (list[str]): folder_idのリスト
+
+        Returns:
+            dict[str, list[str]]: folder_id -> ルートから自身までのidのリスト。存在しないフォルダは空のリスト
+        """
+        target_ids = {folder_id for folder_id in folder_ids if folder_id}
+        if len(target_ids) == 0:
+            return {}
+
+        async with aiosqlite.connect(MainDB.get_main_db_path()) as conn:
+            await cls._load_folder_ancestry(conn, target_ids)
+
+        return {folder_id: list(cls.folder_ancestor_cache.get(folder_id, [])) for folder_id in target_ids}
+
+    @classmethod
+    async def _load_folder_ancestry(cls, conn: aiosqlite.Connection, target_ids: set[str]):
+        # 他プロセスでフォルダが更新されている場合はキャッシュを破棄する
+        generation = await MainDB.get_counter(conn, cls.folder_path_generation_name)
+        if generation != cls.folder_path_cache_generation:
+            cls.folder_path_cache.clear()
+            cls.folder_ancestor_cache.clear()
+            cls.folder_path_cache_generation = generation
+
+        missing_ids = [folder_id for folder_id in target_ids if folder_id not in cls.folder_path_cache]
+        if len(missing_ids) == 0:
+            return
+        placeholders = ",".join("?" * len(missing_ids))
+        # 開始フォルダからルートまでの祖先を辿る。循環がある場合に備えて深さを制限する
+        sql = f"""
+            WITH RECURSIVE ancestors(start_id, id, parent_id, folder_name, depth) AS (
+                SELECT id, id, parent_id, folder_name, 0 FROM ContentFoldersCatalog WHERE id IN ({placeholders})
+                UNION ALL
+                SELECT a.start_id, f.id, f.parent_id, f.folder_name, a.depth + 1
+                FROM ContentFoldersCatalog f JOIN ancestors a ON f.id = a.parent_id
+                WHERE a.depth < {cls.max_folder_depth}
+            )
+            SELECT start_id, id, folder_name FROM ancestors ORDER BY start_id, depth DESC
+        """
+        folder_names: dict[str, list[str]] = {}
+        ancestor_ids: dict[str, list[str]] = {}
+        async with conn.execute(sql, missing_ids) as cur:
+            async for start_id, folder_id, folder_name in cur:
+                folder_names.setdefault(start_id, []).append(folder_name)
+                ancestor_ids.setdefault(start_id, []).append(folder_id)
+
+        for folder_id in missing_ids:
+            if folder_id not in folder_names:
+                logger.info(f"Folder with id {folder_id} not found.")
+            cls.folder_path_cache[folder_id] = "/".join(folder_names.get(folder_id, []))
+            cls.folder_ancestor_cache[folder_id] = ancestor_ids.get(folder_id, [])
+
+    @classmethod
+    def get_folder_ancestor_key(cls, depth: int) -> str:
+        return f"{cls.folder_ancestor_key_prefix}{depth}"
+
+    @classmethod
+    async def get_folder_ancestor_metadata(cls, folder_id: str) -> dict[str, str]:
+        """
+        Embeddingのmetadataに設定する祖先フォルダのキーを作成する。
+        例: ルート(A)/B/C の場合 {"folder_ancestor_0": A, "folder_ancestor_1": B, "folder_ancestor_2": C}
+        """
+        if not folder_id:
+            return {}
+        ancestor_ids = (await cls.get_content_folder_ancestor_ids_by_ids([folder_id])).get(folder_id, [])
+        return {cls.get_folder_ancestor_key(depth): ancestor_id for depth, ancestor_id in enumerate(ancestor_ids)}
+
+    @classmethod
+    def is_subfolder_filter_fallback_enabled(cls) -> bool:
+        # 祖先フォルダのキーを設定する前に登録したチャンクのmetadataを更新済み(folder_metadata_backfill)の場合はfalseにする
+        return os.getenv("SUBFOLDER_FILTER_FALLBACK", "true").lower() in ("1", "true", "yes")
+
+    @classmethod
+    async def get_subfolder_filter(cls, folder_id: str) -> dict[str, Any]:
+        """
+        folder_idのフォルダとそのサブフォルダのドキュメントを検索するためのfilterを作成する。
+        深さに対応する祖先フォルダのキー1つの一致条件のため、単一フォルダの検索と同じコストで検索できる。
+        祖先フォルダのキーがないチャンクも検索できるよう、既定ではサブフォルダのfolder_idの$inとの$orにする。
+        """
+        ancestor_ids = (await cls.get_content_folder_ancestor_ids_by_ids([folder_id])).get(folder_id, [])
+        if len(ancestor_ids) == 0:
+            raise ValueError(f"Folder with id {folder_id} not found.")
+        ancestor_filter: dict[str, Any] = {cls.get_folder_ancestor_key(len(ancestor_ids) - 1): folder_id}
+        if not cls.is_subfolder_filter_fallback_enabled():
+            return ancestor_filter
+        folder_ids = [folder_id] + await cls.get_content_folder_child_ids(folder_id)
+        return {"$or": [ancestor_filter, {"folder_id": {"$in": folder_ids}}]}
+
+    @classmethod
+    async def _invalidate_folder_path_cache(cls, conn: aiosqlite.Connection):
+        # 世代カウンターを進めて、全プロセスのフォルダパスキャッシュを無効化する
+        await MainDB.increment_counter(conn, cls.folder_path_generation_name)
+        cls.folder_path_cache.clear()
+        cls.folder_ancestor_cache.clear()
 
     # pathを指定して、pathにマッチするエントリーを再帰的に辿り、folderを取得する
     @classmethod
@@ -231,9 +331,10 @@ class ContentFolder(BaseModel):
 
         # include_pathがTrueの場合は、folder_pathを設定する
         if include_path:
+            folder_paths = await cls.get_content_folder_paths_by_ids([folder.id for folder in folders if folder.id])
             for folder in folders:
                 if folder.id:
-                    folder.folder_path = await cls.get_content_folder_path_by_id(folder.id)
+                    folder.folder_path = folder_paths.get(folder.id, "")
         return folders
 
     @classmethod
@@ -323,6 +424,7 @@ class ContentFolder(BaseModel):
                     logger.info(f"SQL: {sql}")
                     await cur.execute(sql)
 
+                await cls._invalidate_folder_path_cache(conn)
                 await conn.commit()
 
     @classmethod
@@ -386,34 +488,26 @@ class ContentFolder(BaseModel):
                 # delete_idsを削除する
                 for delete_id in delete_ids:
                     await cur.execute("DELETE FROM ContentFoldersCatalog WHERE id=?", (delete_id,))
+            await cls._invalidate_folder_path_cache(conn)
             await conn.commit()
 
-    # childrenのidを取得する
+    # 子孫フォルダのidを1回の再帰CTEで取得する
     @classmethod
     async def get_content_folder_child_ids(cls, folder_id: str) -> list[str]:
-        async def get_children_recursively(folder_id: str) -> list[str]:
-            # データベースへ接続
-            async with aiosqlite.connect(MainDB.get_main_db_path()) as conn:
-                conn.row_factory = aiosqlite.Row
-                async with conn.cursor() as cur:
-                    await cur.execute("SELECT * FROM ContentFoldersCatalog WHERE parent_id=?", (folder_id,))
-                    rows = await cur.fetchall()
-                    rows = list(rows)
-
-                    # データが存在しない場合は空のリストを返す
-                    if len(rows) == 0:
-                        return []
-
-                    children = []
-                    for row in rows:
-                        folder_dict = dict(row)
-                        children.append(folder_dict["id"])
-                        children.extend(await get_children_recursively(folder_dict["id"]))
-            return children
-        
-        # フォルダの子供を取得する
-        children = await get_children_recursively(folder_id)
-        return children
+        sql = f"""
+            WITH RECURSIVE descendants(id, depth) AS (
+                SELECT id, 1 FROM ContentFoldersCatalog WHERE parent_id = ?
+                UNION ALL
+                SELECT f.id, d.depth + 1
+                FROM ContentFoldersCatalog f JOIN descendants d ON f.parent_id = d.id
+                WHERE d.depth < {cls.max_folder_depth}
+            )
+            SELECT id FROM descendants
+        """
+        async with aiosqlite.connect(MainDB.get_main_db_path()) as conn:
+            async with conn.execute(sql, (folder_id,)) as cur:
+                rows = await cur.fetchall()
+        return [row[0] for row in rows]
 
     @classmethod
     async def get_content_folder_ids_by_path(cls, folder_path: str) -> list[str]:
@@ -139,6 +139,25 @@ class MainDB:
                     await cur.execute("UPDATE DBProperties SET value=? WHERE name=?", (value, name))
                 await conn.commit()
 
+    #########################################
+    # 世代カウンター関連
+    # キャッシュの無効化をプロセス間で共有するため、DBPropertiesにカウンターを保持する
+    #########################################
+    @classmethod
+    async def get_counter(cls, conn: aiosqlite.Connection, name: str) -> int:
+        async with conn.execute("SELECT value FROM DBProperties WHERE name=?", (name,)) as cur:
+            row = await cur.fetchone()
+        if row is None:
+            return 0
+        return int(row[0])
+
+    @classmethod
+    async def increment_counter(cls, conn: aiosqlite.Connection, name: str) -> None:
+        # コミットは呼び出し元で行う
+        cur = await conn.execute("UPDATE DBProperties SET value=CAST(value AS INTEGER) + 1 WHERE name=?", (name,))
+        if cur.rowcount == 0:
+            await conn.execute("INSERT INTO DBProperties (id, name, value) VALUES (?, ?, ?)", (str(uuid.uuid4()), name, "1"))
+
     async def delete_db_property(self, name: str):
         async with aiosqlite.connect(self.db_path) as conn:
             async with conn.cursor() as cur:
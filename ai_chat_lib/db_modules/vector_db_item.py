@@ -1,6 +1,6 @@
 import aiosqlite
 import json
-from typing import List, Union, Optional, ClassVar
+from typing import List, Union, Optional, ClassVar, Literal
 import uuid
 import os
 from pydantic import BaseModel, Field, field_validator
@@ -28,10 +28,18 @@ class VectorDBItem(BaseModel):
         "chunk_size" INTEGER NOT NULL,
         "default_search_result_limit" INTEGER NOT NULL,
         "is_enabled" INTEGER NOT NULL,
-        "is_system" INTEGER NOT NULL
+        "is_system" INTEGER NOT NULL,
+        "vector_precision" TEXT NOT NULL DEFAULT 'float32',
+        "embedding_dimensions" INTEGER NOT NULL DEFAULT 0
     )    
     '''
 
+    # 既存のテーブルに後から追加した列(列名 -> 列定義)
+    additional_columns: ClassVar[dict[str, str]] = {
+        "vector_precision": "TEXT NOT NULL DEFAULT 'float32'",
+        "embedding_dimensions": "INTEGER NOT NULL DEFAULT 0",
+    }
+
     @classmethod    
     async def create_table(cls):
         # VectorDBItemsテーブルが存在しない場合は作成する
@@ -44,8 +52,10 @@ class VectorDBItem(BaseModel):
                 ''')
                 table = await rows.fetchone()
                 if table is not None:
-                    # テーブルが存在する場合は何もしない
+                    # テーブルが存在する場合は不足している列のみ追加する
                     logger.debug("VectorDBItems table already exists.")
+                    await cls._add_missing_columns(cur)
+                    await conn.commit()
                     return
                 else:
                     # テーブルが存在しない場合は作成する
@@ -64,13 +74,24 @@ class VectorDBItem(BaseModel):
                             default_search_result_limit INTEGER NOT NULL,
                             default_score_threshold REAL NOT NULL DEFAULT 0.5,
                             is_enabled INTEGER NOT NULL,
-                            is_system INTEGER NOT NULL
+                            is_system INTEGER NOT NULL,
+                            vector_precision TEXT NOT NULL DEFAULT 'float32',
+                            embedding_dimensions INTEGER NOT NULL DEFAULT 0
                         )
                     ''')
                     await conn.commit()
 
                     await cls.update_default_data()
 
+    @classmethod
+    async def _add_missing_columns(cls, cur: aiosqlite.Cursor):
+        rows = await cur.execute("PRAGMA table_info(VectorDBItems)")
+        existing_columns = {row[1] for row in await rows.fetchall()}
+        for column_name, column_definition in cls.additional_columns.items():
+            if column_name not in existing_columns:
+                logger.info(f"Adding column to VectorDBItems: {column_name}")
+                await cur.execute(f"ALTER TABLE VectorDBItems ADD COLUMN {column_name} {column_definition}")
+
     @classmethod
     async def update_default_data(cls):
         # name="default"のVectorDBItemを取得
@@ -87,7 +108,7 @@ class VectorDBItem(BaseModel):
                 "doc_store_url": f'sqlite:///{os.path.join(os.getenv("APP_DATA_PATH", ""), "server", "vector_db", "default_doc_store.db")}',
                 "vector_db_type": 1,
                 "collection_name": "ai_app_default_collection",
-                "chunk_size": 4096,
+                "chunk_size": cls.DEFAULT_CHUNK_SIZE,
                 "default_search_result_limit": 10,
                 "is_enable": True,
                 "is_system": False,
@@ -101,10 +122,18 @@ class VectorDBItem(BaseModel):
         else:
             # 存在する場合は初期化処理を行わない
             logger.info("VectorDBItem is already exists.")
+            # 以前の既定値(文字数として扱っていた4096)のままの場合は、トークン数の既定値に変更する
+            if vector_db_item.chunk_size == cls.LEGACY_DEFAULT_CHUNK_SIZE:
+                vector_db_item.chunk_size = cls.DEFAULT_CHUNK_SIZE
+                await cls.update_vector_db_item(vector_db_item)
+                logger.info(f"default VectorDBItem chunk_size updated: {cls.LEGACY_DEFAULT_CHUNK_SIZE} -> {cls.DEFAULT_CHUNK_SIZE}")
 
     # コレクションの指定がない場合はデフォルトのコレクション名を使用
     DEFAULT_COLLECTION_NAME: ClassVar[str] = "ai_app_default_collection"
     FOLDER_CATALOG_COLLECTION_NAME: ClassVar[str] = "ai_app_folder_catalog_collection"
+    # 既定のVectorDBItemのchunk_size(Embeddingを作成するチャンクのトークン数)
+    DEFAULT_CHUNK_SIZE: ClassVar[int] = 1000
+    LEGACY_DEFAULT_CHUNK_SIZE: ClassVar[int] = 4096
 
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
@@ -118,9 +147,11 @@ class VectorDBItem(BaseModel):
     default_score_threshold: float = 0.5
     is_enabled: bool = False
     is_system: bool = False
-    vector_db_type: int = Field(default=0, ge=0, le=2, description="0: Chroma, 1: PGVector, 2: Other")
+    vector_db_type: int = Field(default=0, ge=0, le=3, description="0: Chroma, 1: PGVector, 2: Other, 3: NumPy")
     system_message: Optional[str] = None
     folder_id: Optional[str] = ""
+    vector_precision: Literal["float32", "float16", "int8"] = Field(default="float32", description="ベクトルの保存精度(NumPyのみ)")
+    embedding_dimensions: int = Field(default=0, ge=0, description="Embeddingの次元数(text-embedding-3のdimensions)。0の場合はモデルの既定値")
 
     @field_validator("is_use_multi_vector_retriever")
     @classmethod
@@ -233,6 +264,8 @@ class VectorDBItem(BaseModel):
             return "PGVector"
         elif self.vector_db_type == 2:
             return "Other"
+        elif self.vector_db_type == 3:
+            return "NumPy"
         else:
             return "Unknown"
 
@@ -308,22 +341,24 @@ class VectorDBItem(BaseModel):
     @classmethod
     async def update_vector_db_item(cls, vector_db_item: "VectorDBItem") -> "VectorDBItem":
         if not vector_db_item.vector_db_type:
-            raise ValueError("vector_db_type must be 1:Chroma or 2:PGVector")
+            raise ValueError("vector_db_type must be 1:Chroma, 2:PGVector or 3:NumPy")
 
         async with aiosqlite.connect(MainDB.get_main_db_path()) as conn:
             async with conn.cursor() as cur:
                 if await cls.get_vector_db_by_id(vector_db_item.id) is None:
-                    await cur.execute("INSERT INTO VectorDBItems VALUES (?, ? , ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    await cur.execute("""INSERT INTO VectorDBItems (id, name, description, vector_db_url, is_use_multi_vector_retriever, doc_store_url, vector_db_type, collection_name, chunk_size, default_search_result_limit, default_score_threshold, is_enabled, is_system, vector_precision, embedding_dimensions)
+                                VALUES (?, ? , ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                                 (vector_db_item.id, vector_db_item.name, vector_db_item.description, 
                                 vector_db_item.vector_db_url, vector_db_item.is_use_multi_vector_retriever, 
                                 vector_db_item.doc_store_url, vector_db_item.vector_db_type, 
                                 vector_db_item.collection_name, 
                                 vector_db_item.chunk_size, vector_db_item.default_search_result_limit, 
                                 vector_db_item.default_score_threshold,
-                                vector_db_item.is_enabled, vector_db_item.is_system)
+                                vector_db_item.is_enabled, vector_db_item.is_system,
+                                vector_db_item.vector_precision, vector_db_item.embedding_dimensions)
                                 )
                 else:
-                    await cur.execute("UPDATE VectorDBItems SET name=?, description=?, vector_db_url=?, is_use_multi_vector_retriever=?, doc_store_url=?, vector_db_type=?, collection_name=?, chunk_size=?, default_search_result_limit=?, default_score_threshold=?, is_enabled=?, is_system=? WHERE id=?",
+                    await cur.execute("UPDATE VectorDBItems SET name=?, description=?, vector_db_url=?, is_use_multi_vector_retriever=?, doc_store_url=?, vector_db_type=?, collection_name=?, chunk_size=?, default_search_result_limit=?, default_score_threshold=?, is_enabled=?, is_system=?, vector_precision=?, embedding_dimensions=? WHERE id=?",
                                 (vector_db_item.name, vector_db_item.description, vector_db_item.vector_db_url, 
                                 vector_db_item.is_use_multi_vector_retriever, vector_db_item.doc_store_url, 
                                 vector_db_item.vector_db_type, vector_db_item.collection_name, 
@@ -331,7 +366,7 @@ class VectorDBItem(BaseModel):
                                 vector_db_item.default_search_result_limit, 
                                 vector_db_item.default_score_threshold,                          
                                 vector_db_item.is_enabled, 
-                                vector_db_item.is_system, vector_db_item.id)
+                                vector_db_item.is_system, vector_db_item.vector_precision, vector_db_item.embedding_dimensions, vector_db_item.id)
                                 )
                 await conn.commit()
 
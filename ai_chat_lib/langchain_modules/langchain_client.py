@@ -8,6 +8,7 @@ from langchain_openai import AzureOpenAIEmbeddings
 from langchain_openai import OpenAIEmbeddings
 
 from ai_chat_lib.llm_modules.openai_util import OpenAIProps
+from ai_chat_lib.langchain_modules.langchain_embedding_cache import EmbeddingCacheStore
 
 import ai_chat_lib.log_modules.log_settings as log_settings
 logger = log_settings.getLogger(__name__)
@@ -15,6 +16,14 @@ logger = log_settings.getLogger(__name__)
 class LangChainOpenAIClient(BaseModel):
     props: OpenAIProps = Field(..., description="OpenAI properties")
     embedding_model: str = Field(default="text-embedding-3-small", description="Embedding model name")
+    use_embedding_cache: bool = Field(default=True, description="Embeddingのディスクキャッシュを利用するかどうか")
+    embedding_dimensions: int = Field(default=0, ge=0, description="Embeddingの次元数(text-embedding-3のdimensions)。0の場合はモデルの既定値")
+
+    def get_embedding_model_key(self) -> str:
+        # 次元数が異なるEmbeddingを区別するため、キャッシュのキーに次元数を含める
+        if self.embedding_dimensions > 0:
+            return f"{self.embedding_model}:{self.embedding_dimensions}"
+        return self.embedding_model
 
     def get_embedding_client(self):
         if not self.embedding_model:
@@ -24,6 +33,8 @@ class LangChainOpenAIClient(BaseModel):
             params = self.props.create_azure_openai_dict()
             # modelを設定する。
             params["model"] = self.embedding_model
+            if self.embedding_dimensions > 0:
+                params["dimensions"] = self.embedding_dimensions
             embeddings = AzureOpenAIEmbeddings(
                 **params
             )
@@ -31,9 +42,14 @@ class LangChainOpenAIClient(BaseModel):
             params =self.props.create_openai_dict()
             # modelを設定する。
             params["model"] = self.embedding_model
+            if self.embedding_dimensions > 0:
+                params["dimensions"] = self.embedding_dimensions
             embeddings = OpenAIEmbeddings(
                 **params
             )
+        # 計算済みのEmbeddingを再利用するため、ディスクキャッシュでラップする
+        if self.use_embedding_cache:
+            return EmbeddingCacheStore.wrap(embeddings, self.get_embedding_model_key())
         return embeddings
         
 
@@ -1,70 +1,253 @@
-
 import os, json, sys
+import zlib
+import threading
 from langchain.docstore.document import Document
 from langchain_core.stores import BaseStore
-from typing import Sequence, Optional, Tuple, Iterator, Union, TypeVar
-from sqlalchemy import create_engine
-from sqlalchemy import text
+from typing import Sequence, Optional, Tuple, Iterator, Union, TypeVar, ClassVar
+import sqlalchemy
+from sqlalchemy import text, bindparam
 import abc
 from typing import Any
 
+from ai_chat_lib.langchain_modules.sql_engine_pool import SQLEnginePool
+
+import ai_chat_lib.log_modules.log_settings as log_settings
+logger = log_settings.getLogger(__name__)
+
+# 圧縮形式で利用するオプションのライブラリ(インストールされていない場合はzlib + JSONを利用する)
+try:
+    import zstandard # type: ignore
+except ImportError:
+    zstandard = None
+try:
+    import msgpack # type: ignore
+except ImportError:
+    msgpack = None
+
 sys.path.append("python")
 K = TypeVar("K")
 V = TypeVar("V")
 
 class SQLDocStore(BaseStore):
-    
-    def __init__(self, url:str):
+    """
+    documentsテーブルにDocumentを保存するDocStore。
+    storage_formatが"compressed"の場合はdata_blob列に圧縮したバイナリを保存する。
+    data_blobの先頭1バイトは形式(圧縮方式とシリアライズ方式)を表し、読み込み時はdata列のJSONにも対応する。
+    """
+
+    # 1回のSQLで扱うキーの最大数
+    sql_batch_size: ClassVar[int] = 500
+    # SELECTで取得するdata列の式(JSON文字列として取得する)
+    select_data_column: ClassVar[str] = "data"
+
+    storage_format_json: ClassVar[str] = "json"
+    storage_format_compressed: ClassVar[str] = "compressed"
+    # data_blobの形式を表す先頭1バイト
+    blob_format_zlib_json: ClassVar[int] = 1
+    blob_format_zstd_json: ClassVar[int] = 2
+    blob_format_zlib_msgpack: ClassVar[int] = 3
+    blob_format_zstd_msgpack: ClassVar[int] = 4
+    # documentsテーブルの存在確認が済んだURL
+    initialized_urls: ClassVar[set[str]] = set()
+    initialized_urls_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url: str, storage_format: Optional[str] = None) -> "SQLDocStore":
+        """
+        URLのスキームに応じたDocStoreを作成する。PostgreSQLの場合はSQLDocStorePostgresを利用する。
+        """
+        if url.startswith("postgresql"):
+            from ai_chat_lib.langchain_modules.langchain_doc_store_postgres import SQLDocStorePostgres
+            return SQLDocStorePostgres(url, storage_format=storage_format)
+        return SQLDocStore(url, storage_format=storage_format)
+
+    def __init__(self, url:str, storage_format: Optional[str] = None):
         self.url = url
-        self.engine  = create_engine(url)
-        connection = self.engine.connect()
-        # documentsテーブルがなければ作成
-        sql = text("CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, data TEXT)")
-        connection.execute(sql)
-        connection.commit()
-        connection.close()
-        
-        
+        # 保存形式。指定がない場合は環境変数DOC_STORE_FORMAT(json/compressed)
+        self.storage_format = storage_format or os.getenv("DOC_STORE_FORMAT", self.storage_format_json)
+        if self.storage_format not in (self.storage_format_json, self.storage_format_compressed):
+            raise ValueError(f"Invalid storage_format: {self.storage_format}")
+        # URL毎に共有するEngineを利用する
+        self.engine = SQLEnginePool.get_engine(url)
+        self._create_table_if_not_exists()
+
+    def _create_table_if_not_exists(self) -> None:
+        # documentsテーブルがなければ作成(URL毎に1回のみ確認する)
+        with self.initialized_urls_lock:
+            if self.url in self.initialized_urls:
+                return
+            with self.engine.begin() as connection:
+                connection.execute(text("CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, data TEXT)"))
+                # 圧縮形式用のdata_blob列がなければ追加する
+                columns = [column["name"] for column in sqlalchemy.inspect(connection).get_columns("documents")]
+                if "data_blob" not in columns:
+                    blob_type = "BYTEA" if self.engine.dialect.name == "postgresql" else "BLOB"
+                    connection.execute(text(f"ALTER TABLE documents ADD COLUMN data_blob {blob_type}"))
+            self.initialized_urls.add(self.url)
+
+    def _serialize(self, value: Document) -> str:
+        # valueのpage_contentとmetadataをjson文字列に変換
+        dict_item = {"page_content": value.page_content, "metadata": value.metadata}
+        return json.dumps(dict_item, ensure_ascii=False)
+
+    def _deserialize(self, data: str) -> Document:
+        # 結果をjson文字列からdictに変換し、Documentを作成
+        dict_item = json.loads(data)
+        return Document(page_content=dict_item["page_content"], metadata=dict_item["metadata"])
+
+    @classmethod
+    def get_blob_format(cls) -> int:
+        # 利用できるライブラリに応じて、最も効率の良い形式を選択する
+        if zstandard is not None:
+            return cls.blob_format_zstd_msgpack if msgpack is not None else cls.blob_format_zstd_json
+        return cls.blob_format_zlib_msgpack if msgpack is not None else cls.blob_format_zlib_json
+
+    @classmethod
+    def encode_blob(cls, value: Document) -> bytes:
+        """
+        Documentを先頭1バイトの形式と圧縮済みのバイナリに変換する。
+        """
+        dict_item = {"page_content": value.page_content, "metadata": value.metadata}
+        blob_format = cls.get_blob_format()
+        if blob_format in (cls.blob_format_zlib_msgpack, cls.blob_format_zstd_msgpack):
+            payload = msgpack.packb(dict_item, use_bin_type=True) # type: ignore
+        else:
+            payload = json.dumps(dict_item, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if blob_format in (cls.blob_format_zstd_json, cls.blob_format_zstd_msgpack):
+            compressed = zstandard.ZstdCompressor(level=3).compress(payload) # type: ignore
+        else:
+            compressed = zlib.compress(payload, 6)
+        return bytes([blob_format]) + compressed
+
+    @classmethod
+    def decode_blob(cls, blob: bytes) -> Document:
+        """
+        encode_blobで作成したバイナリをDocumentに変換する。
+        """
+        blob = bytes(blob)
+        blob_format, compressed = blob[0], blob[1:]
+        if blob_format in (cls.blob_format_zstd_json, cls.blob_format_zstd_msgpack):
+            if zstandard is None:
+                raise ValueError("zstandard is required to read this document.")
+            payload = zstandard.ZstdDecompressor().decompress(compressed)
+        elif blob_format in (cls.blob_format_zlib_json, cls.blob_format_zlib_msgpack):
+            payload = zlib.decompress(compressed)
+        else:
+            raise ValueError(f"Unknown document blob format: {blob_format}")
+        if blob_format in (cls.blob_format_zlib_msgpack, cls.blob_format_zstd_msgpack):
+            if msgpack is None:
+                raise ValueError("msgpack is required to read this document.")
+            dict_item = msgpack.unpackb(payload, raw=False)
+        else:
+            dict_item = json.loads(payload.decode("utf-8"))
+        return Document(page_content=dict_item["page_content"], metadata=dict_item["metadata"])
+
+    def _decode_row(self, data: Optional[str], data_blob: Optional[bytes]) -> Document:
+        # data_blobがある行は圧縮形式、それ以外は従来のJSON形式
+        if data_blob is not None:
+            return self.decode_blob(data_blob)
+        return self._deserialize(data or "")
+
     def mdelete(self, keys: Sequence[K]) -> None:
-        # documentsテーブルから指定されたkeyのレコードを削除
-        connection = self.engine.connect()
-        for key in keys:
-            sql = text("DELETE FROM documents WHERE id = :key")
-            connection.execute(sql, parameters=dict(key = key) )
-        connection.commit()
-        connection.close()
-            
-    
-    def mget(self, keys: Sequence[K]) -> list[Optional[object]]:
-        # documentsテーブルから指定されたkeyのレコードを取得
-        connection = self.engine.connect()
-        result:list[Any] = []
-        for key in keys:
-            sql = text("SELECT data FROM documents WHERE id = :key")
-            row = connection.execute(sql, parameters=dict(key = key)).fetchall()
-            for r in row:
-                # 結果をjson文字列からdictに変換
-                dict_item = json.loads(r[0])
-                # dict_itemからDocumentを作成
-                result.append(Document(page_content=dict_item["page_content"], metadata=dict_item["metadata"]))
-                
-        connection.close()
-        return result
-    
-    
+        # documentsテーブルから指定されたkeyのレコードをIN句でまとめて削除
+        keys = list(keys)
+        if len(keys) == 0:
+            return
+        with self.engine.begin() as connection:
+            self.mdelete_with_connection(connection, keys)
+
+    def mdelete_with_connection(self, connection: sqlalchemy.Connection, keys: Sequence[K]) -> None:
+        """
+        呼び出し元のトランザクション(connection)の中で指定されたkeyのレコードを削除する。
+        """
+        keys = list(keys)
+        sql = text("DELETE FROM documents WHERE id IN :keys").bindparams(bindparam("keys", expanding=True))
+        for i in range(0, len(keys), self.sql_batch_size):
+            connection.execute(sql, parameters=dict(keys = keys[i:i + self.sql_batch_size]))
+
+    def mget(self, keys: Sequence[K]) -> list[Optional[Document]]:
+        # documentsテーブルから指定されたkeyのレコードをIN句でまとめて取得し、keyの順に返す(存在しない場合はNone)
+        keys = list(keys)
+        if len(keys) == 0:
+            return []
+        documents: dict[Any, Document] = {}
+        sql = text(f"SELECT id, {self.select_data_column}, data_blob FROM documents WHERE id IN :keys").bindparams(bindparam("keys", expanding=True))
+        with self.engine.connect() as connection:
+            unique_keys = list(dict.fromkeys(keys))
+            for i in range(0, len(unique_keys), self.sql_batch_size):
+                rows = connection.execute(sql, parameters=dict(keys = unique_keys[i:i + self.sql_batch_size])).fetchall()
+                for row in rows:
+                    documents[row[0]] = self._decode_row(row[1], row[2])
+        return [documents.get(key, None) for key in keys]
+
     def mset(self, key_value_pairs: Sequence[Tuple[K, Document]]) -> None:
-        # documentsテーブルにkey-valueのペアを保存. keyが既に存在する場合は上書き
-        connection = self.engine.connect()
-        for key, value in key_value_pairs:
-            # valueのpage_contentとmetadataをjson文字列に変換
-            dict_item = {"page_content": value.page_content, "metadata": value.metadata}
-            json_value = json.dumps(dict_item, ensure_ascii=False)
-            sql = text("INSERT OR REPLACE INTO documents (id, data) VALUES (:v1, :v2)")
-            connection.execute(sql, parameters=dict(v1 = key, v2 = json_value))
-
-        connection.commit()
-        connection.close()
-    
+        # documentsテーブルにkey-valueのペアを1つのトランザクションでまとめて保存. keyが既に存在する場合は上書き
+        if len(key_value_pairs) == 0:
+            return
+        with self.engine.begin() as connection:
+            self.mset_with_connection(connection, key_value_pairs)
+
+    def mset_with_connection(self, connection: sqlalchemy.Connection, key_value_pairs: Sequence[Tuple[K, Document]]) -> None:
+        """
+        呼び出し元のトランザクション(connection)の中でkey-valueのペアを保存する。
+        同じデータベースへの他の書き込みと1つのトランザクションにまとめる場合に利用する。
+        """
+        if len(key_value_pairs) == 0:
+            return
+        connection.execute(text(self._get_upsert_sql()), self._get_mset_parameters(key_value_pairs))
+
+    def _get_upsert_sql(self) -> str:
+        return (
+            "INSERT INTO documents (id, data, data_blob) VALUES (:v1, :v2, :v3) "
+            "ON CONFLICT (id) DO UPDATE SET data = excluded.data, data_blob = excluded.data_blob"
+        )
+
+    def _get_mset_parameters(self, key_value_pairs: Sequence[Tuple[K, Document]]) -> list[dict[str, Any]]:
+        # 保存形式に応じて、dataまたはdata_blobのどちらか一方に値を設定する
+        if self.storage_format == self.storage_format_compressed:
+            return [dict(v1 = key, v2 = None, v3 = self.encode_blob(value)) for key, value in key_value_pairs]
+        return [dict(v1 = key, v2 = self._serialize(value), v3 = None) for key, value in key_value_pairs]
+
+    def compact(self, batch_size: int = 500, progress_callback: Optional[Any] = None) -> dict[str, int]:
+        """
+        JSON形式で保存されている行を圧縮形式に書き換える。
+        アプリケーションの実行中でも利用できるよう、batch_size件毎に別のトランザクションで更新する。
+
+        Args:
+            batch_size (int): 1回のトランザクションで書き換える件数
+            progress_callback (Optional[Callable[[int, int], None]]): (書き換えた件数, 対象件数)を受け取る関数
+
+        Returns:
+            dict[str, int]: 書き換えた件数と、書き換え前後のデータサイズ(バイト)
+        """
+        with self.engine.connect() as connection:
+            total = connection.execute(text("SELECT COUNT(*) FROM documents WHERE data_blob IS NULL")).scalar() or 0
+        select_sql = text(
+            f"SELECT id, {self.select_data_column} FROM documents WHERE data_blob IS NULL AND id > :last_id ORDER BY id LIMIT :limit"
+        )
+        update_sql = text("UPDATE documents SET data = NULL, data_blob = :data_blob WHERE id = :id AND data_blob IS NULL")
+        rewritten = 0
+        bytes_before = 0
+        bytes_after = 0
+        last_id = ""
+        while True:
+            with self.engine.begin() as connection:
+                rows = connection.execute(select_sql, parameters=dict(last_id = last_id, limit = batch_size)).fetchall()
+                if len(rows) == 0:
+                    break
+                parameters = []
+                for row in rows:
+                    blob = self.encode_blob(self._deserialize(row[1] or ""))
+                    bytes_before += len((row[1] or "").encode("utf-8"))
+                    bytes_after += len(blob)
+                    parameters.append(dict(id = row[0], data_blob = blob))
+                connection.execute(update_sql, parameters)
+                last_id = rows[-1][0]
+            rewritten += len(rows)
+            if progress_callback is not None:
+                progress_callback(rewritten, total)
+        logger.info(f"doc store compaction finished. rows:{rewritten} bytes:{bytes_before} -> {bytes_after}")
+        return {"rows": rewritten, "bytes_before": bytes_before, "bytes_after": bytes_after}
+
     def yield_keys(self, *, prefix: Optional[str] = None) -> Union[Iterator[object], Iterator[str]]:
         return iter([])
-    
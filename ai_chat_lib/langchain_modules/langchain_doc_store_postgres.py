@@ -1,24 +1,119 @@
-
 import os, json, sys
-from langchain.docstore.document import Document
-from langchain_core.stores import BaseStore
-from typing import Sequence, Optional, Tuple, Iterator, Union, TypeVar
-from sqlalchemy import create_engine
+import threading
+from typing import ClassVar, Optional, Sequence, Tuple, TypeVar
+import sqlalchemy
 from sqlalchemy import text
+from langchain.docstore.document import Document
 from ai_chat_lib.langchain_modules.langchain_doc_store import SQLDocStore
 
+import ai_chat_lib.log_modules.log_settings as log_settings
+logger = log_settings.getLogger(__name__)
+
 sys.path.append("python")
 K = TypeVar("K")
 V = TypeVar("V")
 
 class SQLDocStorePostgres(SQLDocStore):
-    
-    def __init__(self, url:str):
-        self.url = url
-        self.engine  = create_engine(url)
-        connection = self.engine.connect()
-        # documentsテーブルがなければ作成
-        sql = text("CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, data TEXT)")
-        connection.execute(sql)
-        connection.commit()
-        connection.close()
+    """
+    PostgreSQL用のDocStore。
+    - 新規に作成するdocumentsテーブルのdata列はJSONB(既存のTEXT列のテーブルはそのまま利用する)
+    - 少量の書き込みはINSERT ... ON CONFLICT、copy_threshold件以上はCOPYで一時テーブルに読み込んでからまとめて反映する
+    - 環境変数DOC_STORE_PG_COMPRESSION(lz4/pglz)が設定されている場合はdata列のTOAST圧縮方式を設定する(PostgreSQL 14以降)
+    """
+
+    # COPYを利用する件数の閾値
+    copy_threshold: ClassVar[int] = 1000
+    # JSONBはJSON文字列として取得し、SQLiteと同じ方法でDocumentに変換する
+    select_data_column: ClassVar[str] = "data::text"
+    # DOC_STORE_PG_COMPRESSIONの値 -> pg_attribute.attcompressionの値
+    toast_compressions: ClassVar[dict[str, str]] = {"lz4": "l", "pglz": "p"}
+    # data列がJSONBのURL
+    jsonb_urls: ClassVar[set[str]] = set()
+    jsonb_urls_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, url:str, storage_format: Optional[str] = None):
+        # 共有Engineの取得はSQLDocStoreと共通(テーブルの作成は_create_table_if_not_existsでJSONBを利用する)
+        super().__init__(url, storage_format=storage_format)
+
+    def _create_table_if_not_exists(self) -> None:
+        # documentsテーブルがなければJSONBで作成(URL毎に1回のみ確認する)
+        with self.initialized_urls_lock:
+            if self.url in self.initialized_urls:
+                return
+            with self.engine.begin() as connection:
+                inspector = sqlalchemy.inspect(connection)
+                if not inspector.has_table("documents"):
+                    connection.execute(text("CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, data JSONB, data_blob BYTEA)"))
+                    # data_blobは圧縮済みのため、TOASTで再度圧縮しない
+                    connection.execute(text("ALTER TABLE documents ALTER COLUMN data_blob SET STORAGE EXTERNAL"))
+                else:
+                    columns = [column["name"] for column in inspector.get_columns("documents")]
+                    if "data_blob" not in columns:
+                        connection.execute(text("ALTER TABLE documents ADD COLUMN data_blob BYTEA"))
+                        connection.execute(text("ALTER TABLE documents ALTER COLUMN data_blob SET STORAGE EXTERNAL"))
+                data_type = connection.execute(text(
+                    "SELECT data_type FROM information_schema.columns WHERE table_name = 'documents' AND column_name = 'data' "
+                    "AND table_schema = current_schema()"
+                )).scalar()
+                if data_type == "jsonb":
+                    with self.jsonb_urls_lock:
+                        self.jsonb_urls.add(self.url)
+                self._set_column_compression(connection)
+            self.initialized_urls.add(self.url)
+
+    def _set_column_compression(self, connection: sqlalchemy.Connection) -> None:
+        # data列のTOAST圧縮方式を環境変数の値に合わせる(変更がない場合はALTER TABLEを実行しない)
+        compression = os.getenv("DOC_STORE_PG_COMPRESSION", "")
+        if not compression:
+            return
+        if compression not in self.toast_compressions:
+            raise ValueError(f"Invalid DOC_STORE_PG_COMPRESSION: {compression}")
+        current = connection.execute(text(
+            "SELECT attcompression FROM pg_attribute WHERE attrelid = 'documents'::regclass AND attname = 'data'"
+        )).scalar()
+        if current != self.toast_compressions[compression]:
+            connection.execute(text(f"ALTER TABLE documents ALTER COLUMN data SET COMPRESSION {compression}"))
+
+    def _serialize(self, value: Document) -> str:
+        # JSONBは文字列中のNUL文字を扱えないため取り除く
+        dict_item = {"page_content": value.page_content.replace("\x00", ""), "metadata": value.metadata}
+        return json.dumps(dict_item, ensure_ascii=False)
+
+    def _get_upsert_sql(self) -> str:
+        data_value = "CAST(:v2 AS JSONB)" if self.url in self.jsonb_urls else ":v2"
+        return (
+            f"INSERT INTO documents (id, data, data_blob) VALUES (:v1, {data_value}, :v3) "
+            "ON CONFLICT (id) DO UPDATE SET data = excluded.data, data_blob = excluded.data_blob"
+        )
+
+    def mset_with_connection(self, connection: sqlalchemy.Connection, key_value_pairs: Sequence[Tuple[K, Document]]) -> None:
+        if len(key_value_pairs) < self.copy_threshold:
+            super().mset_with_connection(connection, key_value_pairs)
+            return
+        driver_connection = connection.connection.driver_connection
+        if not type(driver_connection).__module__.startswith("psycopg."):
+            # COPYに対応していないドライバ(psycopg2等)の場合はINSERT ... ON CONFLICTで保存する
+            super().mset_with_connection(connection, key_value_pairs)
+            return
+        self._copy_documents(connection, key_value_pairs)
+
+    def _copy_documents(self, connection: sqlalchemy.Connection, key_value_pairs: Sequence[Tuple[K, Document]]) -> None:
+        # ON CONFLICTは同じ文の中で同じ行を2回更新できないため、同じkeyは最後の値のみ残す
+        parameters = list({param["v1"]: param for param in self._get_mset_parameters(key_value_pairs)}.values())
+        connection.execute(text(
+            "CREATE TEMP TABLE IF NOT EXISTS documents_copy (id TEXT, data TEXT, data_blob BYTEA) ON COMMIT DELETE ROWS"
+        ))
+        cursor = connection.connection.cursor()
+        try:
+            with cursor.copy("COPY documents_copy (id, data, data_blob) FROM STDIN") as copy: # type: ignore
+                for param in parameters:
+                    copy.write_row((param["v1"], param["v2"], param["v3"]))
+        finally:
+            cursor.close()
+        data_value = "CAST(data AS JSONB)" if self.url in self.jsonb_urls else "data"
+        connection.execute(text(
+            f"INSERT INTO documents (id, data, data_blob) SELECT id, {data_value}, data_blob FROM documents_copy "
+            "ON CONFLICT (id) DO UPDATE SET data = excluded.data, data_blob = excluded.data_blob"
+        ))
+        connection.execute(text("DELETE FROM documents_copy"))
+        logger.info(f"documents copied: {len(parameters)}")
@@ -0,0 +1,408 @@
+"""
+langchain_embedding_cache.py
+
+Embeddingのディスクキャッシュを提供するモジュール。
+- (モデル, チャンクのハッシュ)をキーとしてEmbeddingを保存する
+- インデックスはSQLite、ベクトル本体は次元毎のfloat32 memmapファイルに保存する
+- エントリ数/サイズの上限を超えた場合はLRUで追い出す
+- 読み込みはロックを取得せずに行い、読み込んだベクトルのチェックサムで他プロセスによるスロットの書き換えを検出する
+- APIサーバ、バッチアップローダー、MCPサーバで同じキャッシュディレクトリを共有する
+"""
+
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+import asyncio
+import threading
+from typing import Any, Optional, ClassVar
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+import ai_chat_lib.log_modules.log_settings as log_settings
+logger = log_settings.getLogger(__name__)
+
+
+class EmbeddingCacheStore:
+    """
+    Embeddingをディスクに保存するキャッシュストア。
+    スレッドセーフ。複数プロセスから同じディレクトリを開いても、
+    スロットの割り当てはSQLiteのトランザクションで直列化される。
+    """
+
+    # 1回のSQLで扱うキーの最大数(SQLiteのパラメータ数上限対策)
+    sql_batch_size: ClassVar[int] = 500
+    # memmapファイルを拡張する際の最小スロット数
+    min_capacity: ClassVar[int] = 1024
+    # LRU用の最終アクセス時刻は、溜まった件数か経過時間でまとめて更新する
+    touch_batch_size: ClassVar[int] = 256
+    touch_flush_interval: ClassVar[float] = 5.0
+    # 更新できなかった最終アクセス時刻を保持する最大件数(超えた場合は破棄する)
+    max_pending_touches: ClassVar[int] = 10000
+
+    _shared_stores: ClassVar[dict[str, "EmbeddingCacheStore"]] = {}
+    _shared_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, cache_dir: str, max_entries: int = 100000, max_bytes: int = 0):
+        """
+        Args:
+            cache_dir (str): キャッシュを保存するディレクトリ
+            max_entries (int): 次元毎の最大エントリ数
+            max_bytes (int): 次元毎のベクトルファイルの最大サイズ(0の場合は無制限)
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._memmaps: dict[int, np.memmap] = {}
+        self._conn = sqlite3.connect(os.path.join(cache_dir, "embedding_cache.db"), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS embedding_cache_index (
+                key TEXT NOT NULL PRIMARY KEY,
+                model TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                slot INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                checksum INTEGER
+            )
+        ''')
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(embedding_cache_index)").fetchall()]
+        if "checksum" not in columns:
+            # チェックサムのない既存のエントリは、読み込み時にキャッシュミスとして扱い再作成する
+            self._conn.execute("ALTER TABLE embedding_cache_index ADD COLUMN checksum INTEGER")
+        self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_embedding_cache_slot ON embedding_cache_index (dim, slot)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_access ON embedding_cache_index (dim, last_access)")
+        self._conn.commit()
+
+        # 未反映の最終アクセス時刻(キー -> 時刻)
+        self._pending_touches: dict[str, float] = {}
+        self._last_touch_flush = time.time()
+
+        # 統計情報(プロセス内)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.checksum_mismatches = 0
+
+    @classmethod
+    def get_default_cache_dir(cls) -> Optional[str]:
+        # EMBEDDING_CACHE_PATHが設定されている場合はそれを使用する
+        cache_dir = os.getenv("EMBEDDING_CACHE_PATH", None)
+        if cache_dir:
+            return cache_dir
+        app_data_path = os.getenv("APP_DATA_PATH", None)
+        if not app_data_path:
+            return None
+        return os.path.join(app_data_path, "server", "embedding_cache")
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        return os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() != "false"
+
+    @classmethod
+    def get_shared_store(cls) -> Optional["EmbeddingCacheStore"]:
+        """
+        プロセス内で共有するキャッシュストアを取得する。
+        キャッシュが無効、またはAPP_DATA_PATHが未設定の場合はNoneを返す。
+
+        Returns:
+            Optional[EmbeddingCacheStore]: 共有キャッシュストア
+        """
+        if not cls.is_enabled():
+            return None
+        cache_dir = cls.get_default_cache_dir()
+        if not cache_dir:
+            logger.info("APP_DATA_PATH is not set. embedding cache is disabled.")
+            return None
+
+        with cls._shared_lock:
+            store = cls._shared_stores.get(cache_dir, None)
+            if store is None:
+                max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+                max_bytes = int(float(os.getenv("EMBEDDING_CACHE_MAX_MB", "0")) * 1024 * 1024)
+                store = EmbeddingCacheStore(cache_dir, max_entries=max_entries, max_bytes=max_bytes)
+                cls._shared_stores[cache_dir] = store
+            return store
+
+    @classmethod
+    def wrap(cls, embeddings: Embeddings, model_key: str) -> Embeddings:
+        """
+        共有キャッシュストアが利用可能な場合は、embeddingsをCachedEmbeddingsでラップする。
+
+        Args:
+            embeddings (Embeddings): ラップするEmbeddings
+            model_key (str): キャッシュキーに使用するモデル名
+
+        Returns:
+            Embeddings: キャッシュ付きのEmbeddings、またはembeddingsそのもの
+        """
+        store = cls.get_shared_store()
+        if store is None:
+            return embeddings
+        return CachedEmbeddings(embeddings, store, model_key)
+
+    @staticmethod
+    def create_key(model_key: str, text: str) -> str:
+        return hashlib.sha256(f"{model_key}\0{text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def create_checksum(vector: np.ndarray) -> int:
+        return zlib.crc32(np.ascontiguousarray(vector, dtype=np.float32).tobytes())
+
+    def get_max_entries(self, dim: int) -> int:
+        max_entries = self.max_entries
+        if self.max_bytes > 0:
+            max_entries = min(max_entries, self.max_bytes // (dim * 4))
+        return max(max_entries, 1)
+
+    def _get_memmap(self, dim: int, required_slots: int = 0) -> np.memmap:
+        # dim毎のmemmapを取得する。required_slotsを格納できない場合はファイルを拡張する
+        path = os.path.join(self.cache_dir, f"vectors_{dim}.f32")
+        memmap = self._memmaps.get(dim, None)
+        capacity = 0 if memmap is None else memmap.shape[0]
+        if memmap is not None and required_slots <= capacity:
+            return memmap
+
+        file_slots = os.path.getsize(path) // (dim * 4) if os.path.exists(path) else 0
+        if required_slots > file_slots:
+            # 容量を倍々で拡張する(上限はget_max_entries)
+            new_slots = max(required_slots, file_slots * 2, self.min_capacity)
+            new_slots = max(min(new_slots, self.get_max_entries(dim)), required_slots)
+            with open(path, "ab") as f:
+                f.truncate(new_slots * dim * 4)
+            file_slots = new_slots
+        if memmap is not None:
+            memmap.flush()
+        memmap = np.memmap(path, dtype=np.float32, mode="r+", shape=(file_slots, dim))
+        self._memmaps[dim] = memmap
+        return memmap
+
+    def get_many(self, model_key: str, texts: list[str]) -> list[Optional[list[float]]]:
+        """
+        textsに対応するキャッシュ済みEmbeddingを取得する。
+
+        Args:
+            model_key (str): モデル名
+            texts (list[str]): テキストのリスト
+
+        Returns:
+            list[Optional[list[float]]]: textsと同じ順序のEmbedding。存在しない場合はNone
+        """
+        keys = [self.create_key(model_key, text) for text in texts]
+        found: dict[str, tuple[int, int, Optional[int]]] = {}
+        results: list[Optional[list[float]]] = []
+        hit_keys: list[str] = []
+        with self._lock:
+            # 書き込みロックを取得せずに読み込む(他プロセスのput_manyと並行して読み込める)
+            for i in range(0, len(keys), self.sql_batch_size):
+                batch = keys[i:i + self.sql_batch_size]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, dim, slot, checksum FROM embedding_cache_index WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, dim, slot, checksum in rows:
+                    found[key] = (dim, slot, checksum)
+
+            for key in keys:
+                location = found.get(key, None)
+                if location is None:
+                    results.append(None)
+                    continue
+                dim, slot, checksum = location
+                vector = np.array(self._get_memmap(dim, slot + 1)[slot], dtype=np.float32)
+                # 検索後に他プロセスがスロットを追い出して書き換えた場合や、書き込み途中の場合はチェックサムが一致しない
+                if checksum is None or self.create_checksum(vector) != checksum:
+                    if checksum is not None:
+                        self.checksum_mismatches += 1
+                    results.append(None)
+                    continue
+                results.append(vector.tolist())
+                hit_keys.append(key)
+
+            hit_count = len(hit_keys)
+            self.hits += hit_count
+            self.misses += len(keys) - hit_count
+
+            # LRU用の最終アクセス時刻は、読み込みとは別にまとめて更新する
+            now = time.time()
+            for key in hit_keys:
+                self._pending_touches[key] = now
+            if len(self._pending_touches) >= self.touch_batch_size or now - self._last_touch_flush >= self.touch_flush_interval:
+                self._flush_touches(wait=False)
+        return results
+
+    def _flush_touches(self, wait: bool) -> None:
+        """
+        未反映の最終アクセス時刻をまとめて更新する。
+        waitがFalseの場合は他プロセスが書き込み中でも待たずに諦め、次回に持ち越す(LRUの精度のみに影響する)。
+        """
+        self._last_touch_flush = time.time()
+        if not self._pending_touches:
+            return
+        touches = list(self._pending_touches.items())
+        if not wait:
+            self._conn.execute("PRAGMA busy_timeout = 0")
+        try:
+            if not self._conn.in_transaction:
+                self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "UPDATE embedding_cache_index SET last_access=? WHERE key=?", [(last_access, key) for key, last_access in touches]
+            )
+            if not wait:
+                self._conn.commit()
+            self._pending_touches.clear()
+        except sqlite3.OperationalError as e:
+            if wait:
+                raise
+            self._conn.rollback()
+            logger.debug(f"Skipped updating last access of embedding cache: {e}")
+            if len(self._pending_touches) > self.max_pending_touches:
+                self._pending_touches.clear()
+        finally:
+            if not wait:
+                self._conn.execute("PRAGMA busy_timeout = 30000")
+
+    def put_many(self, model_key: str, texts: list[str], vectors: list[list[float]]) -> None:
+        """
+        textsに対応するEmbeddingをキャッシュに保存する。上限を超える場合はLRUで追い出す。
+
+        Args:
+            model_key (str): モデル名
+            texts (list[str]): テキストのリスト
+            vectors (list[list[float]]): Embeddingのリスト
+        """
+        if len(texts) != len(vectors):
+            raise ValueError("texts and vectors must have the same length.")
+        with self._lock:
+            # BEGIN IMMEDIATEで他プロセスとのスロット割り当てを直列化する
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 追い出す対象を正しく選べるよう、未反映の最終アクセス時刻を先に反映する
+                self._flush_touches(wait=True)
+                for text, vector in zip(texts, vectors):
+                    self._put(model_key, self.create_key(model_key, text), vector)
+                for memmap in self._memmaps.values():
+                    memmap.flush()
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def _put(self, model_key: str, key: str, vector: list[float]) -> None:
+        dim = len(vector)
+        now = time.time()
+        array = np.asarray(vector, dtype=np.float32)
+        checksum = self.create_checksum(array)
+        row = self._conn.execute("SELECT slot FROM embedding_cache_index WHERE key=? AND dim=?", (key, dim)).fetchone()
+        if row is not None:
+            slot = row[0]
+            self._conn.execute("UPDATE embedding_cache_index SET last_access=?, checksum=? WHERE key=?", (now, checksum, key))
+        else:
+            count, max_slot = self._conn.execute(
+                "SELECT COUNT(*), MAX(slot) FROM embedding_cache_index WHERE dim=?", (dim,)
+            ).fetchone()
+            if count < self.get_max_entries(dim):
+                slot = 0 if max_slot is None else max_slot + 1
+            else:
+                # 最も古いエントリを追い出してスロットを再利用する
+                slot, evicted_key = self._conn.execute(
+                    "SELECT slot, key FROM embedding_cache_index WHERE dim=? ORDER BY last_access LIMIT 1", (dim,)
+                ).fetchone()
+                self._conn.execute("DELETE FROM embedding_cache_index WHERE key=?", (evicted_key,))
+                self.evictions += 1
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embedding_cache_index (key, model, dim, slot, last_access, checksum) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_key, dim, slot, now, checksum)
+            )
+        memmap = self._get_memmap(dim, slot + 1)
+        memmap[slot] = array
+        self.writes += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM embedding_cache_index")
+            self._conn.commit()
+            self._memmaps.clear()
+            self._pending_touches.clear()
+
+    def get_stats(self) -> dict[str, Any]:
+        """
+        キャッシュの統計情報を取得する。
+
+        Returns:
+            dict[str, Any]: ヒット数、ミス数、ヒット率、エントリ数、ディスク使用量など
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT dim, COUNT(*) FROM embedding_cache_index GROUP BY dim").fetchall()
+        entries = {str(dim): count for dim, count in rows}
+        disk_bytes = 0
+        for name in os.listdir(self.cache_dir):
+            disk_bytes += os.path.getsize(os.path.join(self.cache_dir, name))
+        lookups = self.hits + self.misses
+        return {
+            "cache_dir": self.cache_dir,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "checksum_mismatches": self.checksum_mismatches,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "disk_bytes": disk_bytes,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddingsをラップし、EmbeddingCacheStoreに存在するテキストはAPIを呼び出さずに返すクラス。
+    """
+
+    def __init__(self, underlying: Embeddings, store: EmbeddingCacheStore, model_key: str):
+        self.underlying = underlying
+        self.store = store
+        self.model_key = model_key
+
+    def _merge(self, texts: list[str], cached: list[Optional[list[float]]]) -> tuple[list[str], dict[str, list[int]]]:
+        # キャッシュに存在しないテキストを重複なく抽出する
+        miss_positions: dict[str, list[int]] = {}
+        for i, (text, vector) in enumerate(zip(texts, cached)):
+            if vector is None:
+                miss_positions.setdefault(text, []).append(i)
+        return list(miss_positions.keys()), miss_positions
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        cached = self.store.get_many(self.model_key, texts)
+        miss_texts, miss_positions = self._merge(texts, cached)
+        if miss_texts:
+            vectors = self.underlying.embed_documents(miss_texts)
+            self.store.put_many(self.model_key, miss_texts, vectors)
+            for text, vector in zip(miss_texts, vectors):
+                for i in miss_positions[text]:
+                    cached[i] = vector
+        return [vector for vector in cached if vector is not None]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        # SQLiteとmemmapへのアクセスはイベントループを止めないようにスレッドで実行する
+        cached = await asyncio.to_thread(self.store.get_many, self.model_key, texts)
+        miss_texts, miss_positions = self._merge(texts, cached)
+        if miss_texts:
+            vectors = await self.underlying.aembed_documents(miss_texts)
+            await asyncio.to_thread(self.store.put_many, self.model_key, miss_texts, vectors)
+            for text, vector in zip(miss_texts, vectors):
+                for i in miss_positions[text]:
+                    cached[i] = vector
+        return [vector for vector in cached if vector is not None]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_documents([text]))[0]
@@ -0,0 +1,299 @@
+"""
+langchain_keyword_index.py
+
+ベクトルDBのコレクションと並行して管理するキーワード検索(BM25)用のインデックス。
+- SQLite FTS5を利用し、コレクション毎に1つのDBファイルを作成する
+- 日本語を分かち書きなしで検索できるようにtrigramトークナイザを利用する
+  (trigramが利用できないSQLiteの場合はunicode61を利用する)
+- metadataのfilter($and, $or, $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin)に対応する
+"""
+
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import threading
+from typing import Any, ClassVar, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+import ai_chat_lib.log_modules.log_settings as log_settings
+logger = log_settings.getLogger(__name__)
+
+
+class UnsupportedKeywordFilterError(ValueError):
+    """
+    キーワード検索のSQLに変換できないmetadataのfilter
+    """
+
+
+class KeywordIndex:
+    """
+    FTS5によるキーワードインデックス。スレッドセーフ。
+    """
+
+    # 1回のSQLで扱うパラメータの最大数
+    sql_batch_size: ClassVar[int] = 500
+    # trigramトークナイザで検索できる最小文字数
+    trigram_min_length: ClassVar[int] = 3
+
+    _indexes: ClassVar[dict[str, "KeywordIndex"]] = {}
+    _indexes_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(index_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS keyword_documents (
+                rowid INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                source_id TEXT,
+                folder_id TEXT,
+                metadata_json TEXT NOT NULL,
+                page_content TEXT NOT NULL
+            )
+        ''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_keyword_documents_source_id ON keyword_documents (source_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_keyword_documents_folder_id ON keyword_documents (folder_id)")
+        self.tokenizer = self._create_fts_table()
+        # keyword_documentsとFTSテーブルを同期するトリガー
+        self._conn.executescript('''
+            CREATE TRIGGER IF NOT EXISTS keyword_documents_ai AFTER INSERT ON keyword_documents BEGIN
+                INSERT INTO keyword_fts(rowid, page_content) VALUES (new.rowid, new.page_content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS keyword_documents_ad AFTER DELETE ON keyword_documents BEGIN
+                INSERT INTO keyword_fts(keyword_fts, rowid, page_content) VALUES ('delete', old.rowid, old.page_content);
+            END;
+        ''')
+        self._conn.commit()
+
+    def _create_fts_table(self) -> str:
+        row = self._conn.execute("SELECT sql FROM sqlite_master WHERE name='keyword_fts'").fetchone()
+        if row is not None:
+            return "trigram" if "trigram" in row[0] else "unicode61"
+        try:
+            self._conn.execute('''
+                CREATE VIRTUAL TABLE keyword_fts USING fts5(
+                    page_content, content='keyword_documents', content_rowid='rowid', tokenize='trigram'
+                )
+            ''')
+            return "trigram"
+        except sqlite3.OperationalError:
+            logger.warning("FTS5 trigram tokenizer is not available. Falling back to unicode61.")
+            self._conn.execute('''
+                CREATE VIRTUAL TABLE keyword_fts USING fts5(
+                    page_content, content='keyword_documents', content_rowid='rowid', tokenize='unicode61'
+                )
+            ''')
+            return "unicode61"
+
+    @classmethod
+    def get_index_path(cls, vector_db_url: str, collection_name: str) -> Optional[str]:
+        app_data_path = os.getenv("APP_DATA_PATH", None)
+        if not app_data_path:
+            return None
+        url_hash = hashlib.sha1(vector_db_url.encode("utf-8")).hexdigest()[:8]
+        file_name = re.sub(r"[^\w\-]", "_", collection_name or "default") + f"_{url_hash}.db"
+        return os.path.join(app_data_path, "server", "keyword_index", file_name)
+
+    @classmethod
+    def get_index(cls, vector_db_url: str, collection_name: str) -> Optional["KeywordIndex"]:
+        """
+        コレクションに対応するキーワードインデックスを取得する。
+        APP_DATA_PATHが未設定の場合はNoneを返す。
+
+        Args:
+            vector_db_url (str): ベクトルDBのURL
+            collection_name (str): コレクション名
+
+        Returns:
+            Optional[KeywordIndex]: キーワードインデックス
+        """
+        index_path = cls.get_index_path(vector_db_url, collection_name)
+        if index_path is None:
+            return None
+        with cls._indexes_lock:
+            index = cls._indexes.get(index_path, None)
+            if index is None:
+                index = KeywordIndex(index_path)
+                cls._indexes[index_path] = index
+            return index
+
+    def add_documents(self, ids: Sequence[str], documents: Sequence[Document]) -> None:
+        rows = []
+        for id, doc in zip(ids, documents):
+            rows.append((
+                id, doc.metadata.get("source_id", None), doc.metadata.get("folder_id", None),
+                json.dumps(doc.metadata, ensure_ascii=False), doc.page_content
+            ))
+        with self._lock:
+            # 既存のidは置き換える(DELETEトリガーでFTSからも削除される)
+            self._conn.executemany("DELETE FROM keyword_documents WHERE id=?", [(row[0],) for row in rows])
+            self._conn.executemany(
+                "INSERT INTO keyword_documents (id, source_id, folder_id, metadata_json, page_content) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+
+    def update_metadatas(self, ids: Sequence[str], metadatas: Sequence[dict[str, Any]]) -> None:
+        # page_contentは変更しないため、FTSテーブルの更新は不要
+        rows = [
+            (metadata.get("source_id", None), metadata.get("folder_id", None), json.dumps(metadata, ensure_ascii=False), id)
+            for id, metadata in zip(ids, metadatas)
+        ]
+        with self._lock:
+            self._conn.executemany("UPDATE keyword_documents SET source_id=?, folder_id=?, metadata_json=? WHERE id=?", rows)
+            self._conn.commit()
+
+    def delete_by_ids(self, ids: Sequence[str]) -> None:
+        with self._lock:
+            self._conn.executemany("DELETE FROM keyword_documents WHERE id=?", [(id,) for id in ids])
+            self._conn.commit()
+
+    def delete_by_metadata(self, name: str, values: Sequence[str]) -> int:
+        """
+        metadataの値を指定してドキュメントを削除する。
+
+        Args:
+            name (str): metadataのキー
+            values (Sequence[str]): 削除対象の値
+
+        Returns:
+            int: 削除した件数
+        """
+        column = self._get_column_expression(name)
+        deleted = 0
+        with self._lock:
+            for i in range(0, len(values), self.sql_batch_size):
+                batch = list(values[i:i + self.sql_batch_size])
+                placeholders = ",".join("?" * len(batch))
+                cur = self._conn.execute(f"DELETE FROM keyword_documents WHERE {column} IN ({placeholders})", batch)
+                deleted += cur.rowcount
+            self._conn.commit()
+        return deleted
+
+    def delete_all(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM keyword_documents")
+            self._conn.execute("INSERT INTO keyword_fts(keyword_fts) VALUES ('rebuild')")
+            self._conn.commit()
+
+    def _get_column_expression(self, name: str) -> str:
+        # source_id, folder_idはインデックス付きの列、それ以外はmetadata_jsonから取得する
+        if name in ("source_id", "folder_id"):
+            return name
+        if not re.fullmatch(r"\w+", name):
+            raise ValueError(f"Invalid metadata key: {name}")
+        return f"json_extract(metadata_json, '$.{name}')"
+
+    # 比較演算子 -> SQLの演算子
+    filter_comparison_operators: ClassVar[dict[str, str]] = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+    def _create_filter_sql(self, filter: Optional[dict[str, Any]]) -> Tuple[str, list[Any]]:
+        """
+        Chroma形式のfilterをSQLの条件式に変換する。
+        対応する演算子: $and, $or, $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin
+        変換できない場合はUnsupportedKeywordFilterErrorを発生させる
+        """
+        if not filter:
+            return "", []
+        conditions: list[str] = []
+        params: list[Any] = []
+        for key, value in filter.items():
+            if key in ("$and", "$or"):
+                # 空のfilterは全件に一致する。空のリストは$andでは真、$orでは偽として扱う
+                sub_conditions: list[str] = []
+                for sub_filter in value:
+                    sql, sub_params = self._create_filter_sql(sub_filter)
+                    sub_conditions.append(f"({sql or '1'})")
+                    params.extend(sub_params)
+                if len(sub_conditions) == 0:
+                    sub_conditions = ["1" if key == "$and" else "0"]
+                conditions.append("(" + (" AND " if key == "$and" else " OR ").join(sub_conditions) + ")")
+                continue
+            if key.startswith("$") or not re.fullmatch(r"\w+", key):
+                raise UnsupportedKeywordFilterError(f"Unsupported filter key for keyword search: {key}")
+            if not isinstance(value, dict):
+                value = {"$eq": value}
+            for operator, operand in value.items():
+                conditions.append(self._create_condition_sql(self._get_column_expression(key), operator, operand, params))
+        return " AND ".join(conditions), params
+
+    def _create_condition_sql(self, column: str, operator: str, operand: Any, params: list[Any]) -> str:
+        if operator == "$eq":
+            params.append(operand)
+            return f"{column} = ?"
+        if operator == "$ne":
+            params.append(operand)
+            return f"{column} <> ?"
+        if operator in ("$in", "$nin") and isinstance(operand, (list, tuple)):
+            if len(operand) == 0:
+                # 空のリストは$inでは偽、$ninでは値が存在する場合に真とする
+                return "0" if operator == "$in" else f"{column} IS NOT NULL"
+            params.extend(operand)
+            return f"{column} {'IN' if operator == '$in' else 'NOT IN'} ({','.join('?' * len(operand))})"
+        if operator in self.filter_comparison_operators and isinstance(operand, (int, float, str)) and not isinstance(operand, bool):
+            params.append(operand)
+            return f"{column} {self.filter_comparison_operators[operator]} ?"
+        raise UnsupportedKeywordFilterError(f"Unsupported filter operator for keyword search: {operator} {operand!r}")
+
+    def _create_match_expression(self, query: str) -> Tuple[str, list[str]]:
+        # 空白で区切った語をOR検索する。trigramで検索できない短い語はLIKEで検索する
+        terms = [term for term in re.split(r"\s+", query.strip()) if term]
+        match_terms: list[str] = []
+        like_terms: list[str] = []
+        for term in terms:
+            if self.tokenizer == "trigram" and len(term) < self.trigram_min_length:
+                like_terms.append(term)
+            else:
+                match_terms.append('"' + term.replace('"', '""') + '"')
+        return " OR ".join(match_terms), like_terms
+
+    def search(self, query: str, k: int = 4, filter: Optional[dict[str, Any]] = None) -> list[Tuple[Document, float]]:
+        """
+        BM25でキーワード検索を行う。
+
+        Args:
+            query (str): 検索クエリ
+            k (int): 取得件数
+            filter (Optional[dict[str, Any]]): metadataのfilter
+
+        Returns:
+            list[Tuple[Document, float]]: ドキュメントとスコア(大きいほど関連度が高い)のリスト
+        """
+        filter_sql, filter_params = self._create_filter_sql(filter)
+        match_expression, like_terms = self._create_match_expression(query)
+        if not match_expression and not like_terms:
+            return []
+
+        if match_expression:
+            sql = '''
+                SELECT d.metadata_json, d.page_content, bm25(keyword_fts) AS rank
+                FROM keyword_fts JOIN keyword_documents d ON d.rowid = keyword_fts.rowid
+                WHERE keyword_fts MATCH ?
+            '''
+            params: list[Any] = [match_expression]
+        else:
+            # 短い語のみの場合は部分一致で検索する
+            sql = '''
+                SELECT d.metadata_json, d.page_content, 0.0 AS rank
+                FROM keyword_documents d WHERE (
+            ''' + " OR ".join(["d.page_content LIKE ?"] * len(like_terms)) + ")"
+            params = [f"%{term}%" for term in like_terms]
+        if filter_sql:
+            sql += f" AND {filter_sql}"
+            params.extend(filter_params)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(k)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        results: list[Tuple[Document, float]] = []
+        for metadata_json, page_content, rank in rows:
+            # bm25()は関連度が高いほど小さい値を返すため、符号を反転する
+            results.append((Document(page_content=page_content, metadata=json.loads(metadata_json)), -float(rank)))
+        return results
@@ -1,5 +1,7 @@
 
-import json, sys
+import json, sys, os
+import time
+import asyncio
 from typing import Any, Generator
 from langchain.docstore.document import Document
 
@@ -14,6 +16,12 @@ from ai_chat_lib.db_modules.vector_db_item import VectorDBItem
 from ai_chat_lib.db_modules.content_folder import ContentFolder
 from ai_chat_lib.langchain_modules.langchain_vector_db_chroma import LangChainVectorDBChroma
 from ai_chat_lib.langchain_modules.langchain_vector_db_pgvector import LangChainVectorDBPGVector
+from ai_chat_lib.langchain_modules.langchain_vector_db_numpy import LangChainVectorDBNumpy
+from ai_chat_lib.langchain_modules.langchain_embedding_cache import EmbeddingCacheStore
+from ai_chat_lib.langchain_modules.vector_search_executor import VectorSearchExecutor
+from ai_chat_lib.langchain_modules.vector_search_cache import VectorSearchCache
+from ai_chat_lib.langchain_modules.vector_write_queue import VectorWriteQueue
+from ai_chat_lib.langchain_modules.rank_fusion import RankFusion
 
 import ai_chat_lib.log_modules.log_settings as log_settings
 logger = log_settings.getLogger(__name__)
@@ -86,6 +94,67 @@ class LangChainUtil:
 
         return {}
 
+    @classmethod
+    async def delete_embeddings_by_folder_tree_api(cls, request_json: str) -> dict[str, Any]:
+        # フォルダとその子孫フォルダのインデックスをまとめて削除する
+        request_dict: dict = json.loads(request_json)
+        embedding_data = EmbeddingData.get_embedding_request_objects(request_dict)
+        openai_props = OpenAIProps.create_from_env()
+
+        vector_db_item = await VectorDBItem.get_vector_db_by_name(embedding_data.name)
+        if vector_db_item is None:
+            raise ValueError(f"VectorDBItem with name {embedding_data.name} not found.")
+        vector_db: LangChainVectorDB = LangChainUtil.get_vector_db(openai_props, vector_db_item, embedding_data.model)
+
+        folder = await ContentFolder.get_content_folder_by_path(embedding_data.folder_path)
+        if folder is None or not folder.id:
+            raise ValueError(f"Folder with path {embedding_data.folder_path} not found.")
+
+        def progress_callback(done: int, total: int, vectors: int):
+            logger.info(f"delete_embeddings_by_folder_tree: folders {done}/{total}, vectors {vectors}")
+
+        result = await vector_db.delete_folder_tree(folder.id, progress_callback)
+        return {"deleted": result}
+
+    metadata_patch_request_name = "metadata_patch"
+
+    @classmethod
+    async def patch_embeddings_metadata_api(cls, request_json: str) -> dict[str, Any]:
+        # source_idの全てのチャンクのmetadataを、Embeddingを作成せずに更新する
+        request_dict: dict = json.loads(request_json)
+        embedding_data = EmbeddingData.get_embedding_request_objects(request_dict)
+        patch: dict[str, Any] = request_dict.get(cls.metadata_patch_request_name, None) or {}
+        if not patch:
+            raise ValueError(f"{cls.metadata_patch_request_name} is not set.")
+        if "doc_id" in patch or "source_id" in patch:
+            raise ValueError("doc_id and source_id cannot be patched.")
+        openai_props = OpenAIProps.create_from_env()
+
+        vector_db_item = await VectorDBItem.get_vector_db_by_name(embedding_data.name)
+        if vector_db_item is None:
+            raise ValueError(f"VectorDBItem with name {embedding_data.name} not found.")
+        vector_db: LangChainVectorDB = LangChainUtil.get_vector_db(openai_props, vector_db_item, embedding_data.model)
+        updated = await vector_db.patch_metadata("source_id", embedding_data.source_id, patch)
+        return {"updated": updated}
+
+    @classmethod
+    async def update_folder_embeddings_metadata_api(cls, request_json: str) -> dict[str, Any]:
+        # フォルダの名前の変更・移動の後に、フォルダと子孫フォルダのチャンクのmetadataを更新する
+        request_dict: dict = json.loads(request_json)
+        embedding_data = EmbeddingData.get_embedding_request_objects(request_dict)
+        openai_props = OpenAIProps.create_from_env()
+
+        vector_db_item = await VectorDBItem.get_vector_db_by_name(embedding_data.name)
+        if vector_db_item is None:
+            raise ValueError(f"VectorDBItem with name {embedding_data.name} not found.")
+        vector_db: LangChainVectorDB = LangChainUtil.get_vector_db(openai_props, vector_db_item, embedding_data.model)
+
+        folder = await ContentFolder.get_content_folder_by_path(embedding_data.folder_path)
+        if folder is None or not folder.id:
+            raise ValueError(f"Folder with path {embedding_data.folder_path} not found.")
+        result = await vector_db.update_folder_metadata(folder.id)
+        return {"updated": result}
+
     @classmethod
     async def delete_embeddings_api(cls, request_json: str):
         # request_jsonからrequestを作成
@@ -99,7 +168,8 @@ class LangChainUtil:
         if vector_db_item is None:
             raise ValueError(f"VectorDBItem with name {embedding_data.name} not found.")
         vector_db: LangChainVectorDB = LangChainUtil.get_vector_db(openai_props, vector_db_item, embedding_data.model)
-        await vector_db.delete_document(embedding_data.source_id)
+        # 同じコレクションへの書き込みと直列に実行する
+        await VectorWriteQueue.get_queue(vector_db).enqueue_delete(vector_db, embedding_data.source_id)
 
         return {}
 
@@ -128,16 +198,160 @@ class LangChainUtil:
         
         # LangChainVectorDBを生成
         vector_db: LangChainVectorDB = LangChainUtil.get_vector_db(openai_props, vector_db_item, embedding_data.model)
-        await vector_db.update_embeddings(embedding_data)
+        # コレクション毎の書き込みキューで削除・登録を直列に実行し、完了を待つ
+        await VectorWriteQueue.get_queue(vector_db).enqueue_update(vector_db, embedding_data)
 
         return {}   
 
+    @classmethod
+    def get_embedding_cache_stats_api(cls) -> dict:
+        # Embeddingキャッシュの統計情報を取得
+        store = EmbeddingCacheStore.get_shared_store()
+        if store is None:
+            return {"embedding_cache": {}}
+        return {"embedding_cache": store.get_stats()}
+
+    @classmethod
+    def get_vector_search_stats_api(cls) -> dict:
+        # ベクトル検索の待ち行列の深さ・待ち時間などを取得
+        return {"vector_search_stats": VectorSearchExecutor.get_stats()}
+
+    @classmethod
+    def get_vector_search_cache_stats_api(cls) -> dict:
+        # 検索結果キャッシュのヒット率・エントリ数などを取得
+        return {"vector_search_cache": VectorSearchCache.get_stats()}
+
+    embedding_dimension_migration_request_name = "embedding_dimension_migration_request"
+
+    @classmethod
+    async def migrate_embedding_dimensions_api(cls, request_json: str) -> dict[str, Any]:
+        request_dict: dict = json.loads(request_json)
+        migration_request: dict = request_dict.get(cls.embedding_dimension_migration_request_name, None)
+        if not migration_request:
+            raise ValueError(f"{cls.embedding_dimension_migration_request_name} is not set.")
+        openai_props = OpenAIProps.create_from_env()
+        return await cls.migrate_embedding_dimensions(
+            openai_props,
+            name=migration_request.get("name", ""),
+            embedding_model=migration_request.get("model", "text-embedding-3-small"),
+            embedding_dimensions=int(migration_request.get("embedding_dimensions", 0)),
+            confirm=bool(migration_request.get("confirm", False)),
+        )
+
+    @classmethod
+    async def migrate_embedding_dimensions(
+            cls, openai_props: OpenAIProps, name: str, embedding_model: str, embedding_dimensions: int, confirm: bool = False
+            ) -> dict[str, Any]:
+        """
+        VectorDBItemのembedding_dimensionsを変更し、コレクションを再Embeddingする。
+        confirmがFalseの場合は対象件数と次元数のみを返し、何も変更しない。
+
+        Args:
+            openai_props (OpenAIProps): OpenAIの設定
+            name (str): VectorDBItemの名前
+            embedding_model (str): Embeddingのモデル
+            embedding_dimensions (int): 新しい次元数。0の場合はモデルの既定値
+            confirm (bool): Trueの場合のみ再Embeddingを実行する
+
+        Returns:
+            dict[str, Any]: 対象件数、変更前後の次元数、実行したかどうか
+        """
+        vector_db_item = await VectorDBItem.get_vector_db_by_name(name)
+        if vector_db_item is None:
+            raise ValueError(f"VectorDBItem with name {name} not found.")
+        vector_db = cls.get_vector_db(openai_props, vector_db_item, embedding_model)
+        # 前回の移行が置き換え中に失敗した場合は、このファイルから置き換えをやり直す
+        checkpoint_path = ""
+        app_data_path = os.getenv("APP_DATA_PATH", None)
+        if app_data_path:
+            checkpoint_path = os.path.join(app_data_path, "server", "migration", f"{vector_db_item.id}_embeddings.jsonl")
+        current_dimension = await asyncio.to_thread(vector_db.get_collection_dimension)
+        if not confirm:
+            ids, _ = await asyncio.to_thread(vector_db.get_all_documents)
+            return {
+                "name": name, "documents": len(ids), "old_dimension": current_dimension,
+                "new_dimension": embedding_dimensions, "migrated": False,
+                "resumable": bool(checkpoint_path) and os.path.exists(checkpoint_path),
+            }
+
+        new_client = LangChainOpenAIClient(
+            props=openai_props, embedding_model=embedding_model, embedding_dimensions=embedding_dimensions)
+
+        async def migrate() -> dict[str, Any]:
+            result = await vector_db.migrate_embedding_dimensions(new_client, checkpoint_path=checkpoint_path)
+            # 再Embeddingに成功した場合のみ設定を更新する
+            vector_db_item.embedding_dimensions = embedding_dimensions
+            await VectorDBItem.update_vector_db_item(vector_db_item)
+            return result
+
+        # 同じコレクションへの登録・削除と重ならないよう、書き込みキューで単独で実行する
+        result = await VectorWriteQueue.get_queue(vector_db).enqueue_operation(vector_db, migrate)
+        result.update({"name": name, "migrated": True})
+        return result
+
+    vector_index_request_name = "vector_index_request"
+    # 実行中のインデックス作成タスク(ガベージコレクションされないように保持する)
+    vector_index_tasks: set[asyncio.Task] = set()
+
+    @classmethod
+    async def _get_pgvector_db_for_index(cls, request_json: str) -> tuple[LangChainVectorDBPGVector, dict]:
+        request_dict: dict = json.loads(request_json)
+        index_request: dict = request_dict.get(cls.vector_index_request_name, None)
+        if not index_request:
+            raise ValueError(f"{cls.vector_index_request_name} is not set.")
+        name = index_request.get("name", "")
+        vector_db_item = await VectorDBItem.get_vector_db_by_name(name)
+        if vector_db_item is None:
+            raise ValueError(f"VectorDBItem with name {name} not found.")
+        openai_props = OpenAIProps.create_from_env()
+        vector_db = cls.get_vector_db(openai_props, vector_db_item, index_request.get("model", "text-embedding-3-small"))
+        if not isinstance(vector_db, LangChainVectorDBPGVector):
+            raise ValueError(f"ANN index management is only supported by PGVector. name:{name}")
+        return vector_db, index_request
+
+    @classmethod
+    async def create_vector_index_api(cls, request_json: str) -> dict[str, Any]:
+        # インデックスの作成は時間がかかるため、バックグラウンドで実行する。進捗はget_vector_index_status_apiで取得する
+        vector_db, index_request = await cls._get_pgvector_db_for_index(request_json)
+        method = index_request.get("method", "hnsw")
+        task = asyncio.create_task(asyncio.to_thread(
+            vector_db.create_ann_index,
+            method=method,
+            m=int(index_request.get("m", 16)),
+            ef_construction=int(index_request.get("ef_construction", 64)),
+            lists=int(index_request.get("lists", 0)),
+        ))
+        cls.vector_index_tasks.add(task)
+
+        def on_done(task: asyncio.Task):
+            cls.vector_index_tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(f"ANN index creation failed: {task.exception()}")
+        task.add_done_callback(on_done)
+        return {"index_name": vector_db.get_ann_index_name(method), "started": True}
+
+    @classmethod
+    async def get_vector_index_status_api(cls, request_json: str) -> dict[str, Any]:
+        vector_db, _ = await cls._get_pgvector_db_for_index(request_json)
+        indexes, progress = await asyncio.gather(
+            asyncio.to_thread(vector_db.get_ann_indexes),
+            asyncio.to_thread(vector_db.get_ann_index_build_progress),
+        )
+        return {"indexes": indexes, "build_progress": progress}
+
+    @classmethod
+    async def drop_vector_index_api(cls, request_json: str) -> dict[str, Any]:
+        vector_db, index_request = await cls._get_pgvector_db_for_index(request_json)
+        await asyncio.to_thread(vector_db.drop_ann_index, index_request.get("method", "hnsw"))
+        return {}
+
     chat_request_name = "chat_request"
 
     @classmethod
     def get_vector_db(cls, openai_props: OpenAIProps, vector_db_props: VectorDBItem, embedding_model: str) -> LangChainVectorDB:
 
-        langchain_openai_client = LangChainOpenAIClient(props=openai_props, embedding_model=embedding_model)
+        langchain_openai_client = LangChainOpenAIClient(
+            props=openai_props, embedding_model=embedding_model, embedding_dimensions=vector_db_props.embedding_dimensions)
 
         vector_db_url = vector_db_props.vector_db_url
         if vector_db_props.is_use_multi_vector_retriever:
@@ -146,6 +360,9 @@ class LangChainUtil:
             doc_store_url = ""
         collection_name = vector_db_props.collection_name
         chunk_size = vector_db_props.chunk_size
+        # 保存精度の設定はNumPyのベクトルDBのみ対応
+        if vector_db_props.vector_precision != "float32" and vector_db_props.vector_db_type != 3:
+            logger.warning(f"vector_precision:{vector_db_props.vector_precision} is only supported by NumPy vector db. Using float32.")
 
         # ベクトルDBのタイプがChromaの場合
         if vector_db_props.vector_db_type == 1:
@@ -164,6 +381,16 @@ class LangChainUtil:
                 collection_name = collection_name,
                 doc_store_url= doc_store_url, 
                 chunk_size = chunk_size)
+
+        # ベクトルDBのタイプがNumPyの場合
+        elif vector_db_props.vector_db_type == 3:
+            return LangChainVectorDBNumpy(
+                langchain_openai_client = langchain_openai_client,
+                vector_db_url = vector_db_url,
+                collection_name = collection_name,
+                doc_store_url= doc_store_url, 
+                chunk_size = chunk_size,
+                vector_precision = vector_db_props.vector_precision)
                 
         else:
             # それ以外の場合は例外
@@ -176,39 +403,123 @@ class LangChainUtil:
         if not openai_props:
             raise ValueError("openai_props is None")
 
+        # vector_db_propsの要素毎にRetrieverを作成して、並行して検索を行う。結果はリクエストの順に連結する
+        results = await asyncio.gather(*[cls._vector_search(openai_props, request) for request in vector_search_requests])
         result_documents = []
-
-        # vector_db_propsの要素毎にRetrieverを作成して、検索を行う
-        for request in vector_search_requests:
-            # debug request.nameが設定されているか確認
-            if not request.name:
-                raise ValueError("request.name is not set")
-            if not request.query:
-                raise ValueError("request.query is not set")
-
-            # vector_db_itemを取得
-            vector_db_item = await VectorDBItem.get_vector_db_by_name(request.name)
-            if vector_db_item is None:
-                logger.error(f"VectorDBItem with name {request.name} not found.")
-                raise ValueError(f"vector_db_item is None. name:{request.name}")
-
-            langchain_db = LangChainUtil.get_vector_db(openai_props, vector_db_item, request.model)
-
-            # デバッグ出力
-            logger.info('ベクトルDBの設定')
-            logger.info(f'''
-                        name:{vector_db_item.name} vector_db_description:{vector_db_item.description} 
-                        VectorDBTypeString:{vector_db_item.get_vector_db_type_string()} VectorDBURL:{vector_db_item.vector_db_url} 
-                        CollectionName:{vector_db_item.collection_name}'
-                        ChunkSize:{vector_db_item.chunk_size} IsUseMultiVectorRetriever:{vector_db_item.is_use_multi_vector_retriever}
-                        ''')
-
-
-            logger.info(f'Query: {request.query}')
-            logger.info(f'SearchKwargs:{request.search_kwargs}')
-            documents =  await langchain_db.vector_search(request.query, request.search_kwargs)
+        for documents in results:
             result_documents.extend(documents)
 
-
         return result_documents
-    
+
+    @classmethod
+    async def _vector_search(cls, openai_props: OpenAIProps, request: VectorSearchRequest) -> list[Document]:
+        # debug request.nameが設定されているか確認
+        if not request.name:
+            raise ValueError("request.name is not set")
+        if not request.query:
+            raise ValueError("request.query is not set")
+
+        # vector_db_itemを取得
+        vector_db_item = await VectorDBItem.get_vector_db_by_name(request.name)
+        if vector_db_item is None:
+            logger.error(f"VectorDBItem with name {request.name} not found.")
+            raise ValueError(f"vector_db_item is None. name:{request.name}")
+
+        langchain_db = LangChainUtil.get_vector_db(openai_props, vector_db_item, request.model)
+
+        # デバッグ出力
+        logger.info('ベクトルDBの設定')
+        logger.info(f'''
+                    name:{vector_db_item.name} vector_db_description:{vector_db_item.description} 
+                    VectorDBTypeString:{vector_db_item.get_vector_db_type_string()} VectorDBURL:{vector_db_item.vector_db_url} 
+                    CollectionName:{vector_db_item.collection_name}'
+                    ChunkSize:{vector_db_item.chunk_size} IsUseMultiVectorRetriever:{vector_db_item.is_use_multi_vector_retriever}
+                    ''')
+
+
+        logger.info(f'Query: {request.query}')
+        logger.info(f'SearchKwargs:{request.search_kwargs}')
+        if not VectorSearchCache.is_enabled():
+            return await langchain_db.vector_search(request.query, request.search_kwargs)
+
+        # 書き込み世代を含むキーで検索結果のキャッシュを参照する
+        collection_key = langchain_db.get_collection_key()
+        generations = await VectorSearchCache.get_generations(collection_key)
+        cache_key = VectorSearchCache.create_key(collection_key, generations, request.model, request.query, request.search_kwargs)
+        cached_documents = VectorSearchCache.get(cache_key)
+        if cached_documents is not None:
+            logger.info(f"vector search cache hit. collection:{collection_key}")
+            return cached_documents
+        documents = await langchain_db.vector_search(request.query, request.search_kwargs)
+        VectorSearchCache.put(cache_key, documents)
+        return documents
+
+    @classmethod
+    async def federated_vector_search_api(cls, request_json: str) -> dict[str, Any]:
+        # request_jsonからrequestを作成
+        request_dict: dict = json.loads(request_json)
+
+        vector_search_requests: list[VectorSearchRequest] = await VectorSearchRequest.get_vector_search_requests_objects(request_dict)
+        # 統合方法の設定を取得 {"federated_search_request": {"top_k": 10, "fusion_method": "rrf", "rrf_k": 60}}
+        federated_search_request: dict = request_dict.get(cls.federated_search_request_name, {})
+        openai_props = OpenAIProps.create_from_env()
+        result = await cls.federated_vector_search(
+            openai_props, vector_search_requests,
+            top_k=federated_search_request.get("top_k", 0),
+            fusion_method=federated_search_request.get("fusion_method", RankFusion.fusion_method_rrf),
+            rrf_k=federated_search_request.get("rrf_k", RankFusion.default_rrf_k),
+        )
+        result["documents"] = [doc.model_dump() for doc in result["documents"]]
+        return result
+
+    federated_search_request_name = "federated_search_request"
+
+    @classmethod
+    async def federated_vector_search(
+            cls, openai_props: OpenAIProps, vector_search_requests: list[VectorSearchRequest],
+            top_k: int = 0, fusion_method: str = RankFusion.fusion_method_rrf, rrf_k: int = RankFusion.default_rrf_k
+            ) -> dict[str, Any]:
+        """
+        複数のコレクションを並行して検索し、結果をランク統合して返す。
+
+        Args:
+            openai_props (OpenAIProps): OpenAIの設定
+            vector_search_requests (list[VectorSearchRequest]): コレクション毎の検索リクエスト
+            top_k (int): 統合後に返す件数。0以下の場合は各リクエストのkの最大値
+            fusion_method (str): "rrf"(Reciprocal Rank Fusion) または "score"(スコア正規化)
+            rrf_k (int): RRFの定数k
+
+        Returns:
+            dict[str, Any]: {"documents": 統合後のドキュメント, "sources": リクエスト毎の件数と処理時間, "elapsed_ms": 全体の処理時間}
+        """
+        if not openai_props:
+            raise ValueError("openai_props is None")
+
+        async def search_with_timing(request: VectorSearchRequest) -> tuple[list[Document], dict[str, Any]]:
+            start = time.perf_counter()
+            source: dict[str, Any] = {"name": request.name}
+            try:
+                documents = await cls._vector_search(openai_props, request)
+            except Exception as e:
+                # 一部のコレクションでエラーが発生しても他の結果は返す
+                logger.error(f"vector search failed. name:{request.name} error:{e}")
+                documents = []
+                source["error"] = str(e)
+            for doc in documents:
+                doc.metadata["source_name"] = request.name
+            source["count"] = len(documents)
+            source["elapsed_ms"] = (time.perf_counter() - start) * 1000
+            return documents, source
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*[search_with_timing(request) for request in vector_search_requests])
+
+        if top_k <= 0:
+            top_k = max([request.search_kwargs.get("k", 4) for request in vector_search_requests], default=4)
+        documents = RankFusion.fuse([documents for documents, _ in results], method=fusion_method, top_k=top_k, rrf_k=rrf_k)
+
+        return {
+            "documents": documents,
+            "sources": [source for _, source in results],
+            "elapsed_ms": (time.perf_counter() - start) * 1000,
+        }
@@ -1,6 +1,11 @@
 
+import os
 import uuid
-from typing import Tuple, List, Any, Union, Optional
+import copy
+import hashlib
+import re
+import json
+from typing import Tuple, List, Any, Union, Optional, ClassVar, Callable
 from collections import defaultdict
 import asyncio
 from pydantic import BaseModel, Field, ConfigDict
@@ -8,7 +13,6 @@ from pydantic import BaseModel, Field, ConfigDict
 from langchain_core.documents import Document
 from langchain_core.vectorstores import VectorStore
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.runnables import chain
 from langchain_core.callbacks import (
     CallbackManagerForRetrieverRun,
@@ -19,6 +23,13 @@ from ai_chat_lib.langchain_modules.langchain_client import LangChainOpenAIClient
 from ai_chat_lib.langchain_modules.langchain_doc_store import SQLDocStore
 
 from ai_chat_lib.langchain_modules.embedding_data import EmbeddingData
+from ai_chat_lib.langchain_modules.vector_search_executor import VectorSearchExecutor
+from ai_chat_lib.langchain_modules.langchain_keyword_index import KeywordIndex, UnsupportedKeywordFilterError
+from ai_chat_lib.langchain_modules.vector_search_request import VectorSearchRequest
+from ai_chat_lib.langchain_modules.rank_fusion import RankFusion
+from ai_chat_lib.langchain_modules.vector_mmr import VectorMMR
+from ai_chat_lib.langchain_modules.text_chunker import TextChunker
+from ai_chat_lib.langchain_modules.vector_search_cache import VectorSearchCache
 from ai_chat_lib.db_modules.content_folder import ContentFolder
 
 import ai_chat_lib.log_modules.log_settings as log_settings
@@ -33,15 +44,31 @@ class LangChainVectorDB(BaseModel):
     vector_db_url: str = Field(..., description="Vector DBのURL")
     collection_name: str = Field(default="", description="コレクション名")
     doc_store_url: str = Field(default="", description="MultiVectorRetrieverを利用する場合のDocStoreのURL")
-    chunk_size: int = Field(default=1000, description="テキストを分割するチャンクサイズ")
+    chunk_size: int = Field(default=1000, description="テキストを分割するチャンクサイズ(トークン数, MultiVectorRetrieverを利用する場合はEmbeddingを作成する子チャンクのサイズ)")
     use_multi_vector_retriever: bool = Field(default=False, description="MultiVectorRetrieverを利用するかどうか")
-    parent_chunk_size: int = Field(default=4000, description="親データのチャンクサイズ(MultiVectorRetrieverを利用する場合)")
+    parent_chunk_size: int = Field(default=4000, description="親データのチャンクサイズ(トークン数, MultiVectorRetrieverを利用する場合)")
 
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
     db : Union[VectorStore, None] = Field(default=None, description="VectorStoreのインスタンス")
     doc_store: Union[SQLDocStore, None] = Field(default=None, description="SQLDocStoreのインスタンス")
 
+    # search_kwargsで指定するANNインデックスの検索時のパラメータ(対応するベクトルDBのみ利用する)
+    ef_search_key: ClassVar[str] = "ef_search"
+    probes_key: ClassVar[str] = "probes"
+    # フォルダ単位の削除で、1回の検索・削除の対象とするフォルダ数
+    delete_folder_batch_size: ClassVar[int] = 200
+    # metadataの更新で、1回に更新するベクトル数
+    metadata_patch_batch_size: ClassVar[int] = 500
+    # 登録したテキストのハッシュ値を保持するmetadataのキー(内容が変わらない更新ではEmbeddingを作成しない)
+    content_hash_key: ClassVar[str] = "content_hash"
+    # 1回のベクトルDBへの登録(Embeddingの作成)でまとめるチャンク数
+    add_batch_size: ClassVar[int] = 64
+    # 親ドキュメントを返す検索で、kの何倍の子チャンクを検索するか
+    parent_search_fetch_factor: ClassVar[int] = 4
+    # 子チャンクの最大サイズを親チャンクの何分の1にするか(chunk_sizeが親チャンク以上の場合も、親を複数の子に分割する)
+    parent_child_chunk_ratio: ClassVar[int] = 4
+
 
     # document_idのリストとmetadataのリストを返す
     def _get_document_ids_by_tag(self, name: str = "", value: str = "") -> Tuple[List[str], List[dict[str, Any]]]:
@@ -58,6 +85,360 @@ class LangChainVectorDB(BaseModel):
 
         return len(doc_ids)    
 
+    def _get_document_ids_by_folder_ids(self, folder_ids: List[str]) -> Tuple[List[str], List[dict[str, Any]]]:
+        # 複数のフォルダに属するdocument_idとmetadataを返す。$inで検索できるベクトルDBはオーバーライドする
+        document_ids: List[str] = []
+        metadata_list: List[dict[str, Any]] = []
+        for folder_id in folder_ids:
+            ids, metadatas = self._get_document_ids_by_tag("folder_id", folder_id)
+            document_ids.extend(ids)
+            metadata_list.extend(metadatas)
+        return document_ids, metadata_list
+
+    @classmethod
+    def get_doc_store_keys(cls, metadata_list: List[dict[str, Any]]) -> List[str]:
+        # DocStoreのkeyはベクトルのmetadataのdoc_id
+        return list(dict.fromkeys(metadata["doc_id"] for metadata in metadata_list if metadata and metadata.get("doc_id")))
+
+    async def _delete_folders(self, folder_ids: List[str], progress_callback: Optional[Callable[[int, int, int], None]] = None) -> dict[str, int]:
+        """
+        フォルダに属するベクトルとDocStoreのデータを、delete_folder_batch_size個のフォルダ毎にまとめて削除する。
+        progress_callbackには(処理済みのフォルダ数, フォルダ数, 削除したベクトル数)を渡す。
+        """
+        if self.db is None:
+            raise ValueError("db is None")
+        doc_store: Optional[SQLDocStore] = self.doc_store if self.doc_store_url else None
+        vectors = 0
+        documents = 0
+        for i in range(0, len(folder_ids), self.delete_folder_batch_size):
+            batch = folder_ids[i:i + self.delete_folder_batch_size]
+            vector_ids, metadata_list = await asyncio.to_thread(self._get_document_ids_by_folder_ids, batch)
+            if doc_store is not None:
+                doc_store_keys = self.get_doc_store_keys(metadata_list)
+                await doc_store.amdelete(doc_store_keys)
+                documents += len(doc_store_keys)
+            await self._delete(vector_ids)
+            vectors += len(vector_ids)
+            if progress_callback is not None:
+                progress_callback(i + len(batch), len(folder_ids), vectors)
+        return {"folders": len(folder_ids), "vectors": vectors, "documents": documents}
+
+    def _update_metadatas(self, ids: List[str], metadatas: List[dict[str, Any]], removed_keys: Optional[List[List[str]]] = None):
+        # Embeddingを変更せずにmetadataを置き換える(サブクラスで実装する)
+        # removed_keysは行毎の削除したキー。既存のmetadataにマージして更新するベクトルストアで、キーの削除に利用する
+        raise NotImplementedError("Not implemented")
+
+    async def _apply_metadata_patches(self, ids: List[str], metadata_list: List[dict[str, Any]], patches: List[dict[str, Any]], remove_key_prefix: str = "") -> int:
+        """
+        ベクトル、キーワードインデックス、DocStoreの親ドキュメントのmetadataに、patchesをmetadata_patch_batch_size件ずつ適用する。
+        remove_key_prefixが指定されている場合は、そのキーで始まる既存の値を削除してから適用する。
+        """
+        def apply(metadata: dict[str, Any], patch: dict[str, Any]) -> dict[str, Any]:
+            new_metadata = {key: value for key, value in metadata.items() if not (remove_key_prefix and key.startswith(remove_key_prefix))}
+            new_metadata.update(patch)
+            return new_metadata
+
+        def get_removed_keys(metadata: dict[str, Any], new_metadata: dict[str, Any]) -> List[str]:
+            return [key for key in metadata if key not in new_metadata]
+
+        keyword_index = self.get_keyword_index()
+        patches_by_doc_id: dict[str, dict[str, Any]] = {}
+        for i in range(0, len(ids), self.metadata_patch_batch_size):
+            batch_ids = ids[i:i + self.metadata_patch_batch_size]
+            old_metadatas = [metadata or {} for metadata in metadata_list[i:i + self.metadata_patch_batch_size]]
+            batch_metadatas = [
+                apply(metadata, patch) for metadata, patch in zip(old_metadatas, patches[i:i + self.metadata_patch_batch_size])
+            ]
+            removed_keys = [get_removed_keys(metadata, new_metadata) for metadata, new_metadata in zip(old_metadatas, batch_metadatas)]
+            await asyncio.to_thread(self._update_metadatas, batch_ids, batch_metadatas, removed_keys)
+            if keyword_index is not None:
+                await asyncio.to_thread(keyword_index.update_metadatas, batch_ids, batch_metadatas)
+            for metadata, patch in zip(batch_metadatas, patches[i:i + self.metadata_patch_batch_size]):
+                if metadata.get("doc_id"):
+                    patches_by_doc_id[metadata["doc_id"]] = patch
+
+        if self.doc_store_url and self.doc_store is not None and len(patches_by_doc_id) > 0:
+            # 親ドキュメントのmetadataも同じ値に更新する
+            doc_ids = list(patches_by_doc_id.keys())
+            parents = await self.doc_store.amget(doc_ids)
+            pairs = [
+                (doc_id, Document(page_content=parent.page_content, metadata=apply(parent.metadata, patches_by_doc_id[doc_id])))
+                for doc_id, parent in zip(doc_ids, parents) if parent is not None
+            ]
+            await self.doc_store.amset(pairs)
+        return len(ids)
+
+    @classmethod
+    def create_content_hash(cls, page_content: str) -> str:
+        return hashlib.sha256(page_content.encode("utf-8")).hexdigest()
+
+    def _supports_native_async_search(self) -> bool:
+        # ベクトルストアがネイティブの非同期検索APIを持つ場合はTrueを返す(サブクラスでオーバーライド)
+        return False
+
+    def get_collection_key(self) -> str:
+        return VectorSearchExecutor.create_collection_key(self.vector_db_url, self.collection_name)
+
+    async def _similarity_search_with_relevance_scores(self, query: str, search_kwargs: dict) -> List[Tuple[Document, float]]:
+        if self.db is None:
+            raise ValueError("db is None")
+        search_kwargs = {key: value for key, value in search_kwargs.items() if key not in (self.ef_search_key, self.probes_key)}
+        db = self.db
+        collection_key = self.get_collection_key()
+        if self._supports_native_async_search():
+            return await VectorSearchExecutor.run_coroutine(
+                collection_key, lambda: db.asimilarity_search_with_relevance_scores(query, **search_kwargs)
+            )
+        # 同期APIはEmbeddingのHTTPリクエストとインデックス検索を含むため、専用スレッドプールで実行する
+        return await VectorSearchExecutor.run_in_executor(
+            collection_key, db.similarity_search_with_relevance_scores, query, **search_kwargs
+        )
+
+    # クエリのEmbeddingで検索し、(Document, 関連度, 候補のEmbedding)のリストを返す(サブクラスで実装)
+    def _similarity_search_with_embeddings(self, query_embedding: List[float], k: int, filter: Optional[dict] = None) -> List[Tuple[Document, float, List[float]]]:
+        raise NotImplementedError("Not implemented")
+
+    async def _mmr_search(self, query: str, search_kwargs: dict, mmr_params: dict[str, Any]) -> List[Tuple[Document, float]]:
+        # k * N件の候補をEmbedding付きで取得し、MMRで多様な上位k件を選択する
+        query_embedding = await self.langchain_openai_client.get_embedding_client().aembed_query(query)
+        candidates = await VectorSearchExecutor.run_in_executor(
+            self.get_collection_key(), self._similarity_search_with_embeddings,
+            query_embedding, mmr_params["fetch_k"], search_kwargs.get("filter", None)
+        )
+        score_threshold = search_kwargs.get("score_threshold", None)
+        if score_threshold is not None:
+            candidates = [candidate for candidate in candidates if candidate[1] >= score_threshold]
+        selected = VectorMMR.select(
+            query_embedding, [embedding for _, _, embedding in candidates], mmr_params["k"], mmr_params["lambda_mult"]
+        )
+        return [(candidates[i][0], candidates[i][1]) for i in selected]
+
+    async def _vector_search_with_optional_mmr(self, query: str, search_kwargs: dict, mmr_params: Optional[dict[str, Any]]) -> List[Tuple[Document, float]]:
+        if mmr_params is not None:
+            try:
+                return await self._mmr_search(query, search_kwargs, mmr_params)
+            except NotImplementedError:
+                logger.warning(f"MMR is not supported by {self.__class__.__name__}. Using similarity search.")
+        return await self._similarity_search_with_relevance_scores(query, search_kwargs)
+
+    def get_keyword_index(self) -> Optional[KeywordIndex]:
+        return KeywordIndex.get_index(self.vector_db_url, self.collection_name)
+
+    async def _keyword_search(self, query: str, search_kwargs: dict) -> List[Tuple[Document, float]]:
+        keyword_index = self.get_keyword_index()
+        if keyword_index is None:
+            return []
+        try:
+            return await VectorSearchExecutor.run_in_executor(
+                self.get_collection_key(), keyword_index.search, query,
+                k=search_kwargs.get("k", 4), filter=search_kwargs.get("filter", None)
+            )
+        except UnsupportedKeywordFilterError as e:
+            # キーワード検索で評価できないfilterの場合は、ベクトル検索の結果のみを返す
+            logger.warning(f"{e}. Skipping keyword search.")
+            return []
+
+    @classmethod
+    def is_identifier_like_query(cls, query: str) -> bool:
+        # 空白を含まず、数字・記号を含む英数字の文字列(エラーコード、識別子など)を識別子とみなす
+        query = query.strip()
+        if len(query) == 0 or len(query) > 64:
+            return False
+        if not re.fullmatch(r"[A-Za-z0-9_\-\.:/#@]+", query):
+            return False
+        return bool(re.search(r"[0-9_\-\.:/#@]", query)) or (query.isupper() and len(query) > 1)
+
+    async def _search_documents(self, query: str, search_kwargs: dict) -> List[Tuple[Document, float]]:
+        # search_kwargsのsearch_modeに応じて、ベクトル検索・キーワード検索・ハイブリッド検索を行う
+        search_kwargs = dict(search_kwargs)
+        search_mode = search_kwargs.pop(VectorSearchRequest.search_mode_key, VectorSearchRequest.search_mode_vector)
+        # MMRの設定はベクトル検索の結果に適用する
+        mmr_params = VectorMMR.pop_mmr_params(search_kwargs)
+        if search_mode == VectorSearchRequest.search_mode_auto:
+            if self.is_identifier_like_query(query):
+                search_mode = VectorSearchRequest.search_mode_keyword
+            else:
+                search_mode = VectorSearchRequest.search_mode_hybrid
+
+        if search_mode == VectorSearchRequest.search_mode_vector:
+            return await self._vector_search_with_optional_mmr(query, search_kwargs, mmr_params)
+
+        if search_mode == VectorSearchRequest.search_mode_keyword:
+            # Embeddingを作成せずにキーワード検索のみ行う。ヒットしない場合はベクトル検索を行う
+            keyword_results = await self._keyword_search(query, search_kwargs)
+            if len(keyword_results) > 0:
+                return keyword_results
+            logger.info("keyword search returned no results. falling back to vector search.")
+            return await self._vector_search_with_optional_mmr(query, search_kwargs, mmr_params)
+
+        if search_mode == VectorSearchRequest.search_mode_hybrid:
+            vector_results, keyword_results = await asyncio.gather(
+                self._vector_search_with_optional_mmr(query, search_kwargs, mmr_params),
+                self._keyword_search(query, search_kwargs),
+            )
+            # 尺度の異なる元のスコアはvector_score / keyword_scoreに残し、RRFのスコアを検索結果のスコアとする
+            raw_scores: dict[str, dict[str, float]] = {}
+            for score_key, results in (("vector_score", vector_results), ("keyword_score", keyword_results)):
+                for doc, score in results:
+                    raw_scores.setdefault(RankFusion.get_document_key(doc), {})[score_key] = score
+            ranked_lists = [[doc for doc, _ in vector_results], [doc for doc, _ in keyword_results]]
+            fused_docs = RankFusion.reciprocal_rank_fusion(ranked_lists, top_k=search_kwargs.get("k", 4))
+            for doc in fused_docs:
+                doc.metadata.update(raw_scores.get(RankFusion.get_document_key(doc), {}))
+                doc.metadata["score"] = doc.metadata["fusion_score"]
+            return [(doc, doc.metadata["fusion_score"]) for doc in fused_docs]
+
+        raise ValueError(f"Invalid search_mode: {search_mode}")
+
+    # コレクションに保存されているEmbeddingの次元数を返す。空の場合は0
+    def get_collection_dimension(self) -> int:
+        raise NotImplementedError("Not implemented")
+
+    # コレクションの全てのドキュメントのidとDocumentのリストを返す
+    def get_all_documents(self) -> Tuple[List[str], List[Document]]:
+        raise NotImplementedError("Not implemented")
+
+    # 作成済みのEmbeddingをコレクションに追加する
+    def _add_embeddings(self, ids: List[str], documents: List[Document], embeddings: List[List[float]]):
+        raise NotImplementedError("Not implemented")
+
+    def validate_embedding_dimensions(self):
+        """
+        embedding_dimensionsの設定とコレクションの次元数が一致しない場合は例外を発生させる。
+        """
+        expected = self.langchain_openai_client.embedding_dimensions
+        if expected <= 0:
+            return
+        current = self.get_collection_dimension()
+        if current > 0 and current != expected:
+            raise ValueError(
+                f"Embedding dimension mismatch. collection:{self.collection_name} dimension:{current} embedding_dimensions:{expected}. "
+                "Run the embedding dimension migration before adding documents."
+            )
+
+    async def migrate_embedding_dimensions(self, new_client: LangChainOpenAIClient, batch_size: int = 100, checkpoint_path: str = "") -> dict[str, Any]:
+        """
+        コレクションの全てのドキュメントを新しい次元数で再Embeddingして置き換える。
+        全てのEmbeddingの作成に成功するまで既存のコレクションは変更しない。
+        置き換え(コレクションの削除と再登録)はアトミックではないため、checkpoint_pathを指定した場合は、
+        削除の前に作成済みのEmbeddingを書き出し、置き換え中に失敗した場合は次回の実行時にcheckpointから置き換えをやり直す。
+        checkpoint_pathを指定しない場合、置き換え中に失敗したコレクションは復旧できない。
+        同じコレクションへの書き込みと並行して実行しないこと(LangChainUtilはVectorWriteQueueで直列に実行する)。
+
+        Args:
+            new_client (LangChainOpenAIClient): 新しい次元数を設定したクライアント
+            batch_size (int): 1回のEmbedding APIで処理する件数
+            checkpoint_path (str): 置き換え前に作成済みのEmbeddingを書き出すファイル。空の場合は書き出さない
+
+        Returns:
+            dict[str, Any]: 件数、変更前後の次元数、checkpointから再開したかどうか
+        """
+        checkpoint = None
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            checkpoint = await asyncio.to_thread(self._read_migration_checkpoint, checkpoint_path, new_client.get_embedding_model_key())
+
+        if checkpoint is not None:
+            # 前回の置き換えが途中で失敗した場合は、コレクションではなくcheckpointのドキュメントとEmbeddingを使う
+            old_dimension, ids, documents, embeddings = checkpoint
+            new_dimension = len(embeddings[0]) if len(embeddings) > 0 else new_client.embedding_dimensions
+            logger.info(f"embedding dimension migration resumed from checkpoint. collection:{self.collection_name} documents:{len(ids)}")
+        else:
+            old_dimension = await asyncio.to_thread(self.get_collection_dimension)
+            ids, documents = await asyncio.to_thread(self.get_all_documents)
+            logger.info(f"embedding dimension migration started. collection:{self.collection_name} documents:{len(ids)}")
+
+            # 1. 全てのドキュメントのEmbeddingを作成する
+            embedding_client = new_client.get_embedding_client()
+            embeddings = []
+            for i in range(0, len(documents), batch_size):
+                texts = [doc.page_content for doc in documents[i:i + batch_size]]
+                embeddings.extend(await self._embed_documents_with_retry(embedding_client, texts))
+            new_dimension = len(embeddings[0]) if len(embeddings) > 0 else new_client.embedding_dimensions
+            if new_client.embedding_dimensions > 0 and new_dimension != new_client.embedding_dimensions:
+                raise ValueError(f"Embedding API returned {new_dimension} dimensions. expected:{new_client.embedding_dimensions}")
+
+            # 2. 置き換え中に失敗した場合に再開できるよう、作成済みのEmbeddingを書き出す
+            if checkpoint_path:
+                await asyncio.to_thread(
+                    self._write_migration_checkpoint, checkpoint_path, new_client.get_embedding_model_key(), old_dimension,
+                    ids, documents, embeddings
+                )
+
+        # 3. コレクションを作り直して、作成済みのEmbeddingを登録する(再開時は途中まで登録されたコレクションも作り直す)
+        try:
+            self._delete_collection()
+            self.langchain_openai_client = new_client
+            self.db = self._load()
+            for i in range(0, len(ids), batch_size):
+                await asyncio.to_thread(
+                    self._add_embeddings, ids[i:i + batch_size], documents[i:i + batch_size], embeddings[i:i + batch_size]
+                )
+        finally:
+            # 検索結果のキャッシュを無効化する
+            await VectorSearchCache.invalidate(self.get_collection_key())
+
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        logger.info(f"embedding dimension migration finished. collection:{self.collection_name} {old_dimension} -> {new_dimension}")
+        return {"documents": len(ids), "old_dimension": old_dimension, "new_dimension": new_dimension, "resumed": checkpoint is not None}
+
+    async def _embed_documents_with_retry(self, embedding_client: Any, texts: List[str], max_retries: int = 5, delay: float = 1.0) -> List[List[float]]:
+        for attempt in range(max_retries):
+            try:
+                return await embedding_client.aembed_documents(texts)
+            except RateLimitError as e:
+                if attempt >= max_retries - 1:
+                    raise
+                logger.warning(f"RateLimitError: {e}. Retrying in {delay} seconds...")
+                await asyncio.sleep(delay)
+                delay *= 2
+        return []
+
+    @classmethod
+    def _write_migration_checkpoint(
+            cls, checkpoint_path: str, embedding_model_key: str, old_dimension: int,
+            ids: List[str], documents: List[Document], embeddings: List[List[float]]):
+        # 1行目は移行先のモデルと件数。書き込み途中のファイルが読み込まれないよう、一時ファイルに書いてから置き換える
+        os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+        temp_path = checkpoint_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"embedding_model_key": embedding_model_key, "old_dimension": old_dimension, "documents": len(ids)}) + "\n")
+            for id, doc, embedding in zip(ids, documents, embeddings):
+                f.write(json.dumps(
+                    {"id": id, "page_content": doc.page_content, "metadata": doc.metadata, "embedding": embedding},
+                    ensure_ascii=False
+                ) + "\n")
+        os.replace(temp_path, checkpoint_path)
+
+    @classmethod
+    def _read_migration_checkpoint(
+            cls, checkpoint_path: str, embedding_model_key: str
+            ) -> Optional[Tuple[int, List[str], List[Document], List[List[float]]]]:
+        """
+        _write_migration_checkpointで書き出したファイルを読み込む。
+        移行先のモデル・次元数が異なる場合、件数が一致しない場合はNoneを返す。
+        """
+        ids: List[str] = []
+        documents: List[Document] = []
+        embeddings: List[List[float]] = []
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            header = json.loads(f.readline() or "{}")
+            if header.get("embedding_model_key") != embedding_model_key:
+                logger.warning(f"migration checkpoint is for another embedding model. ignored: {checkpoint_path}")
+                return None
+            for line in f:
+                item = json.loads(line)
+                ids.append(item["id"])
+                documents.append(Document(page_content=item["page_content"], metadata=item["metadata"]))
+                embeddings.append(item["embedding"])
+        if len(ids) != header.get("documents", -1):
+            logger.warning(f"migration checkpoint is incomplete. ignored: {checkpoint_path}")
+            return None
+        return int(header.get("old_dimension", 0)), ids, documents, embeddings
+
+    def _load(self) -> VectorStore:
+        raise NotImplementedError("Not implemented")
+
     def _delete_collection(self):
         # self.dbがdelete_collectionメソッドを持っている場合はそれを呼び出す
         if hasattr(self.db, "delete_collection"):
@@ -65,45 +446,103 @@ class LangChainVectorDB(BaseModel):
 
 
     async def add_document(self, data: EmbeddingData):
+        await self.add_documents([data])
 
+    async def add_documents(self, data_list: List[EmbeddingData]):
+        """
+        複数のソースのドキュメントを分割し、チャンクをadd_batch_size件ずつまとめてベクトルDBに登録する。
+        """
         if self.db is None:
             raise ValueError("db is None")
-       # テキストをサニタイズ
-        page_content = self._sanitize_text(data.content)
- 
-        doc_id_text_list: list[tuple[str, str]] = []
-        # doc_store_urlが指定されている場合は、page_contentをparent_chunk_sizeで分割, doc_idとtextのタプルを作成
-        doc_store: Optional[SQLDocStore] = None
-        if self.doc_store_url:
-            doc_store = SQLDocStore(self.doc_store_url)
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=self.parent_chunk_size)
-            text_list = text_splitter.split_text(page_content)
-            for text in text_list:
-                doc_id = str(uuid.uuid4())
-                doc_id_text_list.append((doc_id, text))
+        # 設定された次元数とコレクションの次元数が異なる場合は登録しない
+        await asyncio.to_thread(self.validate_embedding_dimensions)
+
+        # doc_store_urlが指定されている場合は、page_contentをparent_chunk_sizeトークンの親チャンクに分割してdoc_storeに保存し、
+        # 親チャンクをさらにchunk_sizeトークンの子チャンクに分割してEmbeddingを作成する(子チャンクのdoc_idは親チャンクのid)
+        # doc_store_urlが指定されていない場合は、chunk_sizeトークンで分割する
+        doc_store: Optional[SQLDocStore] = self.doc_store if self.doc_store_url else None
+        if doc_store is not None:
+            chunker = TextChunker(self.get_parent_chunk_tokens())
+            child_chunker = TextChunker(self.get_child_chunk_tokens())
         else:
-            # doc_store_urlが指定されていない場合は、page_contentとdoc_idのタプルを作成
-            doc_id = str(uuid.uuid4())
-            doc_id_text_list.append((doc_id, page_content))
-
-        # doc_id_text_listの要素をループして、Documentを作成
-        for doc_id, text in doc_id_text_list:
-            # metadataをコピーしてdoc_idを設定
-            metadata_copy = await LangChainVectorDB.create_metadata(data)
-            metadata_copy["doc_id"] = doc_id
-
-            # Documentを作成
-            document = Document(
-                page_content=text,
-                metadata=metadata_copy
-            )
-            await self.add_doucment_with_retry(self.db, [document])
+            child_chunker = TextChunker(self.chunk_size if self.chunk_size > 0 else TextChunker.max_embedding_tokens)
+            chunker = child_chunker
 
-            if doc_store is not None:
-                # doc_store_urlが指定されている場合は、doc_storeに保存
-                param = []
-                param.append((doc_id, document))
-                await doc_store.amset(param)
+        db = self.db
+        keyword_index = self.get_keyword_index()
+        doc_store_pairs: list[tuple[str, Document]] = []
+        pending_documents: list[Document] = []
+
+        async def flush():
+            # 溜まったチャンクを1回の呼び出しでまとめて登録する
+            if len(pending_documents) == 0:
+                return
+            documents = list(pending_documents)
+            pending_documents.clear()
+            ids = [str(uuid.uuid4()) for _ in documents]
+            added = await self.add_doucment_with_retry(db, documents, ids=ids)
+            if not added:
+                # 呼び出し元(VectorWriteQueue等)が失敗を検知できるよう、例外を発生させる
+                raise RuntimeError(f"Failed to add documents to the vector db. collection:{self.collection_name} chunks:{len(documents)}")
+            if keyword_index is not None:
+                # キーワード検索用のインデックスにも登録
+                await asyncio.to_thread(keyword_index.add_documents, ids, documents)
+
+        try:
+            for data in data_list:
+                # テキストをサニタイズ
+                page_content = self._sanitize_text(data.content)
+                metadata = await LangChainVectorDB.create_metadata(data)
+                metadata[self.content_hash_key] = self.create_content_hash(page_content)
+                # 分割が完了したチャンクから順にEmbeddingを作成して登録する
+                async for text in chunker.aiter_chunks(page_content):
+                    doc_id = str(uuid.uuid4())
+                    # metadataをコピーしてdoc_idを設定
+                    metadata_copy = copy.deepcopy(metadata)
+                    metadata_copy["doc_id"] = doc_id
+
+                    # Documentを作成
+                    document = Document(
+                        page_content=text,
+                        metadata=metadata_copy
+                    )
+                    if doc_store is not None:
+                        # 親チャンクは1回だけ保存し、子チャンクのEmbeddingを作成する
+                        doc_store_pairs.append((doc_id, document))
+                        child_texts = await asyncio.to_thread(child_chunker.split_text, text)
+                        pending_documents.extend(Document(page_content=child_text, metadata=copy.deepcopy(metadata_copy)) for child_text in child_texts)
+                    else:
+                        pending_documents.append(document)
+                    if len(pending_documents) >= self.add_batch_size:
+                        await flush()
+            await flush()
+
+            if doc_store is not None and len(doc_store_pairs) > 0:
+                # doc_store_urlが指定されている場合は、doc_storeに1つのトランザクションでまとめて保存
+                await doc_store.amset(doc_store_pairs)
+        except Exception:
+            # 途中まで登録したチャンクが残らないよう、対象のソースを削除してから例外を再送出する
+            try:
+                await self.delete_documents([data.source_id for data in data_list])
+            except Exception as e:
+                logger.error(f"Failed to remove partially added documents: {e}")
+            raise
+        finally:
+            # 検索結果のキャッシュを無効化する
+            await VectorSearchCache.invalidate(self.get_collection_key())
+
+    def get_parent_chunk_tokens(self) -> int:
+        return self.parent_chunk_size if self.parent_chunk_size > 0 else TextChunker.max_embedding_tokens
+
+    def get_child_chunk_tokens(self) -> int:
+        """
+        MultiVectorRetrieverを利用する場合の子チャンクのトークン数。
+        子チャンクが親チャンクと同じ大きさにならないよう、親チャンクのparent_child_chunk_ratio分の1以下にする。
+        """
+        max_child_tokens = max(1, self.get_parent_chunk_tokens() // self.parent_child_chunk_ratio)
+        if self.chunk_size <= 0:
+            return max_child_tokens
+        return min(self.chunk_size, max_child_tokens)
 
     # テキストをサニタイズする
     def _sanitize_text(self, text: str) -> str:
@@ -123,52 +562,169 @@ class LangChainVectorDB(BaseModel):
     ########################################
 
     def delete_collection(self):
-        # ベクトルDB固有の削除メソッドを呼び出してコレクションを削除
-        self._delete_collection()
+        try:
+            # ベクトルDB固有の削除メソッドを呼び出してコレクションを削除
+            self._delete_collection()
+            keyword_index = self.get_keyword_index()
+            if keyword_index is not None:
+                keyword_index.delete_all()
+        finally:
+            # 検索結果のキャッシュを無効化する
+            VectorSearchCache.invalidate_sync(self.get_collection_key())
 
     async def delete_folder(self, folder_id: str):
-        # ベクトルDB固有のvector id取得メソッドを呼び出し。
-        vector_ids, _ = self._get_document_ids_by_tag("folder_id", folder_id)
-
-        # vector_idsが空の場合は何もしない
-        if len(vector_ids) == 0:
-            return 0
-
-        # DocStoreから削除
-        if self.doc_store_url and self.doc_store is not None:
-            await self.doc_store.amdelete(vector_ids)
+        try:
+            keyword_index = self.get_keyword_index()
+            if keyword_index is not None:
+                await asyncio.to_thread(keyword_index.delete_by_metadata, "folder_id", [folder_id])
+
+            # ベクトルDB固有の削除メソッドを呼び出し。DocStoreからも削除する
+            result = await self._delete_folders([folder_id])
+            return result["vectors"]
+        finally:
+            # 検索結果のキャッシュを無効化する
+            await VectorSearchCache.invalidate(self.get_collection_key())
+
+    async def delete_folder_tree(self, folder_id: str, progress_callback: Optional[Callable[[int, int, int], None]] = None) -> dict[str, int]:
+        """
+        フォルダとその全ての子孫フォルダに属するベクトル、DocStoreのデータ、キーワードインデックスを削除する。
+        子孫フォルダのidは再帰CTEで1回のクエリで取得し、削除はフォルダをまとめたバッチ単位で行う。
 
-        # ベクトルDB固有の削除メソッドを呼び出し
-        await self._delete(vector_ids)
+        Returns:
+            dict[str, int]: 削除したフォルダ数(folders)、ベクトル数(vectors)、DocStoreのデータ数(documents)
+        """
+        folder_ids = [folder_id] + await ContentFolder.get_content_folder_child_ids(folder_id)
+        try:
+            keyword_index = self.get_keyword_index()
+            if keyword_index is not None:
+                await asyncio.to_thread(keyword_index.delete_by_metadata, "folder_id", folder_ids)
+            result = await self._delete_folders(folder_ids, progress_callback)
+            logger.info(f"folder tree deleted: folder_id={folder_id} {result}")
+            return result
+        finally:
+            # 検索結果のキャッシュを無効化する
+            await VectorSearchCache.invalidate(self.get_collection_key())
 
     async def delete_document(self, source_id: str):
-        # ベクトルDB固有のvector id取得メソッドを呼び出し。
-        doc_ids, _ = self._get_document_ids_by_tag("source_id", source_id)
-
-        # vector_idsが空の場合は何もしない
-        if len(doc_ids) == 0:
-            return 0
+        return await self.delete_documents([source_id])
 
-        # DocStoreから削除
-        if self.doc_store_url and self.doc_store is not None:
-            await self.doc_store.amdelete(doc_ids)
+    async def delete_documents(self, source_ids: List[str]) -> int:
+        """
+        複数のソースのベクトル、DocStoreのデータ、キーワードインデックスをまとめて削除する。
+        """
+        try:
+            keyword_index = self.get_keyword_index()
+            if keyword_index is not None:
+                await asyncio.to_thread(keyword_index.delete_by_metadata, "source_id", source_ids)
+
+            # ベクトルDB固有のvector id取得メソッドを呼び出し。
+            doc_ids: List[str] = []
+            metadata_list: List[dict[str, Any]] = []
+            for source_id in source_ids:
+                ids, metadatas = await asyncio.to_thread(self._get_document_ids_by_tag, "source_id", source_id)
+                doc_ids.extend(ids)
+                metadata_list.extend(metadatas)
+
+            # vector_idsが空の場合は何もしない
+            if len(doc_ids) == 0:
+                return 0
+
+            # DocStoreから親ドキュメントを削除(keyは子チャンクのmetadataのdoc_id)
+            if self.doc_store_url and self.doc_store is not None:
+                await self.doc_store.amdelete(self.get_doc_store_keys(metadata_list))
+
+            # ベクトルDB固有の削除メソッドを呼び出し
+            await self._delete(doc_ids)
+            return len(doc_ids)
+        finally:
+            # 検索結果のキャッシュを無効化する
+            await VectorSearchCache.invalidate(self.get_collection_key())
+
+    async def patch_metadata(self, name: str, value: str, patch: dict[str, Any]) -> int:
+        """
+        metadataのnameがvalueの全てのチャンク(source_id, folder_id等)のmetadataを、Embeddingを作成せずに更新する。
 
-        # ベクトルDB固有の削除メソッドを呼び出し
-        await self._delete(doc_ids)
+        Returns:
+            int: 更新したチャンク数
+        """
+        try:
+            ids, metadata_list = await asyncio.to_thread(self._get_document_ids_by_tag, name, value)
+            return await self._apply_metadata_patches(ids, metadata_list, [patch] * len(ids))
+        finally:
+            # 検索結果のキャッシュを無効化する
+            await VectorSearchCache.invalidate(self.get_collection_key())
+
+    async def update_folder_metadata(self, folder_id: str) -> dict[str, int]:
+        """
+        フォルダの名前の変更・移動の後に、フォルダと子孫フォルダのチャンクのfolder_pathと祖先フォルダのidを更新する。
+        Embeddingは作成しない。
+        """
+        folder_ids = [folder_id] + await ContentFolder.get_content_folder_child_ids(folder_id)
+        prefix = ContentFolder.folder_ancestor_key_prefix
+        updated = 0
+        try:
+            for i in range(0, len(folder_ids), self.delete_folder_batch_size):
+                batch = folder_ids[i:i + self.delete_folder_batch_size]
+                ids, metadata_list = await asyncio.to_thread(self._get_document_ids_by_folder_ids, batch)
+                if len(ids) == 0:
+                    continue
+                # 新しいパスと祖先フォルダのidを、フォルダ毎に1回のクエリでまとめて取得する
+                folder_paths = await ContentFolder.get_content_folder_paths_by_ids(batch)
+                ancestor_ids = await ContentFolder.get_content_folder_ancestor_ids_by_ids(batch)
+                folder_patches: dict[str, dict[str, Any]] = {}
+                for batch_folder_id in batch:
+                    patch: dict[str, Any] = {"folder_path": folder_paths.get(batch_folder_id, "")}
+                    for depth, ancestor_id in enumerate(ancestor_ids.get(batch_folder_id, [])):
+                        patch[ContentFolder.get_folder_ancestor_key(depth)] = ancestor_id
+                    folder_patches[batch_folder_id] = patch
+                patches = [folder_patches.get((metadata or {}).get("folder_id", ""), {}) for metadata in metadata_list]
+                updated += await self._apply_metadata_patches(ids, metadata_list, patches, remove_key_prefix=prefix)
+            logger.info(f"folder metadata updated: folder_id={folder_id} folders={len(folder_ids)} chunks={updated}")
+            return {"folders": len(folder_ids), "chunks": updated}
+        finally:
+            # 検索結果のキャッシュを無効化する
+            await VectorSearchCache.invalidate(self.get_collection_key())
+
+    async def update_metadata_if_content_unchanged(self, data: EmbeddingData) -> bool:
+        """
+        source_idの登録済みのチャンクのテキストがdataと同じ場合は、Embeddingを作成せずにmetadataのみ更新してTrueを返す。
+        登録されていない場合、テキストが変わった場合はFalseを返す(呼び出し元で削除・登録を行う)。
+        """
+        ids, metadata_list = await asyncio.to_thread(self._get_document_ids_by_tag, "source_id", data.source_id)
+        if len(ids) == 0:
+            return False
+        content_hash = self.create_content_hash(self._sanitize_text(data.content))
+        if any((metadata or {}).get(self.content_hash_key) != content_hash for metadata in metadata_list):
+            return False
+        try:
+            metadata = await LangChainVectorDB.create_metadata(data)
+            metadata[self.content_hash_key] = content_hash
+            await self._apply_metadata_patches(ids, metadata_list, [metadata] * len(ids), remove_key_prefix=ContentFolder.folder_ancestor_key_prefix)
+            logger.info(f"content is unchanged. metadata updated: source_id={data.source_id} chunks={len(ids)}")
+            return True
+        finally:
+            # 検索結果のキャッシュを無効化する
+            await VectorSearchCache.invalidate(self.get_collection_key())
 
     async def update_embeddings(self, params: EmbeddingData):
-        
+        # テキストが変わっていない場合はmetadataのみ更新する
+        if await self.update_metadata_if_content_unchanged(params):
+            return
+
         # 既に存在するドキュメントを削除
         await self.delete_document(params.source_id)
         # ドキュメントを格納する。
         await self.add_document(params)
 
     # RateLimitErrorが発生した場合は、指数バックオフを行う
-    async def add_doucment_with_retry(self, vector_db: VectorStore, documents: list[Document], max_retries: int = 5, delay: float = 1.0):
+    async def add_doucment_with_retry(self, vector_db: VectorStore, documents: list[Document], max_retries: int = 5, delay: float = 1.0, ids: Optional[list[str]] = None) -> bool:
         for attempt in range(max_retries):
             try:
-                await vector_db.aadd_documents(documents=documents)
-                return
+                if ids is not None:
+                    await vector_db.aadd_documents(documents=documents, ids=ids)
+                else:
+                    await vector_db.aadd_documents(documents=documents)
+                return True
             except RateLimitError as e:
                 if attempt < max_retries - 1:
                     logger.warning(f"RateLimitError: {e}. Retrying in {delay} seconds...")
@@ -180,6 +736,8 @@ class LangChainVectorDB(BaseModel):
             except Exception as e:
                 logger.error(f"Error adding documents: {e}")
                 break
+        return False
+
     async def vector_search(self, query: str, search_kwargs: dict, return_parent: bool = True) -> List[Document]:
         """
         ベクトルDBからドキュメントを検索する。
@@ -190,45 +748,53 @@ class LangChainVectorDB(BaseModel):
         if self.db is None:
             raise ValueError("db is None")
 
-        docs_and_scores = self.db.similarity_search_with_relevance_scores(query, **search_kwargs)
-        # documentのmetadataにscoreを追加
-        doc_ids: set[str] = set()
+        use_parent = bool(self.doc_store_url and return_parent and self.doc_store is not None)
+        top_k = int(search_kwargs.get("k", 4))
+        if use_parent:
+            # 複数の子チャンクが同じ親にヒットするため、多めに検索して重複を除いた親をk件返す
+            search_kwargs = {**search_kwargs, "k": top_k * self.parent_search_fetch_factor}
+        docs_and_scores = await self._search_documents(query, search_kwargs)
+        # documentのmetadataにscoreを追加し、1回の走査でdoc_id毎にグループ化する(検索結果の順序を保持)
         documents: List[Document] = []
+        sub_docs_by_doc_id: dict[str, List[Document]] = {}
         for doc, score in docs_and_scores:
             doc.metadata["score"] = score
-            # folder_idを取得
-            folder_id = doc.metadata.get("folder_id", "")
-            doc.metadata["folder_path"] = await ContentFolder.get_content_folder_path_by_id(folder_id)
-
             documents.append(doc)
             doc_id = doc.metadata.get("doc_id", None)
             if doc_id is not None:
-                doc_ids.add(doc_id)
-
-        if self.doc_store_url and return_parent:
-            doc_store = SQLDocStore(self.doc_store_url)
-            # doc_store_urlが指定されている場合は、doc_storeからドキュメントを取得
-            parent_docs = await doc_store.amget(list(doc_ids))
-                                
-            result_docs: List[Document] = []
-            for parent_doc in parent_docs:
-                if isinstance(parent_doc, Document):
-                    # parent_docのmetadataにscoreを追加
-                    parent_doc.metadata["score"] = 0
-                    # parent_docのmetadataにfolder_pathを追加
-                    folder_id = parent_doc.metadata.get("folder_id", "")
-                    parent_doc.metadata["folder_path"] = await ContentFolder.get_content_folder_path_by_id(folder_id)
-                    # documentsの中から同じdoc_idのドキュメントを探してsub_docsに追加
-                    sub_docs = [doc.model_dump() for doc in documents if doc.metadata.get("doc_id") == parent_doc.metadata.get("doc_id")]
-                    parent_doc.metadata["sub_docs"] = sub_docs
-                    # parent_docをresult_docsに追加
-                    result_docs.append(parent_doc)
-
-            # result_docsを返す
-            return result_docs
-        else:
+                sub_docs_by_doc_id.setdefault(doc_id, []).append(doc)
+
+        if not use_parent or self.doc_store is None:
+            await self._set_folder_paths(documents)
             return documents
 
+        # doc_storeから1回のクエリで親ドキュメントを取得
+        doc_ids = list(sub_docs_by_doc_id.keys())
+        parents = await self.doc_store.amget(doc_ids)
+        parent_docs: List[Tuple[Document, List[Document]]] = [
+            (parent_doc, sub_docs_by_doc_id[doc_id]) for doc_id, parent_doc in zip(doc_ids, parents) if isinstance(parent_doc, Document)
+        ]
+
+        # 検索結果と親ドキュメントのfolder_pathを1回のクエリでまとめて取得する
+        await self._set_folder_paths(documents + [parent_doc for parent_doc, _ in parent_docs])
+
+        result_docs: List[Document] = []
+        for parent_doc, sub_docs in parent_docs:
+            # 親ドキュメントのscoreは、検索にヒットした子ドキュメントの最大のscore
+            parent_doc.metadata["score"] = max(doc.metadata["score"] for doc in sub_docs)
+            parent_doc.metadata["sub_docs"] = [doc.model_dump() for doc in sub_docs]
+            result_docs.append(parent_doc)
+        # scoreの高い順に返す(同じscoreの場合は検索結果の順序を保持する)
+        result_docs.sort(key=lambda doc: doc.metadata["score"], reverse=True)
+        return result_docs[:top_k]
+
+    async def _set_folder_paths(self, documents: List[Document]):
+        # documentsのfolder_idに対応するfolder_pathをmetadataに設定する
+        folder_ids = [doc.metadata.get("folder_id", "") for doc in documents]
+        folder_paths = await ContentFolder.get_content_folder_paths_by_ids(folder_ids)
+        for doc in documents:
+            doc.metadata["folder_path"] = folder_paths.get(doc.metadata.get("folder_id", ""), "")
+
     @classmethod
     async def create_metadata(cls, embedding_data: EmbeddingData) -> dict[str, Any]:
         logger.info(f"folder_path:{embedding_data.folder_path}")
@@ -255,6 +821,8 @@ class LangChainVectorDB(BaseModel):
             "source_type": 0,
             "score": 0
         }
+        # サブフォルダを含む検索(include_subfolders)のため、祖先フォルダのidを設定する
+        metadata.update(await ContentFolder.get_folder_ancestor_metadata(folder_id))
         return metadata
 
     
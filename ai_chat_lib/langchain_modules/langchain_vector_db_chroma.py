@@ -1,10 +1,14 @@
 import os, sys
+import threading
+from urllib.parse import urlparse
 
-from typing import Tuple, List, Any
+from typing import Tuple, List, Any, Optional, ClassVar
 import chromadb.config
 from langchain_chroma.vectorstores import Chroma # type: ignore
 import chromadb
 from langchain_core.vectorstores import VectorStore # type: ignore
+from langchain_core.documents import Document
+from pydantic import Field
 
 from ai_chat_lib.langchain_modules.langchain_vector_db import LangChainVectorDB
 
@@ -14,34 +18,72 @@ import ai_chat_lib.log_modules.log_settings as log_settings
 logger = log_settings.getLogger(__name__)
 
 class LangChainVectorDBChroma(LangChainVectorDB):
-    
+    """
+    Chromaを利用するベクトルDB。vector_db_urlの形式でクライアントを切り替える。
+    - ディレクトリのパス: プロセス内でPersistentClientを利用する
+    - http://host:port, https://host:port, chroma://host:port: Chromaサーバー(cmd_tools/chroma_server.py)にHttpClientで接続する。
+      複数のプロセスが1つのサーバーのインデックスを共有し、書き込みはサーバーで直列化される
+    """
+
+    # HttpClientを利用するURLのスキーム(chromaはhttpとして扱う)
+    server_url_schemes: ClassVar[tuple[str, ...]] = ("http", "https", "chroma")
+    # vector_db_url -> Chromaのクライアント(同じURLのインスタンスで共有する)
+    clients: ClassVar[dict[str, Any]] = {}
+    clients_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    # コレクション作成時のHNSWインデックスの設定(既存のコレクションには反映されない)
+    hnsw_params: dict[str, Any] = Field(
+        default_factory=lambda: {"hnsw:construction_ef": 400, "hnsw:search_ef": 200, "hnsw:M": 24},
+        description="Chromaのコレクション作成時のHNSWの設定"
+    )
+
     def model_post_init(self, __context: Any) -> None:
         self.db = self._load()
 
         if self.doc_store_url:
-            self.doc_store = SQLDocStore(self.doc_store_url)
+            self.doc_store = SQLDocStore.from_url(self.doc_store_url)
         else:
             logger.info("doc_store_url is None")
 
-    def _load(self) -> VectorStore:
+    @classmethod
+    def is_server_url(cls, vector_db_url: str) -> bool:
+        return urlparse(vector_db_url).scheme.lower() in cls.server_url_schemes
+
+    @classmethod
+    def get_client(cls, vector_db_url: str) -> Any:
+        """
+        vector_db_urlに対応するChromaのクライアントを取得する。同じURLのクライアントはプロセス内で共有する。
+        """
+        with cls.clients_lock:
+            client = cls.clients.get(vector_db_url, None)
+            if client is not None:
+                return client
+            settings = chromadb.config.Settings(anonymized_telemetry=False)
+            if cls.is_server_url(vector_db_url):
+                url = urlparse(vector_db_url)
+                ssl = url.scheme.lower() == "https"
+                port = url.port or (443 if ssl else 8000)
+                logger.info(f"connect to chroma server:{url.hostname}:{port}")
+                client = chromadb.HttpClient(host=url.hostname or "localhost", port=port, ssl=ssl, settings=settings)
+            else:
+                # ベクトルDB用のディレクトリが存在しない場合
+                if not os.path.exists(vector_db_url):
+                    # ディレクトリを作成
+                    os.makedirs(vector_db_url)
+                    # ディレクトリが作成されたことをログに出力
+                    logger.info(f"create directory:{vector_db_url}")
+                client = chromadb.PersistentClient(path=vector_db_url, settings=settings)
+            cls.clients[vector_db_url] = client
+            return client
 
-        # ベクトルDB用のディレクトリが存在しない場合
-        if not os.path.exists(self.vector_db_url):
-            # ディレクトリを作成
-            os.makedirs(self.vector_db_url)
-            # ディレクトリが作成されたことをログに出力
-            logger.info(f"create directory:{self.vector_db_url}")
-        # params
-        settings = chromadb.config.Settings(anonymized_telemetry=False)
+    def _load(self) -> VectorStore:
 
         params: dict[str, Any]= {}
-        params["client"] = chromadb.PersistentClient(path=self.vector_db_url, settings=settings)
+        params["client"] = self.get_client(self.vector_db_url)
         params["embedding_function"] = self.langchain_openai_client.get_embedding_client()
         params["collection_metadata"] = {
             "hnsw:space":"cosine", 
-            "hnsw:construction_ef": 400, 
-            "hnsw:search_ef": 200,
-            "hnsw:M": 24,
+            **self.hnsw_params,
         }
         # collectionが指定されている場合
         logger.info(f"collection_name:{self.collection_name}")
@@ -63,6 +105,88 @@ class LangChainVectorDBChroma(LangChainVectorDB):
 
         # vector idを取得してidsに追加
         ids.extend(doc_dict.get("ids", []))
-        metadata_list.extend(doc_dict.get("metadata", []))
+        metadata_list.extend(doc_dict.get("metadatas", None) or [])
 
         return ids, metadata_list
+
+    def _get_document_ids_by_folder_ids(self, folder_ids: List[str]) -> Tuple[List, List]:
+        # $inで複数のフォルダをまとめて検索する
+        doc_dict = self.db.get(where={"folder_id": {"$in": folder_ids}}, include=["metadatas"]) # type: ignore
+        return doc_dict.get("ids", []), doc_dict.get("metadatas", None) or []
+
+    def _update_metadatas(self, ids: List[str], metadatas: List[dict[str, Any]], removed_keys: Optional[List[List[str]]] = None):
+        collection = self.db._collection # type: ignore
+        metadata_by_id = dict(zip(ids, metadatas))
+        # Chromaのupdate/upsertは既存のmetadataにキーをマージし、Noneによるキーの削除もできないため、
+        # キーを削除する行は保存済みのEmbeddingとテキストを取得し、削除してから新しいmetadataで登録し直す
+        replace_ids = [id for id, keys in zip(ids, removed_keys or []) if keys]
+        if len(replace_ids) > 0:
+            stored = collection.get(ids=replace_ids, include=["embeddings", "documents", "metadatas"])
+            stored_ids = stored.get("ids", [])
+            if len(stored_ids) > 0:
+                embeddings = [[float(value) for value in embedding] for embedding in stored["embeddings"]]
+                collection.delete(ids=stored_ids)
+                try:
+                    collection.add(
+                        ids=stored_ids, embeddings=embeddings,
+                        metadatas=[metadata_by_id[id] for id in stored_ids], documents=stored["documents"],
+                    )
+                except Exception:
+                    # 登録し直せなかった場合は元のmetadataで戻す
+                    collection.add(ids=stored_ids, embeddings=embeddings, metadatas=stored["metadatas"], documents=stored["documents"])
+                    raise
+        # それ以外の行は、documentsとembeddingsを指定せずに更新する(Embeddingは作成されない)
+        replace_id_set = set(replace_ids)
+        update_ids = [id for id in ids if id not in replace_id_set]
+        if len(update_ids) > 0:
+            collection.update(ids=update_ids, metadatas=[metadata_by_id[id] for id in update_ids])
+
+    def get_collection_dimension(self) -> int:
+        result = self.db.get(limit=1, include=["embeddings"]) # type: ignore
+        embeddings = result.get("embeddings", None)
+        if embeddings is None or len(embeddings) == 0:
+            return 0
+        return len(embeddings[0])
+
+    def get_all_documents(self, batch_size: int = 1000) -> Tuple[List[str], List[Document]]:
+        ids: List[str] = []
+        documents: List[Document] = []
+        offset = 0
+        while True:
+            result = self.db.get(limit=batch_size, offset=offset, include=["documents", "metadatas"]) # type: ignore
+            batch_ids = result.get("ids", [])
+            if len(batch_ids) == 0:
+                break
+            ids.extend(batch_ids)
+            for page_content, metadata in zip(result.get("documents", []), result.get("metadatas", [])):
+                documents.append(Document(page_content=page_content or "", metadata=metadata or {}))
+            offset += len(batch_ids)
+        return ids, documents
+
+    def _add_embeddings(self, ids: List[str], documents: List[Document], embeddings: List[List[float]]):
+        self.db._collection.upsert( # type: ignore
+            ids=ids,
+            embeddings=embeddings, # type: ignore
+            metadatas=[doc.metadata for doc in documents], # type: ignore
+            documents=[doc.page_content for doc in documents],
+        )
+
+    def _similarity_search_with_embeddings(self, query_embedding: List[float], k: int, filter: Optional[dict] = None) -> List[Tuple[Document, float, List[float]]]:
+        result = self.db._collection.query( # type: ignore
+            query_embeddings=[query_embedding], # type: ignore
+            n_results=k,
+            where=filter or None,
+            include=["documents", "metadatas", "distances", "embeddings"], # type: ignore
+        )
+        ids = result.get("ids", [[]])[0]
+        if len(ids) == 0:
+            return []
+        documents = result["documents"][0] # type: ignore
+        metadatas = result["metadatas"][0] # type: ignore
+        distances = result["distances"][0] # type: ignore
+        embeddings = result["embeddings"][0] # type: ignore
+        # コレクションはcosine距離のため、1 - 距離を関連度とする
+        return [
+            (Document(page_content=page_content or "", metadata=metadata or {}), 1.0 - float(distance), list(embedding))
+            for page_content, metadata, distance, embedding in zip(documents, metadatas, distances, embeddings)
+        ]
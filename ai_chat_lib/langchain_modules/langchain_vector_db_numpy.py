@@ -0,0 +1,995 @@
+"""
+langchain_vector_db_numpy.py
+
+NumPyとmemmapによる組み込みのベクトルストア。
+- ベクトルは追記専用のmemmapファイル(float32/float16/int8)に保存する
+  float16/int8の場合は検索用の量子化ファイルとは別にfloat32のファイルを保持し、上位の候補を再スコアリングする
+  (ディスク使用量はfloat32のみの場合の1.25倍(float16)/1.25倍+スケール(int8)になる。
+   keep_full_precision=Falseの場合はfloat32のファイルを保持せず、再スコアリングも行わない)
+- page_contentとmetadataはSQLiteのサイドカーに保存し、削除は論理削除とする
+- 検索はNumPyの内積とargpartitionによるtop-kで行い、metadataのfilterもベクトル化して評価する
+- 件数が多い場合はIVF(k-meansによる分割)で検索対象を絞り込む。IVFインデックスはバックグラウンドで作成し、作成中は全件検索する
+- 書き込みはSQLiteのBEGIN IMMEDIATEでプロセス間で直列化し、ロック取得後に他プロセスの変更を読み直してから追記する
+- 論理削除した行はファイルに残り続けるため、compact()で取り除いて行番号を詰め直す
+"""
+
+import os
+import json
+import uuid
+import shutil
+import sqlite3
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, ClassVar, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+from pydantic import Field
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from ai_chat_lib.langchain_modules.langchain_vector_db import LangChainVectorDB
+from ai_chat_lib.langchain_modules.langchain_doc_store import SQLDocStore
+
+import ai_chat_lib.log_modules.log_settings as log_settings
+logger = log_settings.getLogger(__name__)
+
+
+class DequantizedVectors:
+    """
+    float32のファイルを保持しない場合に、量子化済みのベクトルをfloat32に戻して返す(IVFの作成・Embeddingの取得用)
+    """
+    def __init__(self, vectors: np.ndarray, scales: Optional[np.ndarray]):
+        self.vectors = vectors
+        self.scales = scales
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def __getitem__(self, index: Any) -> np.ndarray:
+        block = np.asarray(self.vectors[index], dtype=np.float32)
+        if self.scales is None:
+            return block
+        scales = np.asarray(self.scales[index], dtype=np.float32)
+        return block * (scales[..., None] if block.ndim > 1 else scales)
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    NumPyによるベクトルストア。ベクトルは正規化して保存し、類似度はコサイン類似度を返す。
+    """
+
+    supported_dtypes: ClassVar[dict[str, Any]] = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+    # 検索時に一度にfloat32へ変換する行数
+    search_block_size: ClassVar[int] = 65536
+    sql_batch_size: ClassVar[int] = 500
+    # compactで書き出す一時ファイルの拡張子
+    compaction_suffix: ClassVar[str] = ".compact"
+
+    def __init__(
+            self, path: str, embedding: Optional[Embeddings], vector_dtype: Optional[str] = None,
+            ivf_min_vectors: int = 50000, ivf_probes: int = 8, rescore_multiplier: int = 4,
+            keep_full_precision: Optional[bool] = None):
+        """
+        Args:
+            path (str): コレクションのディレクトリ
+            embedding (Optional[Embeddings]): Embeddingを作成するクライアント
+            vector_dtype (Optional[str]): 検索に利用するベクトルの型(float32/float16/int8)。
+                既存のコレクションと異なる場合は変換する。Noneの場合は既存の型(新規の場合はfloat32)
+            ivf_min_vectors (int): IVFインデックスを利用する最小件数
+            ivf_probes (int): IVF検索時に探索するリスト数
+            rescore_multiplier (int): 量子化している場合に、k * rescore_multiplier件をfloat32で再スコアリングする
+            keep_full_precision (Optional[bool]): float16/int8の場合に再スコアリング用のfloat32のファイルを保持するか。
+                Falseの場合はディスク使用量が減る代わりに再スコアリングを行わない。Noneの場合は既存の設定(新規の場合はTrue)
+        """
+        if vector_dtype is not None and vector_dtype not in self.supported_dtypes:
+            raise ValueError(f"Invalid vector_dtype: {vector_dtype}")
+        self.path = path
+        self.embedding = embedding
+        self.ivf_min_vectors = ivf_min_vectors
+        self.ivf_probes = ivf_probes
+        self.rescore_multiplier = rescore_multiplier
+        os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(path, "metadata.db"), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS vectors (
+                row INTEGER NOT NULL PRIMARY KEY,
+                id TEXT NOT NULL,
+                page_content TEXT NOT NULL,
+                metadata_json TEXT NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_vectors_id ON vectors (id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS store_properties (name TEXT NOT NULL PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+
+        properties = self._get_properties()
+        self.vector_dtype = properties.get("vector_dtype", vector_dtype or "float32")
+        self.dim = int(properties.get("dim", "0"))
+        self.keep_full_precision = properties.get("keep_full_precision", "1") == "1"
+        if "vector_dtype" not in properties:
+            self._set_property("vector_dtype", self.vector_dtype)
+            self._conn.commit()
+
+        self._generation = -1
+        self._vectors: np.ndarray = np.zeros((0, 0), dtype=np.float32)
+        self._full_vectors: Union[np.ndarray, DequantizedVectors] = np.zeros((0, 0), dtype=np.float32)
+        self._scales: Optional[np.ndarray] = None
+        self._ids: list[str] = []
+        self._metadatas: list[dict[str, Any]] = []
+        self._deleted: np.ndarray = np.zeros(0, dtype=bool)
+        self._metadata_columns: dict[str, np.ndarray] = {}
+        self._ivf_centroids: Optional[np.ndarray] = None
+        self._ivf_assignments: np.ndarray = np.zeros(0, dtype=np.int32)
+        self._ivf_thread: Optional[threading.Thread] = None
+        self._compactions = 0
+        self._reload_if_needed()
+        if vector_dtype is not None and self.vector_dtype != vector_dtype:
+            self.convert_vector_dtype(vector_dtype)
+        if keep_full_precision is not None and self.keep_full_precision != keep_full_precision:
+            self.set_keep_full_precision(keep_full_precision)
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding
+
+    ########################################
+    # 永続化
+    ########################################
+    def _get_properties(self) -> dict[str, str]:
+        return dict(self._conn.execute("SELECT name, value FROM store_properties").fetchall())
+
+    def _set_property(self, name: str, value: str) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO store_properties (name, value) VALUES (?, ?)", (name, value))
+
+    def _increment_generation(self) -> None:
+        # 他プロセスの変更を検知するための世代番号
+        generation = int(self._get_properties().get("generation", "0")) + 1
+        self._set_property("generation", str(generation))
+        self._generation = generation
+
+    def _get_vector_file_path(self, vector_dtype: Optional[str] = None) -> str:
+        return os.path.join(self.path, f"vectors.{vector_dtype or self.vector_dtype}")
+
+    def _get_scale_file_path(self) -> str:
+        return os.path.join(self.path, "scales.float32")
+
+    def _get_ivf_file_path(self) -> str:
+        return os.path.join(self.path, "ivf.npz")
+
+    def has_full_precision_file(self) -> bool:
+        return self.vector_dtype == "float32" or self.keep_full_precision
+
+    def _get_data_file_paths(self) -> list[str]:
+        return [self._get_vector_file_path(vector_dtype) for vector_dtype in self.supported_dtypes] + [
+            self._get_scale_file_path(), self._get_ivf_file_path()
+        ]
+
+    @contextmanager
+    def _write_transaction(self):
+        """
+        BEGIN IMMEDIATEでサイドカーの書き込みロックを取得し、他プロセスの変更を読み直してから書き込む。
+        正常に終了した場合は世代番号を進めてコミットし、例外の場合はロールバックする。
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._reload_if_needed()
+                yield
+                self._increment_generation()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                # メモリ上の状態がサイドカーと一致しない可能性があるため、次回のアクセス時に読み直す
+                self._generation = -1
+                raise
+
+    def _open_array(self, file_path: str, vector_dtype: str, count: int, dim: int) -> np.ndarray:
+        shape = (count, dim) if dim > 0 else (count,)
+        if count == 0 or self.dim == 0:
+            return np.zeros((0, max(dim, 1)) if dim > 0 else (0,), dtype=self.supported_dtypes[vector_dtype])
+        return np.memmap(file_path, dtype=self.supported_dtypes[vector_dtype], mode="r", shape=shape)
+
+    def _open_vectors(self, count: int) -> None:
+        # 検索用(量子化済み)のベクトル、再スコアリング用のfloat32のベクトル、int8のスケールを開く
+        if self.vector_dtype == "int8":
+            self._scales = self._open_array(self._get_scale_file_path(), "float32", count, 0)
+        else:
+            self._scales = None
+        if self.vector_dtype == "float32":
+            self._vectors = self._full_vectors = self._open_array(self._get_vector_file_path("float32"), "float32", count, self.dim)
+            return
+        self._vectors = self._open_array(self._get_vector_file_path(), self.vector_dtype, count, self.dim)
+        if self.keep_full_precision:
+            self._full_vectors = self._open_array(self._get_vector_file_path("float32"), "float32", count, self.dim)
+        else:
+            self._full_vectors = DequantizedVectors(self._vectors, self._scales)
+
+    def _write_full_precision_file(self, count: int) -> None:
+        # 現在のベクトル(float32のファイルがない場合は量子化済みのベクトルを戻したもの)からfloat32のファイルを作り直す
+        file_path = self._get_vector_file_path("float32")
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        for i in range(0, count, self.search_block_size):
+            self._write_rows(file_path, i, np.asarray(self._full_vectors[i:i + self.search_block_size], dtype=np.float32))
+
+    @classmethod
+    def _write_rows(cls, file_path: str, start_row: int, data: np.ndarray) -> None:
+        # 登録済みの行の直後から書き込む(前回の中断で残った未登録の行は上書きする)
+        row_bytes = data[0].nbytes if len(data) > 0 else 0
+        with open(file_path, "r+b" if os.path.exists(file_path) else "wb") as f:
+            f.seek(start_row * row_bytes)
+            f.write(data.tobytes())
+            f.truncate()
+
+    @classmethod
+    def quantize(cls, vectors: np.ndarray, vector_dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        float32のベクトルを指定した型に変換する。int8の場合は行毎のスケール(最大絶対値/127)も返す。
+        """
+        if vector_dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            quantized = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+            return quantized, scales.astype(np.float32)
+        return vectors.astype(cls.supported_dtypes[vector_dtype]), None
+
+    @classmethod
+    def compute_scores(cls, vectors: np.ndarray, scales: Optional[np.ndarray], rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """
+        指定した行とクエリの内積をブロック毎にfloat32で計算する。
+        """
+        scores = np.empty(len(rows), dtype=np.float32)
+        for i in range(0, len(rows), cls.search_block_size):
+            block = rows[i:i + cls.search_block_size]
+            block_scores = np.asarray(vectors[block], dtype=np.float32) @ query
+            if scales is not None:
+                block_scores *= scales[block]
+            scores[i:i + len(block)] = block_scores
+        return scores
+
+    @classmethod
+    def select_top_k(cls, scores: np.ndarray, k: int) -> np.ndarray:
+        # スコアの降順に並んだ上位k件の位置を返す
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def _reload_if_needed(self) -> None:
+        # サイドカーの世代番号が変わっていれば、ベクトルとmetadataを読み直す
+        with self._lock:
+            properties = self._get_properties()
+            generation = int(properties.get("generation", "0"))
+            if generation == self._generation:
+                return
+            self.dim = int(properties.get("dim", "0"))
+            if "compaction_pending" in properties:
+                self._finish_compaction(int(properties["compaction_pending"]))
+            self._compactions = int(properties.get("compactions", "0"))
+            rows = self._conn.execute("SELECT id, metadata_json, deleted FROM vectors ORDER BY row").fetchall()
+            self._ids = [row[0] for row in rows]
+            self._metadatas = [json.loads(row[1]) for row in rows]
+            self._deleted = np.array([bool(row[2]) for row in rows], dtype=bool)
+            self.vector_dtype = properties.get("vector_dtype", self.vector_dtype)
+            self.keep_full_precision = properties.get("keep_full_precision", "1") == "1"
+            self._open_vectors(len(rows))
+            self._metadata_columns = {}
+            self._load_ivf()
+            self._generation = generation
+
+    def _load_ivf(self) -> None:
+        self._ivf_centroids = None
+        self._ivf_assignments = np.zeros(0, dtype=np.int32)
+        if not os.path.exists(self._get_ivf_file_path()):
+            return
+        data = np.load(self._get_ivf_file_path())
+        self._ivf_centroids = data["centroids"]
+        assignments = data["assignments"]
+        # IVF構築後に追加された行は最も近いセントロイドに割り当てる
+        if len(assignments) < len(self._ids):
+            added = self._assign_to_centroids(np.arange(len(assignments), len(self._ids)))
+            assignments = np.concatenate([assignments, added])
+        self._ivf_assignments = assignments
+
+    ########################################
+    # 追加・削除
+    ########################################
+    @classmethod
+    def _normalize(cls, vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def add_vectors(self, vectors: List[List[float]], texts: List[str], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None) -> List[str]:
+        """
+        作成済みのEmbeddingを追加する。
+
+        Args:
+            vectors (List[List[float]]): Embedding
+            texts (List[str]): page_content
+            metadatas (Optional[List[dict]]): metadata
+            ids (Optional[List[str]]): id。指定しない場合はuuidを生成する
+
+        Returns:
+            List[str]: 追加したid
+        """
+        if len(vectors) == 0:
+            return []
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in texts]
+        array = self._normalize(np.asarray(vectors, dtype=np.float32))
+
+        with self._write_transaction():
+            if self.dim == 0:
+                self.dim = array.shape[1]
+                self._set_property("dim", str(self.dim))
+            elif array.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension mismatch. collection:{self.dim} new:{array.shape[1]}")
+
+            # 同じidが存在する場合は論理削除してから追記する
+            self._delete_ids(ids)
+            # 他プロセスの追記の直後から書き込む
+            start_row = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM vectors").fetchone()[0]
+            if start_row != len(self._ids):
+                raise RuntimeError(f"Vector rows are inconsistent. sidecar:{start_row} loaded:{len(self._ids)}")
+            if self.has_full_precision_file():
+                self._write_rows(self._get_vector_file_path("float32"), start_row, array)
+            if self.vector_dtype != "float32":
+                quantized, scales = self.quantize(array, self.vector_dtype)
+                self._write_rows(self._get_vector_file_path(), start_row, quantized)
+                if scales is not None:
+                    self._write_rows(self._get_scale_file_path(), start_row, scales)
+            self._conn.executemany(
+                "INSERT INTO vectors (row, id, page_content, metadata_json, deleted) VALUES (?, ?, ?, ?, 0)",
+                [(start_row + i, id, text, json.dumps(metadata, ensure_ascii=False))
+                 for i, (id, text, metadata) in enumerate(zip(ids, texts, metadatas))]
+            )
+            # 追加分をメモリ上の状態に反映する
+            self._ids.extend(ids)
+            self._metadatas.extend(metadatas)
+            self._deleted = np.concatenate([self._deleted, np.zeros(len(ids), dtype=bool)])
+            self._open_vectors(len(self._ids))
+            self._metadata_columns = {}
+            if self._ivf_centroids is not None:
+                added = self._assign_to_centroids(np.arange(start_row, len(self._ids)))
+                self._ivf_assignments = np.concatenate([self._ivf_assignments, added])
+        return list(ids)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, *, ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        if self.embedding is None:
+            raise ValueError("embedding is None")
+        texts = list(texts)
+        vectors = self.embedding.embed_documents(texts)
+        return self.add_vectors(vectors, texts, metadatas, ids)
+
+    async def aadd_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, *, ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        if self.embedding is None:
+            raise ValueError("embedding is None")
+        texts = list(texts)
+        vectors = await self.embedding.aembed_documents(texts)
+        return await asyncio.to_thread(self.add_vectors, vectors, texts, metadatas, ids)
+
+    def _delete_ids(self, ids: List[str]) -> int:
+        deleted = 0
+        for i in range(0, len(ids), self.sql_batch_size):
+            batch = ids[i:i + self.sql_batch_size]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._conn.execute(
+                f"SELECT row FROM vectors WHERE deleted=0 AND id IN ({placeholders})", batch
+            ).fetchall()
+            if len(rows) == 0:
+                continue
+            self._conn.execute(f"UPDATE vectors SET deleted=1 WHERE deleted=0 AND id IN ({placeholders})", batch)
+            self._deleted[[row[0] for row in rows]] = True
+            deleted += len(rows)
+        return deleted
+
+    def update_metadatas(self, ids: List[str], metadatas: List[dict[str, Any]]) -> int:
+        """
+        ベクトルを変更せずに、idのmetadataを置き換える。
+
+        Returns:
+            int: 更新した件数
+        """
+        metadata_by_id = dict(zip(ids, metadatas))
+        updated = 0
+        with self._write_transaction():
+            for i in range(0, len(ids), self.sql_batch_size):
+                batch = ids[i:i + self.sql_batch_size]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT row, id FROM vectors WHERE deleted=0 AND id IN ({placeholders})", batch
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE vectors SET metadata_json=? WHERE row=?",
+                    [(json.dumps(metadata_by_id[id], ensure_ascii=False), row) for row, id in rows]
+                )
+                for row, id in rows:
+                    self._metadatas[row] = metadata_by_id[id]
+                updated += len(rows)
+            self._metadata_columns = {}
+        return updated
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return None
+        with self._write_transaction():
+            self._delete_ids(list(ids))
+        return True
+
+    async def adelete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        return await asyncio.to_thread(self.delete, ids)
+
+    def convert_vector_dtype(self, vector_dtype: str) -> None:
+        """
+        検索に利用するベクトルの型を変更する。float32のファイルから量子化ファイルを作り直す。
+        float32のファイルを保持していない場合は、量子化済みのベクトルを戻したものから作り直す。
+        """
+        if vector_dtype not in self.supported_dtypes:
+            raise ValueError(f"Invalid vector_dtype: {vector_dtype}")
+        with self._write_transaction():
+            old_dtype = self.vector_dtype
+            if old_dtype == vector_dtype:
+                return
+            count = len(self._ids)
+            if vector_dtype == "float32" and not self.has_full_precision_file():
+                self._write_full_precision_file(count)
+            self.vector_dtype = vector_dtype
+            if vector_dtype != "float32":
+                # int8以外から変換する場合のみスケールのファイルを作り直す(変換元のスケールは読み込み中のため削除しない)
+                obsolete_paths = [self._get_vector_file_path()] + ([self._get_scale_file_path()] if vector_dtype == "int8" else [])
+                for file_path in obsolete_paths:
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+                for i in range(0, count, self.search_block_size):
+                    block = np.asarray(self._full_vectors[i:i + self.search_block_size], dtype=np.float32)
+                    quantized, scales = self.quantize(block, vector_dtype)
+                    self._write_rows(self._get_vector_file_path(), i, quantized)
+                    if scales is not None:
+                        self._write_rows(self._get_scale_file_path(), i, scales)
+            self._set_property("vector_dtype", vector_dtype)
+            self._open_vectors(count)
+        # 不要になった量子化ファイルを削除する
+        obsolete_files = []
+        if old_dtype != "float32":
+            obsolete_files.append(self._get_vector_file_path(old_dtype))
+        if old_dtype == "int8":
+            obsolete_files.append(self._get_scale_file_path())
+        if old_dtype == "float32" and not self.has_full_precision_file():
+            obsolete_files.append(self._get_vector_file_path("float32"))
+        for file_path in obsolete_files:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        logger.info(f"vector dtype converted. {old_dtype} -> {vector_dtype} vectors:{count}")
+
+    def set_keep_full_precision(self, keep_full_precision: bool) -> None:
+        """
+        float16/int8の場合に、再スコアリング用のfloat32のファイルを保持するかを変更する。
+        保持しない場合はfloat32のファイルを削除する。保持する場合は量子化済みのベクトルを戻してfloat32のファイルを作成する
+        (削除前の精度には戻らない)。
+        """
+        with self._write_transaction():
+            if self.keep_full_precision == keep_full_precision:
+                return
+            count = len(self._ids)
+            if keep_full_precision and self.vector_dtype != "float32":
+                self._write_full_precision_file(count)
+            self.keep_full_precision = keep_full_precision
+            self._set_property("keep_full_precision", "1" if keep_full_precision else "0")
+            self._open_vectors(count)
+        if not self.has_full_precision_file():
+            file_path = self._get_vector_file_path("float32")
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        logger.info(f"keep_full_precision changed. {keep_full_precision} vector_dtype:{self.vector_dtype} vectors:{count}")
+
+    def compact(self) -> dict[str, int]:
+        """
+        論理削除した行を取り除き、ベクトルファイル・サイドカー・IVFの行番号を詰め直す。
+        残す行を一時ファイルに書き出し、サイドカーの更新をコミットしてから置き換える。
+        置き換えの前に中断した場合は、次にいずれかのプロセスが読み込む時に置き換えを再開する。
+
+        Returns:
+            dict[str, int]: 詰め直す前後の行数
+        """
+        # コミットから置き換えまでの間に、同じプロセスの検索が古いファイルと新しい行番号を組み合わせないようにする
+        with self._lock:
+            with self._write_transaction():
+                count = len(self._ids)
+                live_rows = np.nonzero(~self._deleted)[0]
+                if len(live_rows) == count:
+                    return {"rows_before": count, "rows_after": count}
+                # 一時ファイルはcompactの通番毎に分け、コミット前の書きかけのファイルが置き換えに使われないようにする
+                compaction = self._compactions + 1
+                suffix = self.get_compaction_suffix(compaction)
+                sources = []
+                if self.has_full_precision_file():
+                    sources.append((self._get_vector_file_path("float32"), self._full_vectors))
+                if self.vector_dtype != "float32":
+                    sources.append((self._get_vector_file_path(), self._vectors))
+                if self._scales is not None:
+                    sources.append((self._get_scale_file_path(), self._scales))
+                for file_path, source in sources:
+                    temp_path = file_path + suffix
+                    open(temp_path, "wb").close()
+                    for i in range(0, len(live_rows), self.search_block_size):
+                        self._write_rows(temp_path, i, np.asarray(source[live_rows[i:i + self.search_block_size]]))
+                if self._ivf_centroids is not None:
+                    with open(self._get_ivf_file_path() + suffix, "wb") as f:
+                        np.savez(f, centroids=self._ivf_centroids, assignments=self._ivf_assignments[live_rows])
+
+                # 行番号の昇順に詰めるため、移動先の行は削除済みか移動済みで空いている
+                self._conn.execute("DELETE FROM vectors WHERE deleted=1")
+                self._conn.executemany(
+                    "UPDATE vectors SET row=? WHERE row=?",
+                    [(new_row, int(old_row)) for new_row, old_row in enumerate(live_rows) if new_row != old_row]
+                )
+                self._set_property("compaction_pending", str(compaction))
+                self._set_property("compactions", str(compaction))
+
+            self._finish_compaction(compaction)
+            self._conn.execute("DELETE FROM store_properties WHERE name='compaction_pending' AND value=?", (str(compaction),))
+            self._conn.commit()
+            self._generation = -1
+            self._reload_if_needed()
+        logger.info(f"vector store compacted. rows:{count} -> {len(live_rows)}")
+        return {"rows_before": count, "rows_after": int(len(live_rows))}
+
+    @classmethod
+    def get_compaction_suffix(cls, compaction: int) -> str:
+        return f"{cls.compaction_suffix}{compaction}"
+
+    def _finish_compaction(self, compaction: int) -> None:
+        # コミット済みのcompactの一時ファイルで置き換える(他プロセスが置き換え済みの場合は何もしない)
+        self._vectors = self._full_vectors = np.zeros((0, 0), dtype=np.float32)
+        self._scales = None
+        suffix = self.get_compaction_suffix(compaction)
+        for file_path in self._get_data_file_paths():
+            try:
+                os.replace(file_path + suffix, file_path)
+            except FileNotFoundError:
+                pass
+
+    def get_row_stats(self) -> dict[str, int]:
+        """
+        ファイル上の行数と論理削除済みの行数を返す。compactを実行するかの判断に利用する。
+        """
+        self._reload_if_needed()
+        with self._lock:
+            return {"rows": len(self._ids), "deleted": int(np.count_nonzero(self._deleted))}
+
+    def get_disk_usage(self) -> dict[str, int]:
+        """
+        ベクトル・スケール・IVFのファイル毎のディスク使用量(バイト)を返す。
+        """
+        return {
+            os.path.basename(file_path): os.path.getsize(file_path)
+            for file_path in self._get_data_file_paths() if os.path.exists(file_path)
+        }
+
+    def delete_collection(self) -> None:
+        with self._lock:
+            self._conn.close()
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    ########################################
+    # metadataのfilter
+    ########################################
+    def _get_metadata_column(self, key: str) -> np.ndarray:
+        column = self._metadata_columns.get(key, None)
+        if column is None:
+            column = np.empty(len(self._metadatas), dtype=object)
+            column[:] = [metadata.get(key, None) for metadata in self._metadatas]
+            self._metadata_columns[key] = column
+        return column
+
+    @classmethod
+    def _isin(cls, column: np.ndarray, values: Iterable[Any]) -> np.ndarray:
+        # object型の配列はnp.isinのソートに失敗することがあるため、値が少ない場合は比較の論理和、多い場合はsetで判定する
+        values = list(values)
+        if len(values) <= 8:
+            mask = np.zeros(len(column), dtype=bool)
+            for value in values:
+                mask |= column == value
+            return mask
+        value_set = set(values)
+        return np.fromiter((value in value_set for value in column), dtype=bool, count=len(column))
+
+    def _create_filter_mask(self, filter: Optional[dict[str, Any]]) -> np.ndarray:
+        # Chroma形式のfilterを行数分のbool配列に変換する
+        mask = np.ones(len(self._ids), dtype=bool)
+        if not filter:
+            return mask
+        for key, value in filter.items():
+            if key == "$and":
+                for sub_filter in value:
+                    mask &= self._create_filter_mask(sub_filter)
+                continue
+            if key == "$or":
+                or_mask = np.zeros(len(self._ids), dtype=bool)
+                for sub_filter in value:
+                    or_mask |= self._create_filter_mask(sub_filter)
+                mask &= or_mask
+                continue
+            column = self._get_metadata_column(key)
+            if not isinstance(value, dict):
+                value = {"$eq": value}
+            for operator, operand in value.items():
+                if operator == "$eq":
+                    mask &= column == operand
+                elif operator == "$ne":
+                    mask &= column != operand
+                elif operator == "$in":
+                    mask &= self._isin(column, operand)
+                elif operator == "$nin":
+                    mask &= ~self._isin(column, operand)
+                else:
+                    raise ValueError(f"Unsupported filter operator: {operator}")
+        return mask
+
+    def get_all_documents(self) -> Tuple[List[str], List[Document]]:
+        """
+        削除されていない全てのドキュメントのidとDocumentを取得する。
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, page_content, metadata_json FROM vectors WHERE deleted=0 ORDER BY row"
+            ).fetchall()
+        return [row[0] for row in rows], [Document(page_content=row[1], metadata=json.loads(row[2])) for row in rows]
+
+    def get_by_filter(self, filter: Optional[dict[str, Any]]) -> Tuple[List[str], List[dict[str, Any]]]:
+        """
+        filterに一致する削除されていないドキュメントのidとmetadataを取得する。
+        """
+        self._reload_if_needed()
+        with self._lock:
+            mask = self._create_filter_mask(filter) & ~self._deleted
+            rows = np.nonzero(mask)[0]
+            return [self._ids[row] for row in rows], [self._metadatas[row] for row in rows]
+
+    ########################################
+    # IVF
+    ########################################
+    def _assign_to_centroids(self, rows: np.ndarray) -> np.ndarray:
+        if self._ivf_centroids is None or len(rows) == 0:
+            return np.zeros(0, dtype=np.int32)
+        vectors = np.asarray(self._full_vectors[rows], dtype=np.float32)
+        return np.argmax(vectors @ self._ivf_centroids.T, axis=1).astype(np.int32)
+
+    def build_ivf_index(self, n_lists: int = 0, iterations: int = 10, sample_size: int = 100000) -> None:
+        """
+        球面k-meansでベクトルをn_lists個に分割し、IVFインデックスを作成する。
+        k-meansと割り当ての計算中はロックを保持しないため、作成中も検索・追加できる。
+
+        Args:
+            n_lists (int): リスト数。0以下の場合はsqrt(件数)
+            iterations (int): k-meansの反復回数
+            sample_size (int): セントロイドの学習に利用する最大件数
+        """
+        self._reload_if_needed()
+        with self._lock:
+            count = len(self._ids)
+            full_vectors = self._full_vectors
+            compactions = self._compactions
+        if count == 0:
+            return
+        if n_lists <= 0:
+            n_lists = max(1, int(np.sqrt(count)))
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(count, size=min(sample_size, count), replace=False))
+        sample = np.asarray(full_vectors[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=min(n_lists, len(sample)), replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=len(centroids))
+            # 空のクラスタは前回のセントロイドを維持する
+            non_empty = counts > 0
+            centroids[non_empty] = self._normalize(sums[non_empty])
+        assignments = np.concatenate([
+            np.argmax(np.asarray(full_vectors[i:i + self.search_block_size], dtype=np.float32) @ centroids.T, axis=1).astype(np.int32)
+            for i in range(0, count, self.search_block_size)
+        ])
+
+        # 世代番号を進めて、他プロセスにもIVFインデックスを読み直させる
+        with self._write_transaction():
+            if self._compactions != compactions:
+                # 計算中にcompactで行番号が変わった場合は破棄する(次回の検索で作り直す)
+                logger.info("IVF index discarded because the store was compacted during the build.")
+                return
+            self._ivf_centroids = centroids
+            added = self._assign_to_centroids(np.arange(count, len(self._ids)))
+            self._ivf_assignments = np.concatenate([assignments, added])
+            np.savez(self._get_ivf_file_path(), centroids=centroids, assignments=self._ivf_assignments)
+        logger.info(f"IVF index built. lists:{len(centroids)} vectors:{count}")
+
+    def _start_ivf_build(self) -> None:
+        # 検索を止めないよう、IVFインデックスはバックグラウンドのスレッドで作成する
+        with self._lock:
+            if self._ivf_thread is not None and self._ivf_thread.is_alive():
+                return
+            self._ivf_thread = threading.Thread(target=self._build_ivf_in_background, daemon=True)
+            self._ivf_thread.start()
+
+    def _build_ivf_in_background(self) -> None:
+        try:
+            self.build_ivf_index()
+        except Exception as e:
+            logger.error(f"IVF index build failed: {e}")
+
+    ########################################
+    # 検索
+    ########################################
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # 正規化済みベクトルの内積(コサイン類似度)をそのまま関連度として扱う
+        return lambda score: score
+
+    def search_by_vector(self, embedding: List[float], k: int = 4, filter: Optional[dict[str, Any]] = None, ivf_probes: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        ベクトルで検索し、(行番号, コサイン類似度)のリストを返す。
+        """
+        self._reload_if_needed()
+        with self._lock:
+            vectors, full_vectors, scales = self._vectors, self._full_vectors, self._scales
+            # float32のファイルを保持していない場合は再スコアリングしない
+            rescore = self.vector_dtype != "float32" and self.keep_full_precision
+            count = len(self._ids)
+            if count == 0:
+                return []
+            query = self._normalize(np.asarray([embedding], dtype=np.float32))[0]
+            mask = self._create_filter_mask(filter) & ~self._deleted[:count]
+
+            # 件数が多い場合はIVFで探索対象のリストを絞り込む。インデックスの作成中は全件検索する
+            if count >= self.ivf_min_vectors and self._ivf_centroids is None:
+                self._start_ivf_build()
+            if self._ivf_centroids is not None and count >= self.ivf_min_vectors:
+                probes = min(ivf_probes or self.ivf_probes, len(self._ivf_centroids))
+                nearest_lists = np.argpartition(-(self._ivf_centroids @ query), probes - 1)[:probes]
+                ivf_mask = mask & np.isin(self._ivf_assignments[:count], nearest_lists)
+                # filterで絞り込んだ行が探索するリストにk件ない場合は、filterに一致する全件を検索する
+                if np.count_nonzero(ivf_mask) >= k:
+                    mask = ivf_mask
+
+        candidates = np.nonzero(mask)[0]
+        if len(candidates) == 0:
+            return []
+        scores = self.compute_scores(vectors, scales, candidates, query)
+        if not rescore:
+            top = self.select_top_k(scores, k)
+            return [(int(candidates[i]), float(scores[i])) for i in top]
+
+        # 量子化している場合は上位の候補をfloat32で再スコアリングする
+        rescore_rows = np.sort(candidates[self.select_top_k(scores, k * self.rescore_multiplier)])
+        exact_scores = self.compute_scores(full_vectors, None, rescore_rows, query)
+        top = self.select_top_k(exact_scores, k)
+        return [(int(rescore_rows[i]), float(exact_scores[i])) for i in top]
+
+    def _get_documents_by_rows(self, rows: List[int]) -> dict[int, Document]:
+        documents: dict[int, Document] = {}
+        with self._lock:
+            for i in range(0, len(rows), self.sql_batch_size):
+                batch = rows[i:i + self.sql_batch_size]
+                placeholders = ",".join("?" * len(batch))
+                for row, page_content, metadata_json in self._conn.execute(
+                        f"SELECT row, page_content, metadata_json FROM vectors WHERE row IN ({placeholders})", batch):
+                    documents[row] = Document(page_content=page_content, metadata=json.loads(metadata_json))
+        return documents
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4, filter: Optional[dict[str, Any]] = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        results = self.search_by_vector(embedding, k=k, filter=filter, ivf_probes=kwargs.get("ivf_probes", None))
+        documents = self._get_documents_by_rows([row for row, _ in results])
+        return [(documents[row], score) for row, score in results if row in documents]
+
+    def similarity_search_with_embeddings(self, embedding: List[float], k: int = 4, filter: Optional[dict[str, Any]] = None) -> List[Tuple[Document, float, List[float]]]:
+        """
+        ベクトルで検索し、(Document, コサイン類似度, 保存されているEmbedding)のリストを返す。
+        """
+        results = self.search_by_vector(embedding, k=k, filter=filter)
+        rows = [row for row, _ in results]
+        documents = self._get_documents_by_rows(rows)
+        with self._lock:
+            vectors = np.asarray(self._full_vectors[rows], dtype=np.float32) if len(rows) > 0 else np.zeros((0, self.dim))
+        return [
+            (documents[row], score, vector.tolist())
+            for (row, score), vector in zip(results, vectors) if row in documents
+        ]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict[str, Any]] = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        if self.embedding is None:
+            raise ValueError("embedding is None")
+        embedding = self.embedding.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k=k, filter=filter, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
+
+    def create_precision_report(
+            self, k: int = 10, num_queries: int = 100, max_vectors: int = 0,
+            vector_dtypes: Iterable[str] = ("float32", "float16", "int8")) -> dict[str, Any]:
+        """
+        保存済みのベクトルを使って、精度毎のrecall@kと検索時間、メモリ使用量、ディスク使用量を比較する。
+        クエリには保存済みのベクトルにノイズを加えたものを使い、float32の全件検索の結果を正解とする。
+        (float32のファイルを保持していない場合は、量子化済みのベクトルを戻したものを正解とする)
+        memory_bytesは検索で読み込むベクトル、disk_bytesは再スコアリング用のfloat32のファイルを含む保存に必要なサイズ。
+
+        Args:
+            k (int): 取得件数
+            num_queries (int): クエリ数
+            max_vectors (int): 対象とする最大件数。0以下の場合は全件
+            vector_dtypes (Iterable[str]): 比較する型
+
+        Returns:
+            dict[str, Any]: 型毎(int8/float16は再スコアリングの有無毎)の集計結果と、現在のコレクションのディスク使用量
+        """
+        self._reload_if_needed()
+        with self._lock:
+            full_vectors = self._full_vectors
+            rows = np.nonzero(~self._deleted)[0]
+        if max_vectors > 0:
+            rows = rows[:max_vectors]
+        if len(rows) == 0:
+            return {"vectors": 0, "results": []}
+
+        rng = np.random.default_rng(0)
+        query_rows = rng.choice(rows, size=min(num_queries, len(rows)), replace=False)
+        queries = np.asarray(full_vectors[np.sort(query_rows)], dtype=np.float32)
+        queries = self._normalize(queries + rng.normal(0, 0.02, size=queries.shape).astype(np.float32))
+        ground_truth = [set(rows[self.select_top_k(self.compute_scores(full_vectors, None, rows, query), k)]) for query in queries]
+
+        results: list[dict[str, Any]] = []
+        for vector_dtype in vector_dtypes:
+            # 比較対象の型のベクトルをメモリ上に作成する
+            quantized_blocks, scale_blocks = [], []
+            for i in range(0, len(rows), self.search_block_size):
+                block = np.asarray(full_vectors[rows[i:i + self.search_block_size]], dtype=np.float32)
+                quantized, scales = self.quantize(block, vector_dtype)
+                quantized_blocks.append(quantized)
+                if scales is not None:
+                    scale_blocks.append(scales)
+            vectors = np.concatenate(quantized_blocks)
+            scales_array = np.concatenate(scale_blocks) if scale_blocks else None
+            positions = np.arange(len(rows))
+
+            for rescore in ([False] if vector_dtype == "float32" else [False, True]):
+                latencies: list[float] = []
+                recalls: list[float] = []
+                for query, expected in zip(queries, ground_truth):
+                    start = time.perf_counter()
+                    scores = self.compute_scores(vectors, scales_array, positions, query)
+                    if rescore:
+                        candidates = np.sort(self.select_top_k(scores, k * self.rescore_multiplier))
+                        exact_scores = self.compute_scores(full_vectors, None, rows[candidates], query)
+                        found = rows[candidates[self.select_top_k(exact_scores, k)]]
+                    else:
+                        found = rows[self.select_top_k(scores, k)]
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    recalls.append(len(expected & set(found)) / max(len(expected), 1))
+                memory_bytes = vectors.nbytes + (scales_array.nbytes if scales_array is not None else 0)
+                full_precision_bytes = len(rows) * self.dim * 4
+                # 再スコアリングする場合は量子化ファイルに加えてfloat32のファイルも保存する
+                disk_bytes = memory_bytes + (full_precision_bytes if rescore else 0)
+                results.append({
+                    "vector_dtype": vector_dtype,
+                    "rescore": rescore,
+                    f"recall_at_{k}": float(np.mean(recalls)),
+                    "latency_p50_ms": float(np.percentile(latencies, 50)),
+                    "latency_p95_ms": float(np.percentile(latencies, 95)),
+                    "memory_bytes": int(memory_bytes),
+                    "memory_ratio": float(memory_bytes / full_precision_bytes),
+                    "disk_bytes": int(disk_bytes),
+                    "disk_ratio": float(disk_bytes / full_precision_bytes),
+                })
+        disk_usage = self.get_disk_usage()
+        return {
+            "vectors": int(len(rows)), "dim": self.dim, "k": k, "queries": len(queries), "results": results,
+            "vector_dtype": self.vector_dtype, "keep_full_precision": self.keep_full_precision,
+            "disk_usage": disk_usage, "disk_bytes": int(sum(disk_usage.values())),
+        }
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, **kwargs: Any) -> "NumpyVectorStore":
+        path = kwargs.pop("path")
+        store = cls(path=path, embedding=embedding, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
+
+
+class LangChainVectorDBNumpy(LangChainVectorDB):
+    """
+    NumpyVectorStoreを利用するLangChainVectorDB。vector_db_urlはベクトルを保存するディレクトリ。
+    """
+    vector_precision: str = Field(default="float32", description="ベクトルの保存精度(float32/float16/int8)")
+
+    def model_post_init(self, __context: Any) -> None:
+        self.db = self._load()
+
+        if self.doc_store_url:
+            self.doc_store = SQLDocStore.from_url(self.doc_store_url)
+        else:
+            logger.info("doc_store_url is None")
+
+    def _load(self) -> VectorStore:
+        path = os.path.join(self.vector_db_url, self.collection_name or "default")
+        logger.info(f"numpy vector store path:{path}")
+        return NumpyVectorStore(
+            path=path,
+            embedding=self.langchain_openai_client.get_embedding_client(),
+            vector_dtype=self.vector_precision,
+            ivf_min_vectors=int(os.getenv("NUMPY_VECTOR_DB_IVF_MIN_VECTORS", "50000")),
+            ivf_probes=int(os.getenv("NUMPY_VECTOR_DB_IVF_PROBES", "8")),
+            keep_full_precision=self.get_keep_full_precision_setting(),
+        )
+
+    @classmethod
+    def get_keep_full_precision_setting(cls) -> Optional[bool]:
+        # float16/int8の場合に再スコアリング用のfloat32のファイルを保持するか。未設定の場合はコレクションの既存の設定を利用する
+        value = os.getenv("NUMPY_VECTOR_DB_KEEP_FULL_PRECISION", "")
+        if not value:
+            return None
+        return value.lower() in ("1", "true", "yes")
+
+    async def _similarity_search_with_relevance_scores(self, query: str, search_kwargs: dict) -> List[Tuple[Document, float]]:
+        # search_kwargsのprobesはIVFの探索リスト数として利用する
+        search_kwargs = dict(search_kwargs)
+        probes = search_kwargs.pop(self.probes_key, None)
+        if probes:
+            search_kwargs["ivf_probes"] = int(probes)
+        return await super()._similarity_search_with_relevance_scores(query, search_kwargs)
+
+    def _get_document_ids_by_tag(self, name: str = "", value: str = "") -> Tuple[List, List]:
+        if not isinstance(self.db, NumpyVectorStore):
+            raise ValueError("db is not NumpyVectorStore")
+        return self.db.get_by_filter({name: value})
+
+    def _get_document_ids_by_folder_ids(self, folder_ids: List[str]) -> Tuple[List, List]:
+        if not isinstance(self.db, NumpyVectorStore):
+            raise ValueError("db is not NumpyVectorStore")
+        return self.db.get_by_filter({"folder_id": {"$in": folder_ids}})
+
+    def _update_metadatas(self, ids: List[str], metadatas: List[dict[str, Any]], removed_keys: Optional[List[List[str]]] = None):
+        # metadataは置き換えのため、removed_keysは利用しない
+        if not isinstance(self.db, NumpyVectorStore):
+            raise ValueError("db is not NumpyVectorStore")
+        self.db.update_metadatas(ids, metadatas)
+
+    def compact(self) -> dict[str, int]:
+        """
+        論理削除した行を取り除く。削除・更新が多いコレクションで定期的に実行する。
+        """
+        if not isinstance(self.db, NumpyVectorStore):
+            raise ValueError("db is not NumpyVectorStore")
+        return self.db.compact()
+
+    def get_collection_dimension(self) -> int:
+        if not isinstance(self.db, NumpyVectorStore):
+            raise ValueError("db is not NumpyVectorStore")
+        self.db._reload_if_needed()
+        return self.db.dim
+
+    def get_all_documents(self) -> Tuple[List[str], List[Document]]:
+        if not isinstance(self.db, NumpyVectorStore):
+            raise ValueError("db is not NumpyVectorStore")
+        return self.db.get_all_documents()
+
+    def _add_embeddings(self, ids: List[str], documents: List[Document], embeddings: List[List[float]]):
+        if not isinstance(self.db, NumpyVectorStore):
+            raise ValueError("db is not NumpyVectorStore")
+        self.db.add_vectors(
+            embeddings, [doc.page_content for doc in documents], [doc.metadata for doc in documents], ids
+        )
+
+    def _similarity_search_with_embeddings(self, query_embedding: List[float], k: int, filter: Optional[dict] = None) -> List[Tuple[Document, float, List[float]]]:
+        if not isinstance(self.db, NumpyVectorStore):
+            raise ValueError("db is not NumpyVectorStore")
+        return self.db.similarity_search_with_embeddings(query_embedding, k=k, filter=filter)
@@ -1,25 +1,53 @@
 
-from typing import Any, Sequence, Tuple, List
+import re
+import json
+import os
+import uuid
+import asyncio
+import hashlib
+import threading
+from typing import Any, Callable, ClassVar, Optional, Sequence, Tuple, List
 
 from langchain_postgres import PGVector
 from langchain_postgres.vectorstores import PGVector
 from sqlalchemy.orm import Session
 import sqlalchemy
-from sqlalchemy.sql import text
+from sqlalchemy.sql import text, bindparam
 from langchain_core.vectorstores import VectorStore
+from langchain_core.documents import Document
 from ai_chat_lib.langchain_modules.langchain_vector_db import LangChainVectorDB
 from ai_chat_lib.langchain_modules.langchain_doc_store import SQLDocStore
+from ai_chat_lib.langchain_modules.sql_engine_pool import SQLEnginePool
+from ai_chat_lib.langchain_modules.vector_search_executor import VectorSearchExecutor
+from ai_chat_lib.db_modules.content_folder import ContentFolder
 
 import ai_chat_lib.log_modules.log_settings as log_settings
 logger = log_settings.getLogger(__name__)
     
+class UnsupportedMetadataFilterError(NotImplementedError):
+    """
+    SQLに変換できないmetadataのfilter。NotImplementedErrorのため、MMRの検索では類似度検索にフォールバックする
+    """
+
+
 class LangChainVectorDBPGVector(LangChainVectorDB):
 
+    # 式インデックスを作成するmetadataのキー(SQLにリテラルとして埋め込むため固定値のみ)
+    indexed_metadata_keys: ClassVar[tuple[str, ...]] = ("source_id", "folder_id")
+    # 1回のDELETEで削除する最大件数
+    delete_batch_size: ClassVar[int] = 500
+    # インデックスを作成済みのURL
+    indexed_urls: ClassVar[set[str]] = set()
+    indexed_urls_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    # ANNインデックスの種類
+    ann_index_methods: ClassVar[tuple[str, ...]] = ("hnsw", "ivfflat")
+
     def model_post_init(self, __context: Any) -> None:
         self.db = self._load()
         if self.doc_store_url:
             logger.info("doc_store_url:", self.doc_store_url)
-            self.doc_store = SQLDocStore(self.doc_store_url)
+            self.doc_store = SQLDocStore.from_url(self.doc_store_url)
         else:
             logger.info("doc_store_url is None")
 
@@ -27,7 +55,8 @@ class LangChainVectorDBPGVector(LangChainVectorDB):
 
         # params
         params: dict[str, Any] = {}
-        params["connection"] = self.vector_db_url
+        # URL毎に共有するコネクションプールを利用する
+        params["connection"] = SQLEnginePool.get_engine(self.vector_db_url)
         params["embeddings"] = self.langchain_openai_client.get_embedding_client()
         params["use_jsonb"] = True
         
@@ -39,24 +68,399 @@ class LangChainVectorDBPGVector(LangChainVectorDB):
         db: VectorStore = PGVector(
             **params
             )
+        self._ensure_metadata_indexes()
         return db
 
+    def _ensure_metadata_indexes(self):
+        # source_id, folder_idによる検索・削除がテーブル全体のスキャンにならないよう、式インデックスを作成する
+        # 作成中は同じURLの作成を待たせ、コミットに成功した場合のみ作成済みとする(失敗した場合は次回のインスタンス作成時に再試行する)
+        with self.indexed_urls_lock:
+            if self.vector_db_url in self.indexed_urls:
+                return
+            engine = SQLEnginePool.get_engine(self.vector_db_url)
+            try:
+                with engine.begin() as conn:
+                    for key in self.indexed_metadata_keys:
+                        conn.execute(text(
+                            f"create index if not exists ix_langchain_pg_embedding_{key} "
+                            f"on langchain_pg_embedding (collection_id, (cmetadata->>'{key}'))"
+                        ))
+            except Exception as e:
+                logger.warning(f"Failed to create metadata indexes: {e}")
+                return
+            self.indexed_urls.add(self.vector_db_url)
+
     def _get_document_ids_by_tag(self, name:str="", value:str="") -> Tuple[List, List]:
-        engine = sqlalchemy.create_engine(self.vector_db_url)
-        with Session(engine) as session:
-            stmt = text("select uuid from langchain_pg_collection where name=:name")
-            stmt = stmt.bindparams(name=self.collection_name)
-            rows  = session.execute(stmt).fetchone()
-            if rows is None or len(rows) == 0:
-                return [], []
-            collection_id = rows[0]
-            logger.info(collection_id)
-            stmt = text("select id, cmetadata from langchain_pg_embedding where collection_id=:collection_id and cmetadata->>:name=:value")
-            stmt = stmt.bindparams(collection_id=collection_id, name=name, value=value)
-            rows2: Sequence[Any] = session.execute(stmt).all() 
-            document_ids = [row[0] for row in rows2]
-            metadata_list = [row[1] for row in rows2]
-            
+        if name in self.indexed_metadata_keys:
+            # 式インデックスを利用するため、キーはリテラルで指定する
+            condition = f"e.cmetadata->>'{name}' = :value"
+            params: dict[str, Any] = {"value": value}
+        else:
+            # それ以外のキーはcmetadataのGINインデックス(jsonb_path_ops)を利用する
+            condition = "e.cmetadata @> cast(:metadata as jsonb)"
+            params = {"metadata": json.dumps({name: value})}
+        stmt = text(
+            "select e.id, e.cmetadata from langchain_pg_embedding e "
+            "join langchain_pg_collection c on e.collection_id = c.uuid "
+            f"where c.name=:name and {condition}"
+        )
+        with Session(SQLEnginePool.get_engine(self.vector_db_url)) as session:
+            rows: Sequence[Any] = session.execute(stmt.bindparams(name=self.collection_name, **params)).all()
+            document_ids = [row[0] for row in rows]
+            metadata_list = [row[1] for row in rows]
             return document_ids, metadata_list
 
+    async def _delete(self, doc_ids:list=[]):
+        # 同期モードのPGVectorはadeleteを利用できないため、バッチ毎に同期APIをスレッドで実行する
+        if len(doc_ids) == 0:
+            return
+        if self.db is None:
+            raise ValueError("db is None")
+        db = self.db
+        for i in range(0, len(doc_ids), self.delete_batch_size):
+            batch = doc_ids[i:i + self.delete_batch_size]
+            await asyncio.to_thread(db.delete, ids=batch)
+        return len(doc_ids)
+
+    def _get_document_ids_by_folder_ids(self, folder_ids: List[str]) -> Tuple[List, List]:
+        # folder_idの式インデックスを利用してIN句でまとめて検索する
+        stmt = text(
+            "select e.id, e.cmetadata from langchain_pg_embedding e "
+            "join langchain_pg_collection c on e.collection_id = c.uuid "
+            "where c.name=:name and e.cmetadata->>'folder_id' in :folder_ids"
+        ).bindparams(bindparam("folder_ids", expanding=True))
+        with Session(SQLEnginePool.get_engine(self.vector_db_url)) as session:
+            rows: Sequence[Any] = session.execute(stmt, {"name": self.collection_name, "folder_ids": folder_ids}).all()
+            return [row[0] for row in rows], [row[1] for row in rows]
+
+    async def _delete_folders(self, folder_ids: List[str], progress_callback: Optional[Callable[[int, int, int], None]] = None) -> dict[str, int]:
+        return await asyncio.to_thread(self._delete_folders_in_transaction, folder_ids, progress_callback)
+
+    def _delete_folders_in_transaction(self, folder_ids: List[str], progress_callback: Optional[Callable[[int, int, int], None]] = None) -> dict[str, int]:
+        # 全てのバッチのDELETEを1つのトランザクションで実行する。
+        # DocStoreが同じデータベースの場合は、DocStoreの削除も同じトランザクションで行う
+        doc_store: Optional[SQLDocStore] = self.doc_store if self.doc_store_url else None
+        same_database = doc_store is not None and self.doc_store_url == self.vector_db_url
+        stmt = text(
+            "delete from langchain_pg_embedding e using langchain_pg_collection c "
+            "where e.collection_id = c.uuid and c.name=:name and e.cmetadata->>'folder_id' in :folder_ids "
+            "returning e.cmetadata->>'doc_id'"
+        ).bindparams(bindparam("folder_ids", expanding=True))
+        vectors = 0
+        doc_store_keys: List[str] = []
+        with SQLEnginePool.get_engine(self.vector_db_url).begin() as connection:
+            for i in range(0, len(folder_ids), self.delete_folder_batch_size):
+                batch = folder_ids[i:i + self.delete_folder_batch_size]
+                rows = connection.execute(stmt, {"name": self.collection_name, "folder_ids": batch}).all()
+                vectors += len(rows)
+                batch_keys = list(dict.fromkeys(row[0] for row in rows if row[0]))
+                if same_database and doc_store is not None:
+                    doc_store.mdelete_with_connection(connection, batch_keys)
+                doc_store_keys.extend(batch_keys)
+                if progress_callback is not None:
+                    progress_callback(i + len(batch), len(folder_ids), vectors)
+        if doc_store is not None and not same_database:
+            # 別のデータベースのDocStoreはベクトルの削除をコミットした後に削除する
+            doc_store.mdelete(doc_store_keys)
+        return {"folders": len(folder_ids), "vectors": vectors, "documents": len(doc_store_keys) if doc_store is not None else 0}
+
+    def _update_metadatas(self, ids: List[str], metadatas: List[dict[str, Any]], removed_keys: Optional[List[List[str]]] = None):
+        # embedding列は変更せず、cmetadataのみを1つのトランザクションで置き換える(置き換えのため、removed_keysは利用しない)
+        stmt = text("update langchain_pg_embedding set cmetadata = cast(:metadata as jsonb) where id = :id")
+        with SQLEnginePool.get_engine(self.vector_db_url).begin() as connection:
+            connection.execute(stmt, [
+                {"id": id, "metadata": json.dumps(metadata, ensure_ascii=False)} for id, metadata in zip(ids, metadatas)
+            ])
+
+    def get_collection_dimension(self) -> int:
+        with Session(SQLEnginePool.get_engine(self.vector_db_url)) as session:
+            stmt = text(
+                "select vector_dims(e.embedding) from langchain_pg_embedding e "
+                "join langchain_pg_collection c on e.collection_id = c.uuid where c.name=:name limit 1"
+            )
+            row = session.execute(stmt.bindparams(name=self.collection_name)).fetchone()
+            return int(row[0]) if row is not None else 0
+
+    def get_all_documents(self) -> Tuple[List[str], List[Document]]:
+        with Session(SQLEnginePool.get_engine(self.vector_db_url)) as session:
+            stmt = text(
+                "select e.id, e.document, e.cmetadata from langchain_pg_embedding e "
+                "join langchain_pg_collection c on e.collection_id = c.uuid where c.name=:name order by e.id"
+            )
+            rows: Sequence[Any] = session.execute(stmt.bindparams(name=self.collection_name)).all()
+            ids = [row[0] for row in rows]
+            documents = [Document(page_content=row[1] or "", metadata=row[2] or {}) for row in rows]
+            return ids, documents
+
+    def _add_embeddings(self, ids: List[str], documents: List[Document], embeddings: List[List[float]]):
+        self.db.add_embeddings( # type: ignore
+            texts=[doc.page_content for doc in documents],
+            embeddings=embeddings,
+            metadatas=[doc.metadata for doc in documents],
+            ids=ids,
+        )
+
+    # 比較演算子 -> SQLの演算子
+    filter_comparison_operators: ClassVar[dict[str, str]] = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+    @classmethod
+    def _to_metadata_text(cls, value: Any) -> str:
+        # cmetadata->>'key'と同じ文字列表現にする(boolはJSONのtrue/false)
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        return str(value)
+
+    @classmethod
+    def _add_filter_param(cls, params: dict[str, Any], value: Any) -> str:
+        name = f"p{len(params)}"
+        params[name] = value
+        return f":{name}"
+
+    @classmethod
+    def _create_metadata_filter_sql(cls, filter: Optional[dict], params: dict[str, Any]) -> str:
+        """
+        Chroma形式のfilterをcmetadataの条件式に変換する。キーは英数字のみ許可する。
+        対応する演算子: $and, $or, $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin
+        変換できない演算子の場合はUnsupportedMetadataFilterErrorを発生させる(呼び出し元はPGVectorの検索にフォールバックする)
+        """
+        if not filter:
+            return ""
+        conditions: list[str] = []
+        for key, value in filter.items():
+            if key in ("$and", "$or"):
+                # 空のfilterは全件に一致する。空のリストは$andでは真、$orでは偽として扱う
+                sub_conditions = [f"({cls._create_metadata_filter_sql(sub_filter, params) or 'true'})" for sub_filter in value]
+                if len(sub_conditions) == 0:
+                    sub_conditions = ["true" if key == "$and" else "false"]
+                conditions.append("(" + (" and " if key == "$and" else " or ").join(sub_conditions) + ")")
+                continue
+            if key.startswith("$"):
+                raise UnsupportedMetadataFilterError(f"Unsupported filter operator: {key}")
+            if not re.fullmatch(r"\w+", key):
+                raise ValueError(f"Invalid metadata key: {key}")
+            if not isinstance(value, dict):
+                value = {"$eq": value}
+            for operator, operand in value.items():
+                conditions.append(cls._create_metadata_condition_sql(key, operator, operand, params))
+        return " and ".join(conditions)
+
+    @classmethod
+    def _create_metadata_condition_sql(cls, key: str, operator: str, operand: Any, params: dict[str, Any]) -> str:
+        column = f"e.cmetadata->>'{key}'"
+        if operator == "$eq":
+            if key.startswith(ContentFolder.folder_ancestor_key_prefix):
+                # 祖先フォルダのキーは式インデックスを作成しないため、cmetadataのGINインデックスを利用する
+                name = cls._add_filter_param(params, json.dumps({key: str(operand)}))
+                return f"e.cmetadata @> cast({name} as jsonb)"
+            return f"{column} = {cls._add_filter_param(params, cls._to_metadata_text(operand))}"
+        if operator == "$ne":
+            return f"{column} <> {cls._add_filter_param(params, cls._to_metadata_text(operand))}"
+        if operator in ("$in", "$nin"):
+            names = [cls._add_filter_param(params, cls._to_metadata_text(item)) for item in operand]
+            if len(names) == 0:
+                return "false" if operator == "$in" else f"{column} is not null"
+            return f"{column} {'in' if operator == '$in' else 'not in'} ({', '.join(names)})"
+        if operator in cls.filter_comparison_operators:
+            sql_operator = cls.filter_comparison_operators[operator]
+            if isinstance(operand, (int, float)) and not isinstance(operand, bool):
+                # 数値以外の値でキャストが失敗しないよう、caseで数値の場合のみ比較する
+                name = cls._add_filter_param(params, float(operand))
+                return f"(case when jsonb_typeof(e.cmetadata->'{key}') = 'number' then ({column})::float end) {sql_operator} {name}"
+            if isinstance(operand, str):
+                return f"{column} {sql_operator} {cls._add_filter_param(params, operand)}"
+        raise UnsupportedMetadataFilterError(f"Unsupported filter operator: {operator} {operand!r}")
+
+    def _get_collection_id(self) -> Optional[str]:
+        with Session(SQLEnginePool.get_engine(self.vector_db_url)) as session:
+            row = session.execute(
+                text("select uuid from langchain_pg_collection where name=:name").bindparams(name=self.collection_name)
+            ).fetchone()
+            return str(row[0]) if row is not None else None
+
+    def _query_collection(
+            self, query_embedding: List[float], k: int, filter: Optional[dict] = None, include_embeddings: bool = False,
+            ef_search: Optional[int] = None, probes: Optional[int] = None) -> List[Tuple[Document, float, Optional[List[float]]]]:
+        """
+        コサイン距離でコレクションを検索する。ANNインデックスの式(embedding::vector(次元数))と同じ式で並べ替えるため、
+        インデックスがある場合はインデックススキャンになる。
+
+        Args:
+            query_embedding (List[float]): クエリのEmbedding
+            k (int): 取得件数
+            filter (Optional[dict]): metadataのfilter
+            include_embeddings (bool): Trueの場合は保存されているEmbeddingも返す
+            ef_search (Optional[int]): HNSWの探索幅(hnsw.ef_search)
+            probes (Optional[int]): IVFFlatの探索リスト数(ivfflat.probes)
+
+        Returns:
+            List[Tuple[Document, float, Optional[List[float]]]]: Document, 関連度(1 - コサイン距離), Embedding
+        """
+        collection_id = self._get_collection_id()
+        if collection_id is None:
+            return []
+        dimension = len(query_embedding)
+        params: dict[str, Any] = {"collection_id": collection_id, "embedding": json.dumps(query_embedding), "k": k}
+        filter_sql = self._create_metadata_filter_sql(filter, params)
+        stmt = text(
+            f"select e.document, e.cmetadata, e.embedding::vector({dimension}) <=> cast(:embedding as vector({dimension})) as distance"
+            + (", e.embedding::text" if include_embeddings else "") +
+            " from langchain_pg_embedding e where e.collection_id = cast(:collection_id as uuid)"
+            + (f" and {filter_sql}" if filter_sql else "") +
+            " order by distance limit :k"
+        )
+        with Session(SQLEnginePool.get_engine(self.vector_db_url)) as session:
+            # SET LOCALはこのトランザクション内でのみ有効
+            if ef_search:
+                session.execute(text(f"set local hnsw.ef_search = {int(ef_search)}"))
+            if probes:
+                session.execute(text(f"set local ivfflat.probes = {int(probes)}"))
+            rows: Sequence[Any] = session.execute(stmt.bindparams(**params)).all()
+            session.rollback()
+        # PGVectorの既定はcosine距離のため、1 - 距離を関連度とする
+        return [
+            (Document(page_content=row[0] or "", metadata=row[1] or {}), 1.0 - float(row[2]),
+             json.loads(row[3]) if include_embeddings else None)
+            for row in rows
+        ]
+
+    def _similarity_search_with_embeddings(self, query_embedding: List[float], k: int, filter: Optional[dict] = None) -> List[Tuple[Document, float, List[float]]]:
+        return [
+            (doc, score, embedding or [])
+            for doc, score, embedding in self._query_collection(query_embedding, k, filter, include_embeddings=True)
+        ]
+
+    async def _similarity_search_with_relevance_scores(self, query: str, search_kwargs: dict) -> List[Tuple[Document, float]]:
+        # PGVectorの既定の検索はANNインデックスの式(embedding::vector(次元数))を利用しないため、インデックスの式に合わせたSQLで検索する
+        # (インデックスの有無は他のプロセスで変わるため、インデックスの有無に関わらず同じSQLを利用する)
+        search_kwargs = dict(search_kwargs)
+        ef_search = search_kwargs.pop(self.ef_search_key, None)
+        probes = search_kwargs.pop(self.probes_key, None)
+        try:
+            self._create_metadata_filter_sql(search_kwargs.get("filter", None), {})
+        except UnsupportedMetadataFilterError as e:
+            # SQLに変換できないfilterはPGVectorの検索で評価する(ef_search / probesは適用されない)
+            logger.warning(f"{e}. Using PGVector search.")
+            return await super()._similarity_search_with_relevance_scores(query, search_kwargs)
+
+        query_embedding = await self.langchain_openai_client.get_embedding_client().aembed_query(query)
+        results = await VectorSearchExecutor.run_in_executor(
+            self.get_collection_key(), self._query_collection, query_embedding, search_kwargs.get("k", 4),
+            search_kwargs.get("filter", None), False, ef_search, probes
+        )
+        score_threshold = search_kwargs.get("score_threshold", None)
+        return [
+            (doc, score) for doc, score, _ in results
+            if score_threshold is None or score >= score_threshold
+        ]
+
+    ########################################
+    # ANNインデックスの管理
+    ########################################
+    def get_ann_index_name(self, method: str) -> str:
+        # PostgreSQLの識別子の最大長(63)に収まるよう、コレクション名のハッシュを使用する
+        collection_hash = hashlib.sha1(self.collection_name.encode("utf-8")).hexdigest()[:12]
+        return f"ix_lpe_{method}_{collection_hash}"
+
+    def get_ann_indexes(self) -> List[dict[str, Any]]:
+        """
+        コレクションのANNインデックスの一覧を取得する。
+        """
+        names = [self.get_ann_index_name(method) for method in self.ann_index_methods]
+        with Session(SQLEnginePool.get_engine(self.vector_db_url)) as session:
+            rows: Sequence[Any] = session.execute(text(
+                "select i.indexname, i.indexdef, pg_relation_size(cast(i.indexname as regclass)), x.indisvalid "
+                "from pg_indexes i join pg_class c on c.relname = i.indexname join pg_index x on x.indexrelid = c.oid "
+                "where i.tablename = 'langchain_pg_embedding' and i.indexname in :names"
+            ).bindparams(sqlalchemy.bindparam("names", value=tuple(names), expanding=True))).all()
+        return [
+            {"name": row[0], "definition": row[1], "size_bytes": int(row[2]), "is_valid": bool(row[3])}
+            for row in rows
+        ]
+
+    def create_ann_index(self, method: str = "hnsw", m: int = 16, ef_construction: int = 64, lists: int = 0) -> str:
+        """
+        コレクションにHNSWまたはIVFFlatのインデックスを作成する。
+        langchain_pg_embeddingは全コレクションで共有のため、collection_idを条件とする部分インデックスを作成する。
+        書き込みを止めないようにCREATE INDEX CONCURRENTLYで作成する。
+
+        Args:
+            method (str): "hnsw" または "ivfflat"
+            m (int): HNSWの各ノードの最大接続数
+            ef_construction (int): HNSWの構築時の探索幅
+            lists (int): IVFFlatのリスト数。0以下の場合は件数から決める
+
+        Returns:
+            str: 作成したインデックス名
+        """
+        if method not in self.ann_index_methods:
+            raise ValueError(f"Invalid index method: {method}")
+        collection_id = self._get_collection_id()
+        dimension = self.get_collection_dimension()
+        if collection_id is None or dimension == 0:
+            raise ValueError(f"Collection is empty: {self.collection_name}")
+        # collection_idはDBから取得したUUIDのみをリテラルとして埋め込む
+        collection_id = str(uuid.UUID(collection_id))
+
+        if method == "hnsw":
+            options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+        else:
+            if lists <= 0:
+                with Session(SQLEnginePool.get_engine(self.vector_db_url)) as session:
+                    count = session.execute(text(
+                        "select count(*) from langchain_pg_embedding where collection_id = cast(:collection_id as uuid)"
+                    ).bindparams(collection_id=collection_id)).scalar() or 0
+                # pgvectorの推奨値: 100万件以下は件数/1000、それ以上はsqrt(件数)
+                lists = max(10, count // 1000) if count <= 1000000 else int(count ** 0.5)
+            options = f"lists = {int(lists)}"
+
+        index_name = self.get_ann_index_name(method)
+        engine = SQLEnginePool.get_engine(self.vector_db_url)
+        # CONCURRENTLYはトランザクション内で実行できないため、AUTOCOMMITで実行する
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            maintenance_work_mem = os.getenv("PGVECTOR_MAINTENANCE_WORK_MEM", "")
+            if maintenance_work_mem and re.fullmatch(r"\d+(kB|MB|GB)", maintenance_work_mem):
+                conn.execute(text(f"set maintenance_work_mem = '{maintenance_work_mem}'"))
+            # 前回の中断で無効なインデックスが残っている場合は削除する
+            conn.execute(text(f"drop index concurrently if exists {index_name}"))
+            logger.info(f"creating ANN index. name:{index_name} method:{method} options:{options}")
+            conn.execute(text(
+                f"create index concurrently {index_name} on langchain_pg_embedding "
+                f"using {method} ((embedding::vector({dimension})) vector_cosine_ops) with ({options}) "
+                f"where collection_id = '{collection_id}'"
+            ))
+        logger.info(f"ANN index created. name:{index_name}")
+        return index_name
+
+    def drop_ann_index(self, method: str) -> None:
+        if method not in self.ann_index_methods:
+            raise ValueError(f"Invalid index method: {method}")
+        engine = SQLEnginePool.get_engine(self.vector_db_url)
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"drop index concurrently if exists {self.get_ann_index_name(method)}"))
 
+    def get_ann_index_build_progress(self) -> List[dict[str, Any]]:
+        """
+        langchain_pg_embeddingで実行中のインデックス作成の進捗を取得する。
+        """
+        with Session(SQLEnginePool.get_engine(self.vector_db_url)) as session:
+            rows: Sequence[Any] = session.execute(text(
+                "select c.relname, p.phase, p.blocks_total, p.blocks_done, p.tuples_total, p.tuples_done "
+                "from pg_stat_progress_create_index p left join pg_class c on c.oid = p.index_relid "
+                "where p.relid = cast('langchain_pg_embedding' as regclass)"
+            )).all()
+        progress = []
+        for row in rows:
+            blocks_total, tuples_total = int(row[2] or 0), int(row[4] or 0)
+            if tuples_total > 0:
+                ratio = int(row[5] or 0) / tuples_total
+            elif blocks_total > 0:
+                ratio = int(row[3] or 0) / blocks_total
+            else:
+                ratio = 0.0
+            progress.append({
+                "index_name": row[0], "phase": row[1],
+                "blocks_total": blocks_total, "blocks_done": int(row[3] or 0),
+                "tuples_total": tuples_total, "tuples_done": int(row[5] or 0),
+                "progress": ratio,
+            })
+        return progress
@@ -0,0 +1,96 @@
+"""
+rank_fusion.py
+
+複数の検索結果リストを1つのランキングに統合するモジュール。
+- Reciprocal Rank Fusion (RRF)
+- 検索結果リスト毎のスコア正規化(min-max)
+"""
+
+import hashlib
+from typing import ClassVar
+
+from langchain_core.documents import Document
+
+
+class RankFusion:
+    """
+    スコアの尺度が異なる複数の検索結果を統合するクラス。
+    """
+
+    fusion_method_rrf: ClassVar[str] = "rrf"
+    fusion_method_score: ClassVar[str] = "score"
+    default_rrf_k: ClassVar[int] = 60
+
+    @classmethod
+    def get_document_key(cls, doc: Document) -> str:
+        # 同じチャンクが複数のリストに含まれる場合に1件として扱うためのキー
+        doc_id = doc.metadata.get("doc_id", "")
+        source_id = doc.metadata.get("source_id", "")
+        content_hash = hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+        return f"{source_id}:{doc_id}:{content_hash}"
+
+    @classmethod
+    def fuse(cls, ranked_lists: list[list[Document]], method: str = fusion_method_rrf, top_k: int = 0, rrf_k: int = default_rrf_k) -> list[Document]:
+        """
+        指定された方式で検索結果を統合する。
+
+        Args:
+            ranked_lists (list[list[Document]]): スコアの降順に並んだ検索結果のリスト
+            method (str): "rrf" または "score"
+            top_k (int): 返す件数。0以下の場合は全件
+            rrf_k (int): RRFの定数k
+
+        Returns:
+            list[Document]: metadata["fusion_score"]の降順に並んだドキュメント
+        """
+        if method == cls.fusion_method_rrf:
+            return cls.reciprocal_rank_fusion(ranked_lists, top_k=top_k, rrf_k=rrf_k)
+        elif method == cls.fusion_method_score:
+            return cls.normalized_score_fusion(ranked_lists, top_k=top_k)
+        else:
+            raise ValueError(f"Invalid fusion method: {method}")
+
+    @classmethod
+    def reciprocal_rank_fusion(cls, ranked_lists: list[list[Document]], top_k: int = 0, rrf_k: int = default_rrf_k) -> list[Document]:
+        # 各リストでの順位rに対して 1 / (rrf_k + r) を合計する
+        fused_scores: dict[str, float] = {}
+        documents: dict[str, Document] = {}
+        for ranked_list in ranked_lists:
+            for rank, doc in enumerate(ranked_list, start=1):
+                key = cls.get_document_key(doc)
+                fused_scores[key] = fused_scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+                documents.setdefault(key, doc)
+        return cls._sort(documents, fused_scores, top_k)
+
+    @classmethod
+    def normalized_score_fusion(cls, ranked_lists: list[list[Document]], top_k: int = 0) -> list[Document]:
+        # リスト毎にscoreを0-1に正規化し、同じドキュメントは最大値を採用する
+        fused_scores: dict[str, float] = {}
+        documents: dict[str, Document] = {}
+        for ranked_list in ranked_lists:
+            if len(ranked_list) == 0:
+                continue
+            scores = [float(doc.metadata.get("score", 0.0) or 0.0) for doc in ranked_list]
+            min_score = min(scores)
+            max_score = max(scores)
+            for doc, score in zip(ranked_list, scores):
+                if max_score > min_score:
+                    normalized = (score - min_score) / (max_score - min_score)
+                else:
+                    normalized = 1.0
+                key = cls.get_document_key(doc)
+                fused_scores[key] = max(fused_scores.get(key, 0.0), normalized)
+                documents.setdefault(key, doc)
+        return cls._sort(documents, fused_scores, top_k)
+
+    @classmethod
+    def _sort(cls, documents: dict[str, Document], fused_scores: dict[str, float], top_k: int) -> list[Document]:
+        keys = sorted(fused_scores.keys(), key=lambda key: fused_scores[key], reverse=True)
+        if top_k > 0:
+            keys = keys[:top_k]
+        result: list[Document] = []
+        for key in keys:
+            doc = documents[key]
+            doc.metadata["fusion_score"] = fused_scores[key]
+            result.append(doc)
+        return result
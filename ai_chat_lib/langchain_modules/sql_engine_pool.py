@@ -0,0 +1,67 @@
+"""
+sql_engine_pool.py
+
+データベースURL毎にSQLAlchemyのEngine(コネクションプール)をプロセス内で共有するモジュール。
+- リクエスト毎にcreate_engineを呼び出すと、その都度コネクションの確立が発生するため、Engineを再利用する
+- プールのサイズは環境変数で設定する
+"""
+
+import os
+import threading
+from typing import Any, ClassVar
+
+import sqlalchemy
+from sqlalchemy.engine import Engine
+
+import ai_chat_lib.log_modules.log_settings as log_settings
+logger = log_settings.getLogger(__name__)
+
+
+class SQLEnginePool:
+    """
+    URL毎のEngineを保持するクラス。スレッドセーフ。
+    """
+
+    _engines: ClassVar[dict[str, Engine]] = {}
+    _lock: ClassVar[threading.Lock] = threading.Lock()
+
+    @classmethod
+    def get_engine_args(cls, url: str) -> dict[str, Any]:
+        # SQLiteはファイル単位のロックのため、プールの設定は既定値を使用する
+        if url.startswith("sqlite"):
+            return {}
+        return {
+            "pool_size": int(os.getenv("SQL_ENGINE_POOL_SIZE", "5")),
+            "max_overflow": int(os.getenv("SQL_ENGINE_MAX_OVERFLOW", "10")),
+            "pool_recycle": int(os.getenv("SQL_ENGINE_POOL_RECYCLE_SEC", "1800")),
+            "pool_pre_ping": True,
+        }
+
+    @classmethod
+    def get_engine(cls, url: str) -> Engine:
+        """
+        URLに対応する共有のEngineを取得する。存在しない場合は作成する。
+
+        Args:
+            url (str): データベースのURL
+
+        Returns:
+            Engine: 共有のEngine
+        """
+        with cls._lock:
+            engine = cls._engines.get(url, None)
+            if engine is None:
+                engine = sqlalchemy.create_engine(url, **cls.get_engine_args(url))
+                cls._engines[url] = engine
+                logger.info(f"SQL engine created. dialect:{engine.dialect.name}")
+            return engine
+
+    @classmethod
+    def dispose_all(cls) -> None:
+        """
+        全てのEngineのコネクションを閉じる。
+        """
+        with cls._lock:
+            for engine in cls._engines.values():
+                engine.dispose()
+            cls._engines.clear()
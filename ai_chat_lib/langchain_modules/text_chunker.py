@@ -0,0 +1,202 @@
+"""
+text_chunker.py
+
+Embedding用にテキストをトークン数でチャンクに分割するモジュール。
+- チャンクのサイズは文字数ではなく、Embeddingモデルのトークン数で指定する
+- 日本語(。！？)と英語(. ! ?)の文末、改行を区切りとして、文の途中で分割しない
+- 1文がチャンクのサイズを超える場合のみ、トークンの位置で分割する
+- 大きな入力は段落単位のセグメントに分け、プロセスプールで並列に分割する
+- aiter_chunksは分割済みのセグメントから順にチャンクを返すため、分割の完了を待たずにEmbeddingを開始できる
+"""
+
+import os
+import re
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Any, AsyncIterator, ClassVar, Optional
+
+import ai_chat_lib.log_modules.log_settings as log_settings
+logger = log_settings.getLogger(__name__)
+
+# 文末(句点・感嘆符・疑問符と、それに続く閉じ括弧)または改行までを1文とする
+_SENTENCE_PATTERN = re.compile(r'(?:[^。．！？!?\n.]|\.(?!\s))*(?:[。．！？!?]+[」』）)】"\']*|\.(?=\s)|\n+|$)')
+
+
+class _CharEncoder:
+    """
+    tiktokenを利用できない場合の代替。1文字を1トークンとして数える(日本語では実際のトークン数以上になる)
+    """
+    def encode_ordinary(self, text: str) -> list[int]:
+        return [ord(c) for c in text]
+
+    def encode_ordinary_batch(self, texts: list[str]) -> list[list[int]]:
+        return [self.encode_ordinary(text) for text in texts]
+
+    def decode_with_offsets(self, tokens: list[int]) -> tuple[str, list[int]]:
+        return "".join(chr(t) for t in tokens), list(range(len(tokens)))
+
+
+@lru_cache(maxsize=8)
+def get_encoder(encoding_name: str) -> Any:
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        logger.warning(f"tiktoken encoding {encoding_name} is not available. Count characters as tokens: {e}")
+        return _CharEncoder()
+
+
+def split_sentences(text: str) -> list[str]:
+    """
+    テキストを文に分割する。分割した文を連結すると元のテキストに戻る。
+    """
+    return [sentence for sentence in _SENTENCE_PATTERN.findall(text) if sentence]
+
+
+def _split_segment(text: str, chunk_tokens: int, overlap_tokens: int, encoding_name: str) -> list[str]:
+    # プロセスプールから呼び出すため、モジュールのトップレベルに定義する
+    return TextChunker(chunk_tokens, overlap_tokens, encoding_name).split_text(text)
+
+
+class TextChunker:
+    """
+    トークン数でテキストをチャンクに分割するクラス。
+    """
+
+    # Embeddingモデル(text-embedding-3-*, text-embedding-ada-002)の入力トークン数の上限
+    max_embedding_tokens: ClassVar[int] = 8191
+    default_encoding_name: ClassVar[str] = "cl100k_base"
+    # この文字数以上のテキストはプロセスプールで分割する
+    parallel_threshold_chars: ClassVar[int] = 200000
+    # プロセスプールで分割する際のセグメントの文字数
+    segment_chars: ClassVar[int] = 100000
+
+    _executor: ClassVar[Optional[ProcessPoolExecutor]] = None
+    _executor_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, chunk_tokens: int, overlap_tokens: int = 0, encoding_name: str = ""):
+        if chunk_tokens <= 0:
+            raise ValueError("chunk_tokens must be greater than 0")
+        self.chunk_tokens = min(chunk_tokens, self.max_embedding_tokens)
+        self.overlap_tokens = max(0, min(overlap_tokens, self.chunk_tokens // 2))
+        self.encoding_name = encoding_name or os.getenv("TEXT_CHUNKER_ENCODING", self.default_encoding_name)
+
+    @classmethod
+    def get_max_workers(cls) -> int:
+        return int(os.getenv("TEXT_CHUNKER_MAX_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+    @classmethod
+    def get_executor(cls) -> ProcessPoolExecutor:
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ProcessPoolExecutor(max_workers=cls.get_max_workers())
+            return cls._executor
+
+    def split_text(self, text: str) -> list[str]:
+        """
+        テキストをchunk_tokens以下のチャンクに分割する。
+        """
+        if not text:
+            return []
+        encoder = get_encoder(self.encoding_name)
+        sentences = split_sentences(text)
+        token_counts = [len(tokens) for tokens in encoder.encode_ordinary_batch(sentences)]
+
+        chunks: list[str] = []
+        current: list[tuple[str, int]] = []
+        current_tokens = 0
+        for sentence, tokens in zip(sentences, token_counts):
+            if tokens > self.chunk_tokens:
+                # 1文でサイズを超える場合は、それまでの文をチャンクにしてから文をトークンの位置で分割する
+                if current:
+                    chunks.append("".join(s for s, _ in current))
+                    current, current_tokens = [], 0
+                chunks.extend(self._split_long_sentence(encoder, sentence))
+                continue
+            if current_tokens + tokens > self.chunk_tokens and current:
+                chunks.append("".join(s for s, _ in current))
+                current, current_tokens = self._get_overlap(current)
+            current.append((sentence, tokens))
+            current_tokens += tokens
+        if current:
+            chunks.append("".join(s for s, _ in current))
+        # 空白のみのチャンクは除外する
+        return [chunk for chunk in chunks if chunk.strip()]
+
+    def _get_overlap(self, sentences: list[tuple[str, int]]) -> tuple[list[tuple[str, int]], int]:
+        # 直前のチャンクの末尾からoverlap_tokens以下の文を次のチャンクの先頭に含める
+        overlap: list[tuple[str, int]] = []
+        overlap_tokens = 0
+        for sentence, tokens in reversed(sentences):
+            if overlap_tokens + tokens > self.overlap_tokens:
+                break
+            overlap.insert(0, (sentence, tokens))
+            overlap_tokens += tokens
+        return overlap, overlap_tokens
+
+    def _split_long_sentence(self, encoder: Any, sentence: str) -> list[str]:
+        # トークンの開始位置(文字単位)で分割し、マルチバイト文字の途中で切らない
+        tokens = encoder.encode_ordinary(sentence)
+        _, offsets = encoder.decode_with_offsets(tokens)
+        step = self.chunk_tokens - self.overlap_tokens
+        pieces = []
+        for i in range(0, len(tokens), step):
+            end_index = i + self.chunk_tokens
+            end = offsets[end_index] if end_index < len(tokens) else len(sentence)
+            piece = sentence[offsets[i]:end]
+            if piece:
+                pieces.append(piece)
+            if end_index >= len(tokens):
+                break
+        return pieces
+
+    @classmethod
+    def split_segments(cls, text: str, segment_chars: int) -> list[str]:
+        """
+        テキストを約segment_chars文字のセグメントに分割する。セグメントの境界は改行の直後とする。
+        """
+        segments = []
+        start = 0
+        while start < len(text):
+            end = start + segment_chars
+            if end >= len(text):
+                segments.append(text[start:])
+                break
+            newline = text.rfind("\n", start, end)
+            if newline <= start:
+                newline = text.find("\n", end)
+                if newline < 0:
+                    segments.append(text[start:])
+                    break
+            segments.append(text[start:newline + 1])
+            start = newline + 1
+        return segments
+
+    async def aiter_chunks(self, text: str) -> AsyncIterator[str]:
+        """
+        テキストをイベントループの外で分割し、チャンクを先頭から順に返す。
+        parallel_threshold_chars以上のテキストはセグメント毎にプロセスプールで並列に分割する。
+        """
+        if len(text) < self.parallel_threshold_chars:
+            for chunk in await asyncio.to_thread(self.split_text, text):
+                yield chunk
+            return
+
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        futures = [
+            loop.run_in_executor(executor, _split_segment, segment, self.chunk_tokens, self.overlap_tokens, self.encoding_name)
+            for segment in self.split_segments(text, self.segment_chars)
+        ]
+        try:
+            for future in futures:
+                for chunk in await future:
+                    yield chunk
+        finally:
+            for future in futures:
+                future.cancel()
+
+    async def asplit_text(self, text: str) -> list[str]:
+        return [chunk async for chunk in self.aiter_chunks(text)]
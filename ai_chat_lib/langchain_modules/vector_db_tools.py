@@ -10,6 +10,7 @@ async def vector_search(
         query: Annotated[str, "String to search for"],
         num_results: Annotated[int, "Maximum number of results to display"],
         target_folder: Annotated[str, "Target folder for vector search (optional)"] = "",
+        include_subfolders: Annotated[bool, "Whether to include subfolders of the target folder"] = False,
         ) -> list[dict[str, Any]]:
     """
     This function performs a vector search on the specified text and returns the related documents.
@@ -28,8 +29,12 @@ async def vector_search(
     if target_folder:
         # target_folderのパスからfolder_idを取得
         folder = await ContentFolder.get_content_folder_by_path(target_folder)
-        if folder:
-            search_kwargs["filter"] = {"folder_id": folder.id}
+        if folder and folder.id:
+            if include_subfolders:
+                # サブフォルダを含む場合は祖先フォルダのキーで検索する
+                search_kwargs["filter"] = await ContentFolder.get_subfolder_filter(folder.id)
+            else:
+                search_kwargs["filter"] = {"folder_id": folder.id}
         else:
             raise ValueError(f"Folder not found for path: {target_folder}")
 
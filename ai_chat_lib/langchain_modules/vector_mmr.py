@@ -0,0 +1,90 @@
+"""
+vector_mmr.py
+
+Maximal Marginal Relevance(MMR)による検索結果の多様化を行うモジュール。
+- 候補同士の類似度は行列積で一度に計算し、ペア毎のPythonループは使わない
+- 選択済みの候補との最大類似度をベクトルで保持し、1件選択する毎に更新する
+"""
+
+from typing import Any, ClassVar, Optional, Sequence
+
+import numpy as np
+
+
+class VectorMMR:
+    """
+    候補のEmbeddingからMMRで多様な上位k件を選択するクラス。
+    """
+
+    # search_kwargsのキー
+    # mmr: Trueの場合にMMRを行う, mmr_fetch_k: 候補数(0以下の場合はk * mmr_fetch_k_multiplier),
+    # mmr_lambda: 1に近いほど関連度、0に近いほど多様性を重視する
+    mmr_key: ClassVar[str] = "mmr"
+    mmr_fetch_k_key: ClassVar[str] = "mmr_fetch_k"
+    mmr_fetch_k_multiplier_key: ClassVar[str] = "mmr_fetch_k_multiplier"
+    mmr_lambda_key: ClassVar[str] = "mmr_lambda"
+
+    default_fetch_k_multiplier: ClassVar[int] = 4
+    default_lambda: ClassVar[float] = 0.5
+
+    @classmethod
+    def pop_mmr_params(cls, search_kwargs: dict[str, Any]) -> Optional[dict[str, Any]]:
+        """
+        search_kwargsからMMRの設定を取り出す。MMRを行わない場合はNoneを返す。
+        search_kwargsからはMMRのキーを削除する。
+        """
+        use_mmr = bool(search_kwargs.pop(cls.mmr_key, False))
+        fetch_k = int(search_kwargs.pop(cls.mmr_fetch_k_key, 0) or 0)
+        multiplier = int(search_kwargs.pop(cls.mmr_fetch_k_multiplier_key, cls.default_fetch_k_multiplier) or cls.default_fetch_k_multiplier)
+        lambda_mult = float(search_kwargs.pop(cls.mmr_lambda_key, cls.default_lambda))
+        if not use_mmr:
+            return None
+        k = int(search_kwargs.get("k", 4))
+        return {
+            "k": k,
+            "fetch_k": max(fetch_k, k) if fetch_k > 0 else k * max(multiplier, 1),
+            "lambda_mult": min(max(lambda_mult, 0.0), 1.0),
+        }
+
+    @classmethod
+    def select(cls, query_embedding: Sequence[float], embeddings: Sequence[Sequence[float]], k: int, lambda_mult: float = default_lambda) -> list[int]:
+        """
+        MMRで候補を選択する。
+
+        Args:
+            query_embedding (Sequence[float]): クエリのEmbedding
+            embeddings (Sequence[Sequence[float]]): 候補のEmbedding
+            k (int): 選択する件数
+            lambda_mult (float): 関連度と多様性の重み
+
+        Returns:
+            list[int]: 選択した候補の位置(選択順)
+        """
+        if len(embeddings) == 0 or k <= 0:
+            return []
+        candidates = cls._normalize(np.asarray(embeddings, dtype=np.float32))
+        query = cls._normalize(np.asarray([query_embedding], dtype=np.float32))[0]
+
+        relevance = candidates @ query
+        similarity = candidates @ candidates.T
+        k = min(k, len(candidates))
+
+        selected: list[int] = [int(np.argmax(relevance))]
+        # 各候補の、選択済みの候補との最大類似度
+        max_similarity = similarity[:, selected[0]].copy()
+        available = np.ones(len(candidates), dtype=bool)
+        available[selected[0]] = False
+        while len(selected) < k:
+            scores = lambda_mult * relevance - (1.0 - lambda_mult) * max_similarity
+            scores[~available] = -np.inf
+            index = int(np.argmax(scores))
+            selected.append(index)
+            available[index] = False
+            np.maximum(max_similarity, similarity[:, index], out=max_similarity)
+        return selected
+
+    @classmethod
+    def _normalize(cls, vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
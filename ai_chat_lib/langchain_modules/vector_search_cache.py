@@ -0,0 +1,190 @@
+"""
+vector_search_cache.py
+
+ベクトル検索の結果をプロセス内でキャッシュするモジュール。
+- キーは(コレクション, 書き込み世代, フォルダパスの世代, Embeddingモデル, クエリ, search_kwargs)
+- 書き込み世代はコレクション毎のカウンターとしてDBPropertiesに保持し、登録・削除の度に進める。
+  世代が変わるとキーが一致しなくなるため、他プロセスでの書き込み後も古い結果を返さない
+- エントリ数と結果のテキストの合計サイズで上限を設け、超えた場合は最も古く利用されたエントリから削除する
+"""
+
+import os
+import json
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, ClassVar, Optional
+
+import aiosqlite
+from langchain_core.documents import Document
+
+from ai_chat_lib.db_modules.main_db import MainDB
+from ai_chat_lib.db_modules.content_folder import ContentFolder
+
+import ai_chat_lib.log_modules.log_settings as log_settings
+logger = log_settings.getLogger(__name__)
+
+
+class VectorSearchCacheStats:
+    """
+    キャッシュの利用状況
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def to_dict(self) -> dict[str, Any]:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / requests) if requests > 0 else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class VectorSearchCache:
+    """
+    ベクトル検索結果のLRUキャッシュ。スレッドセーフ。
+    """
+
+    # DBPropertiesのカウンター名の接頭辞
+    generation_name_prefix: ClassVar[str] = "vector_search_generation:"
+
+    _entries: ClassVar["OrderedDict[tuple, tuple[list[Document], int]]"] = OrderedDict()
+    _total_bytes: ClassVar[int] = 0
+    _lock: ClassVar[threading.Lock] = threading.Lock()
+    _stats: ClassVar[dict[str, VectorSearchCacheStats]] = {}
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        return os.getenv("VECTOR_SEARCH_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+
+    @classmethod
+    def get_max_entries(cls) -> int:
+        return int(os.getenv("VECTOR_SEARCH_CACHE_MAX_ENTRIES", "1000"))
+
+    @classmethod
+    def get_max_bytes(cls) -> int:
+        return int(os.getenv("VECTOR_SEARCH_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+    @classmethod
+    def get_generation_name(cls, collection_key: str) -> str:
+        return f"{cls.generation_name_prefix}{collection_key}"
+
+    @classmethod
+    async def get_generations(cls, collection_key: str) -> tuple[int, int]:
+        """
+        コレクションの書き込み世代と、フォルダパスの世代を取得する。
+        """
+        async with aiosqlite.connect(MainDB.get_main_db_path()) as conn:
+            generation = await MainDB.get_counter(conn, cls.get_generation_name(collection_key))
+            folder_generation = await MainDB.get_counter(conn, ContentFolder.folder_path_generation_name)
+        return generation, folder_generation
+
+    @classmethod
+    def create_key(cls, collection_key: str, generations: tuple[int, int], model: str, query: str, search_kwargs: dict[str, Any]) -> tuple:
+        kwargs_json = json.dumps(search_kwargs, ensure_ascii=False, sort_keys=True, default=str)
+        return (collection_key, generations, model, query, kwargs_json)
+
+    @classmethod
+    def get(cls, key: tuple) -> Optional[list[Document]]:
+        """
+        キャッシュから検索結果を取得する。呼び出し元での変更がキャッシュに影響しないようコピーを返す。
+        """
+        with cls._lock:
+            stats = cls._get_stats(key[0])
+            entry = cls._entries.get(key, None)
+            if entry is None:
+                stats.misses += 1
+                return None
+            cls._entries.move_to_end(key)
+            stats.hits += 1
+            documents = entry[0]
+        return [doc.model_copy(deep=True) for doc in documents]
+
+    @classmethod
+    def put(cls, key: tuple, documents: list[Document]):
+        documents = [doc.model_copy(deep=True) for doc in documents]
+        size = sum(len(doc.page_content) + len(json.dumps(doc.metadata, ensure_ascii=False, default=str)) for doc in documents)
+        max_bytes = cls.get_max_bytes()
+        if size > max_bytes:
+            return
+        with cls._lock:
+            old_entry = cls._entries.pop(key, None)
+            if old_entry is not None:
+                cls._total_bytes -= old_entry[1]
+            cls._entries[key] = (documents, size)
+            cls._total_bytes += size
+            max_entries = cls.get_max_entries()
+            while len(cls._entries) > max_entries or cls._total_bytes > max_bytes:
+                evicted_key, (_, evicted_size) = cls._entries.popitem(last=False)
+                cls._total_bytes -= evicted_size
+                cls._get_stats(evicted_key[0]).evictions += 1
+
+    @classmethod
+    async def invalidate(cls, collection_key: str):
+        """
+        コレクションの書き込み世代を進めて、全プロセスのキャッシュを無効化する。
+        """
+        async with aiosqlite.connect(MainDB.get_main_db_path()) as conn:
+            await MainDB.increment_counter(conn, cls.get_generation_name(collection_key))
+            await conn.commit()
+        cls._remove_collection_entries(collection_key)
+
+    @classmethod
+    def invalidate_sync(cls, collection_key: str):
+        """
+        invalidateの同期版。イベントループの外(同期メソッド)から呼び出す。
+        """
+        name = cls.get_generation_name(collection_key)
+        with sqlite3.connect(MainDB.get_main_db_path()) as conn:
+            cur = conn.execute("UPDATE DBProperties SET value=CAST(value AS INTEGER) + 1 WHERE name=?", (name,))
+            if cur.rowcount == 0:
+                conn.execute("INSERT INTO DBProperties (id, name, value) VALUES (?, ?, ?)", (str(uuid.uuid4()), name, "1"))
+        cls._remove_collection_entries(collection_key)
+
+    @classmethod
+    def _remove_collection_entries(cls, collection_key: str):
+        # 世代が変わったエントリは参照されないため、メモリを解放する
+        with cls._lock:
+            for key in [key for key in cls._entries if key[0] == collection_key]:
+                _, size = cls._entries.pop(key)
+                cls._total_bytes -= size
+            cls._get_stats(collection_key).invalidations += 1
+
+    @classmethod
+    def _get_stats(cls, collection_key: str) -> VectorSearchCacheStats:
+        stats = cls._stats.get(collection_key, None)
+        if stats is None:
+            stats = VectorSearchCacheStats()
+            cls._stats[collection_key] = stats
+        return stats
+
+    @classmethod
+    def get_stats(cls) -> dict[str, Any]:
+        with cls._lock:
+            collections = {key: stats.to_dict() for key, stats in cls._stats.items()}
+            hits = sum(stats.hits for stats in cls._stats.values())
+            misses = sum(stats.misses for stats in cls._stats.values())
+            return {
+                "enabled": cls.is_enabled(),
+                "entries": len(cls._entries),
+                "max_entries": cls.get_max_entries(),
+                "bytes": cls._total_bytes,
+                "max_bytes": cls.get_max_bytes(),
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": (hits / (hits + misses)) if hits + misses > 0 else 0.0,
+                "collections": collections,
+            }
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._entries.clear()
+            cls._total_bytes = 0
@@ -0,0 +1,191 @@
+"""
+vector_search_executor.py
+
+ベクトル検索をイベントループの外で実行するためのモジュール。
+- ネイティブの非同期APIを持たないベクトルストアの検索は、専用の有界スレッドプールで実行する
+- コレクション毎の同時実行数をセマフォで制限する
+- コレクション毎の待ち行列の深さ・待ち時間・実行時間を計測する
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, ClassVar, Optional, TypeVar
+
+import ai_chat_lib.log_modules.log_settings as log_settings
+logger = log_settings.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class VectorSearchStats:
+    """
+    コレクション毎の検索実行状況
+    """
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.errors = 0
+        self.total_wait_sec = 0.0
+        self.total_run_sec = 0.0
+
+    def to_dict(self) -> dict[str, Any]:
+        finished = self.completed + self.errors
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "max_queued": self.max_queued,
+            "completed": self.completed,
+            "errors": self.errors,
+            "avg_wait_ms": (self.total_wait_sec / finished * 1000) if finished > 0 else 0.0,
+            "avg_run_ms": (self.total_run_sec / finished * 1000) if finished > 0 else 0.0,
+        }
+
+
+class VectorSearchExecutor:
+    """
+    ベクトル検索用の有界スレッドプールとコレクション毎の同時実行制御を提供するクラス。
+    """
+
+    _executor: ClassVar[Optional[ThreadPoolExecutor]] = None
+    _executor_lock: ClassVar[threading.Lock] = threading.Lock()
+    # イベントループ -> (コレクションキー -> セマフォ)。終了したイベントループのセマフォは自動的に破棄される
+    _semaphores: ClassVar["weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, asyncio.Semaphore]]"] = weakref.WeakKeyDictionary()
+    _stats: ClassVar[dict[str, VectorSearchStats]] = {}
+    # スレッドプールに投入され、まだ実行が始まっていない検索の数
+    _executor_queued: ClassVar[int] = 0
+    _executor_queued_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    @classmethod
+    def get_max_workers(cls) -> int:
+        default_workers = min(8, (os.cpu_count() or 1) + 4)
+        return int(os.getenv("VECTOR_SEARCH_MAX_WORKERS", str(default_workers)))
+
+    @classmethod
+    def get_max_concurrency_per_collection(cls) -> int:
+        return int(os.getenv("VECTOR_SEARCH_MAX_CONCURRENCY_PER_COLLECTION", "4"))
+
+    @classmethod
+    def get_executor(cls) -> ThreadPoolExecutor:
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=cls.get_max_workers(), thread_name_prefix="vector_search"
+                )
+            return cls._executor
+
+    @classmethod
+    def create_collection_key(cls, vector_db_url: str, collection_name: str) -> str:
+        # URLには認証情報が含まれることがあるため、ハッシュ値をキーに使用する
+        url_hash = hashlib.sha1(vector_db_url.encode("utf-8")).hexdigest()[:8]
+        return f"{collection_name}@{url_hash}"
+
+    @classmethod
+    def _get_semaphore(cls, collection_key: str) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphores = cls._semaphores.setdefault(loop, {})
+        semaphore = semaphores.get(collection_key, None)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(cls.get_max_concurrency_per_collection())
+            semaphores[collection_key] = semaphore
+        return semaphore
+
+    @classmethod
+    @asynccontextmanager
+    async def _limit(cls, collection_key: str):
+        stats = cls._stats.setdefault(collection_key, VectorSearchStats())
+        semaphore = cls._get_semaphore(collection_key)
+
+        stats.queued += 1
+        stats.max_queued = max(stats.max_queued, stats.queued)
+        enqueued_at = time.perf_counter()
+        try:
+            await semaphore.acquire()
+        finally:
+            stats.queued -= 1
+        started_at = time.perf_counter()
+        stats.total_wait_sec += started_at - enqueued_at
+        stats.running += 1
+        try:
+            yield
+            stats.completed += 1
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.running -= 1
+            stats.total_run_sec += time.perf_counter() - started_at
+            semaphore.release()
+
+    @classmethod
+    async def run_in_executor(cls, collection_key: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        同期関数を専用スレッドプールで実行する。
+
+        Args:
+            collection_key (str): 同時実行数を制限するコレクションのキー
+            func (Callable): 実行する同期関数
+
+        Returns:
+            T: funcの戻り値
+        """
+        async with cls._limit(collection_key):
+            loop = asyncio.get_running_loop()
+            # 実行が始まるか、開始前にキャンセルされた時点で待ち件数から除く
+            dequeued = threading.Event()
+
+            def dequeue() -> None:
+                with cls._executor_queued_lock:
+                    if not dequeued.is_set():
+                        dequeued.set()
+                        cls._executor_queued -= 1
+
+            def run() -> T:
+                dequeue()
+                return func(*args, **kwargs)
+
+            with cls._executor_queued_lock:
+                cls._executor_queued += 1
+            try:
+                return await loop.run_in_executor(cls.get_executor(), run)
+            finally:
+                dequeue()
+
+    @classmethod
+    async def run_coroutine(cls, collection_key: str, coroutine_func: Callable[[], Awaitable[T]]) -> T:
+        """
+        ネイティブの非同期APIを、コレクション毎の同時実行制限の下で実行する。
+
+        Args:
+            collection_key (str): 同時実行数を制限するコレクションのキー
+            coroutine_func (Callable[[], Awaitable[T]]): コルーチンを返す関数
+
+        Returns:
+            T: コルーチンの戻り値
+        """
+        async with cls._limit(collection_key):
+            return await coroutine_func()
+
+    @classmethod
+    def get_stats(cls) -> dict[str, Any]:
+        """
+        検索の実行状況を取得する。
+
+        Returns:
+            dict[str, Any]: スレッドプールの設定とコレクション毎の統計情報
+        """
+        with cls._executor_queued_lock:
+            pending = cls._executor_queued
+        return {
+            "max_workers": cls.get_max_workers(),
+            "max_concurrency_per_collection": cls.get_max_concurrency_per_collection(),
+            "executor_queue_depth": pending,
+            "collections": {key: stats.to_dict() for key, stats in cls._stats.items()},
+        }
@@ -27,6 +27,18 @@ class VectorSearchRequest(BaseModel):
 
     vector_search_requests_name: ClassVar[str] = "vector_search_requests"
 
+    # search_kwargsのsearch_modeで検索方法を指定する
+    # vector: ベクトル検索(デフォルト), keyword: キーワード検索(BM25)のみ, hybrid: 両方の結果をRRFで統合(スコアはRRFのスコア),
+    # auto: 識別子のようなクエリはkeyword、それ以外はhybrid
+    search_mode_key: ClassVar[str] = "search_mode"
+    search_mode_vector: ClassVar[str] = "vector"
+    search_mode_keyword: ClassVar[str] = "keyword"
+    search_mode_hybrid: ClassVar[str] = "hybrid"
+    search_mode_auto: ClassVar[str] = "auto"
+
+    # search_kwargsのfilterで指定する、サブフォルダを含めて検索するかどうかのキー
+    include_subfolders_key: ClassVar[str] = "include_subfolders"
+
     @classmethod
     async def get_vector_search_requests_objects(cls, request_dict: dict) -> List["VectorSearchRequest"]:
         '''
@@ -49,6 +61,8 @@ class VectorSearchRequest(BaseModel):
         if not filter:
             logger.debug("__update_search_kwargs: filter is not set.")
             return kwargs
+        # include_subfolders: Trueの場合はfolder_path(またはfolder_id)のフォルダとそのサブフォルダを検索する
+        include_subfolders = bool(filter.pop(self.include_subfolders_key, False))
         folder_path = filter.get("folder_path", None)
         if folder_path:
             logger.info(f"__update_search_kwargs: folder_path: {folder_path}")
@@ -58,6 +72,12 @@ class VectorSearchRequest(BaseModel):
             kwargs["filter"].pop("folder_path", None)
         else:
             logger.info("__update_search_kwargs: folder_path is not set.")
+
+        folder_id = filter.get("folder_id", None)
+        if include_subfolders and isinstance(folder_id, str) and folder_id:
+            # folder_idの一致条件を、深さに対応する祖先フォルダのキーの一致条件に置き換える
+            kwargs["filter"].pop("folder_id", None)
+            kwargs["filter"].update(await ContentFolder.get_subfolder_filter(folder_id))
         return kwargs
 
     async def get_vector_db_item(self) -> "VectorDBItem":
@@ -0,0 +1,201 @@
+"""
+vector_write_queue.py
+
+コレクション毎に書き込み(登録・更新・削除)を1つのタスクで直列に実行するキュー。
+- 同じコレクションへの削除と登録が並行して実行されず、チャンクの重複やSQLiteのロック待ちが発生しない
+- 未処理の同じsource_idへの書き込みは最後の1件にまとめる(まとめられた呼び出し元も最後の書き込みの完了を待つ)
+- 異なるsource_idの書き込みはmax_batch_sources件までまとめて、削除・登録をそれぞれ1回で行う
+- enqueue_update/enqueue_deleteは書き込みの完了時に結果が設定されるFutureを返す
+- テキストが登録済みのものと同じ更新は、Embeddingを作成せずにmetadataのみ更新する
+- コレクション全体を書き換える処理(次元数の移行等)はenqueue_operationで追加し、前後の書き込みと重ならないように単独で実行する
+"""
+
+import asyncio
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, ClassVar, Optional
+
+from ai_chat_lib.langchain_modules.embedding_data import EmbeddingData
+from ai_chat_lib.langchain_modules.langchain_vector_db import LangChainVectorDB
+
+import ai_chat_lib.log_modules.log_settings as log_settings
+logger = log_settings.getLogger(__name__)
+
+
+class VectorWriteRequest:
+    """
+    source_id毎の未処理の書き込み。embedding_dataがNoneの場合は削除のみ行う。
+    operationが指定されている場合は、コレクション全体を書き換える処理として単独で実行する
+    """
+    def __init__(
+            self, vector_db: LangChainVectorDB, source_id: str, embedding_data: Optional[EmbeddingData],
+            operation: Optional[Callable[[], Awaitable[Any]]] = None):
+        self.vector_db = vector_db
+        self.source_id = source_id
+        self.embedding_data = embedding_data
+        self.operation = operation
+        self.futures: list[asyncio.Future] = []
+
+
+class VectorWriteQueue:
+    """
+    コレクション単位の書き込みキュー
+    """
+
+    # 1回にまとめるsource_idの最大数
+    max_batch_sources: ClassVar[int] = 32
+    # 書き込みをまとめるために、最初の書き込みを受け付けてから待つ時間(秒)
+    batch_wait_sec: ClassVar[float] = 0.05
+
+    # コレクションキー -> キュー
+    _queues: ClassVar[dict[str, "VectorWriteQueue"]] = {}
+
+    def __init__(self, collection_key: str):
+        self.collection_key = collection_key
+        self.loop = asyncio.get_running_loop()
+        self.pending: "OrderedDict[str, VectorWriteRequest]" = OrderedDict()
+        self.worker: Optional[asyncio.Task] = None
+        self.coalesced = 0
+
+    @classmethod
+    def get_queue(cls, vector_db: LangChainVectorDB) -> "VectorWriteQueue":
+        # キューはイベントループ毎に作成する(別のイベントループのキューは利用できない)
+        collection_key = vector_db.get_collection_key()
+        queue = cls._queues.get(collection_key, None)
+        if queue is None or queue.loop is not asyncio.get_running_loop() or queue.loop.is_closed():
+            queue = VectorWriteQueue(collection_key)
+            cls._queues[collection_key] = queue
+        return queue
+
+    def enqueue_update(self, vector_db: LangChainVectorDB, embedding_data: EmbeddingData) -> asyncio.Future:
+        """
+        source_idのドキュメントを削除してから登録する書き込みを追加する。
+        """
+        return self._enqueue(VectorWriteRequest(vector_db, embedding_data.source_id, embedding_data))
+
+    def enqueue_delete(self, vector_db: LangChainVectorDB, source_id: str) -> asyncio.Future:
+        """
+        source_idのドキュメントを削除する書き込みを追加する。
+        """
+        return self._enqueue(VectorWriteRequest(vector_db, source_id, None))
+
+    def enqueue_operation(self, vector_db: LangChainVectorDB, operation: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """
+        コレクション全体を書き換える処理を追加する。先に追加された書き込みの完了後に単独で実行し、
+        処理中に追加された書き込みは処理の完了後に実行する。Futureにはoperationの戻り値が設定される。
+        """
+        # 他の書き込みとまとめられないよう、一意のキーを利用する
+        return self._enqueue(VectorWriteRequest(vector_db, f"operation:{uuid.uuid4()}", None, operation))
+
+    def _enqueue(self, request: VectorWriteRequest) -> asyncio.Future:
+        future = self.loop.create_future()
+        old_request = self.pending.pop(request.source_id, None)
+        if old_request is not None:
+            # 未処理の書き込みは最後の書き込みにまとめ、キューの末尾に移動する
+            request.futures.extend(old_request.futures)
+            self.coalesced += 1
+        request.futures.append(future)
+        self.pending[request.source_id] = request
+        if self.worker is None or self.worker.done():
+            self.worker = self.loop.create_task(self._run())
+        return future
+
+    async def _run(self):
+        # 未処理の書き込みがなくなるまで、まとめて処理する
+        while len(self.pending) > 0:
+            await asyncio.sleep(self.batch_wait_sec)
+            first_request = next(iter(self.pending.values()))
+            if first_request.operation is not None:
+                self.pending.popitem(last=False)
+                await self._process_operation(first_request)
+                continue
+            # operationの手前までの書き込みをまとめる
+            batch: list[VectorWriteRequest] = []
+            while len(self.pending) > 0 and len(batch) < self.max_batch_sources:
+                if next(iter(self.pending.values())).operation is not None:
+                    break
+                _, request = self.pending.popitem(last=False)
+                batch.append(request)
+            await self._process_batch(batch)
+
+    async def _process_operation(self, request: VectorWriteRequest):
+        try:
+            result = await request.operation()  # type: ignore
+            for future in request.futures:
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            logger.error(f"vector write operation failed: collection={self.collection_key} error={e}")
+            for future in request.futures:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _process_batch(self, batch: list[VectorWriteRequest]):
+        try:
+            # Embeddingのモデルが同じ書き込み毎に、削除と登録をそれぞれ1回で行う
+            groups: dict[str, list[VectorWriteRequest]] = {}
+            for request in batch:
+                try:
+                    model_key = request.vector_db.langchain_openai_client.get_embedding_model_key()
+                except Exception as e:
+                    logger.error(f"vector write failed: collection={self.collection_key} source_id={request.source_id} error={e}")
+                    self._set_results([request], e)
+                    continue
+                groups.setdefault(model_key, []).append(request)
+            for requests in groups.values():
+                await self._process_group(requests)
+        finally:
+            # 想定外の例外やキャンセルの場合も、呼び出し元が完了を待ち続けないようにする
+            self._set_results(batch, RuntimeError(f"vector write was not completed: collection={self.collection_key}"))
+
+    async def _process_group(self, requests: list[VectorWriteRequest]):
+        vector_db = requests[-1].vector_db
+        try:
+            # テキストが変わっていない更新はmetadataのみ更新し、削除・登録の対象から除く
+            changed_requests = []
+            for request in requests:
+                if request.embedding_data is not None and await vector_db.update_metadata_if_content_unchanged(request.embedding_data):
+                    continue
+                changed_requests.append(request)
+            if len(changed_requests) > 0:
+                await vector_db.delete_documents([request.source_id for request in changed_requests])
+            data_list = [request.embedding_data for request in changed_requests if request.embedding_data is not None]
+            if len(data_list) > 0:
+                await vector_db.add_documents(data_list)
+            logger.info(f"vector write batch completed: collection={self.collection_key} sources={len(requests)}")
+            self._set_results(requests, None)
+        except Exception as e:
+            # まとめた書き込みが失敗した場合は、source_id毎に削除・登録をやり直し、失敗したsource_idのみエラーとする
+            logger.warning(f"vector write batch failed. retrying per source: collection={self.collection_key} sources={len(requests)} error={e}")
+            for request in requests:
+                await self._process_request(request)
+
+    async def _process_request(self, request: VectorWriteRequest):
+        try:
+            vector_db = request.vector_db
+            if request.embedding_data is None or not await vector_db.update_metadata_if_content_unchanged(request.embedding_data):
+                await vector_db.delete_documents([request.source_id])
+                if request.embedding_data is not None:
+                    await vector_db.add_documents([request.embedding_data])
+            self._set_results([request], None)
+        except Exception as e:
+            logger.error(f"vector write failed: collection={self.collection_key} source_id={request.source_id} error={e}")
+            self._set_results([request], e)
+
+    @classmethod
+    def _set_results(cls, requests: list[VectorWriteRequest], error: Optional[Exception]):
+        for request in requests:
+            for future in request.futures:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(request.source_id)
+
+    def get_stats(self) -> dict[str, Any]:
+        return {
+            "pending": len(self.pending),
+            "coalesced": self.coalesced,
+            "running": self.worker is not None and not self.worker.done(),
+        }
@@ -37,12 +37,13 @@ def search_wikipedia_ja_mcp(
 async def vector_search_mcp(
     query: Annotated[str, Field(description="String to search for")], 
     num_results: Annotated[int, Field(description="Maximum number of results to display")],
-    target_folder: Annotated[str, Field(description="Target folder for vector search (optional)")] = ""
+    target_folder: Annotated[str, Field(description="Target folder for vector search (optional)")] = "",
+    include_subfolders: Annotated[bool, Field(description="Whether to include subfolders of the target folder")] = False
     ) -> Annotated[list[dict[str, Any]], Field(description="List of related documents from vector search")]:
     """
     This function performs a vector search on the specified text and returns the related documents.
     """
-    return await vector_db_tools.vector_search(query, num_results, target_folder)
+    return await vector_db_tools.vector_search(query, num_results, target_folder, include_subfolders)
 
 # フォルダ情報を取得するツールを登録
 async def get_vector_folder_paths_mcp() -> Annotated[list[ContentFolder], Field(description="List of folders in the vector store")]:
@@ -16,13 +16,14 @@ import chromadb.config
 from langchain_chroma.vectorstores import Chroma # type: ignore
 from langchain.docstore.document import Document
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.retrievers.multi_vector import MultiVectorRetriever
 from langchain_core.runnables import chain
 from langchain_core.callbacks import (
     CallbackManagerForRetrieverRun,
 )
 from ai_chat_lib.langchain_modules.langchain_doc_store import SQLDocStore
+from ai_chat_lib.langchain_modules.text_chunker import TextChunker
+from ai_chat_lib.langchain_modules.langchain_embedding_cache import EmbeddingCacheStore
 from langchain_core.retrievers import BaseRetriever
 import logging 
 logger = logging.getLogger(__name__)
@@ -170,7 +171,8 @@ class LangChainOpenAIClient(BaseModel):
         else:
             embeddings = OpenAIEmbeddings(**params)
         
-        return embeddings
+        # APIサーバ、MCPサーバと同じEmbeddingキャッシュを共有する
+        return EmbeddingCacheStore.wrap(embeddings, self.model)
 
     @classmethod
     def create_from_env(cls) -> 'LangChainOpenAIClient':
@@ -195,11 +197,11 @@ class LangChainVectorStore(BaseModel):
         collection_name (str): Name of the vector store collection, defaults to "default_collection".
         folder_paths_file_path (str): Path to the JSON file containing a list of folder names, required.
         vector_store_url (str): URL for the vector store, if applicable.
-        chunk_size (int): Size of chunks for text splitting, defaults to 4000.
+        chunk_size (int): Size of chunks for text splitting in tokens, defaults to 4000.
         embedding_client (LangChainOpenAIClient): Embedding client for generating embeddings.
         use_multi_vector_retriever (bool): Flag to use MultiVectorRetriever, defaults to False.
         doc_store_url (Optional[str]): URL for the document store, if applicable.
-        parent_chunk_size (int): Chunk size for MultiVectorRetriever, defaults to 1000.
+        parent_chunk_size (int): Chunk size in tokens for MultiVectorRetriever, defaults to 1000.
     """
     
     # vector store type 現在はchromaのみ対応. chroma以外はエラーを返す。defaults to chroma.
@@ -212,7 +214,7 @@ class LangChainVectorStore(BaseModel):
     # vector store url for chroma
     vector_store_url: str = Field(description="URL for the vector store, if applicable")
     # chunk size for text splitting
-    chunk_size: int = Field(default=4000, description="Size of chunks for text splitting")
+    chunk_size: int = Field(default=4000, description="Size of chunks for text splitting in tokens")
 
     embedding_client: LangChainOpenAIClient = Field(..., description="Embedding client for generating embeddings")
 
@@ -221,7 +223,7 @@ class LangChainVectorStore(BaseModel):
     # doc store url for MultiVectorRetriever
     doc_store_url: Optional[str] = Field(default=None, description="URL for the document store, if applicable")
     # chunk size for Parent Data
-    parent_chunk_size: int = Field(default=1000, description="Chunk size for Parent Data")
+    parent_chunk_size: int = Field(default=1000, description="Chunk size in tokens for Parent Data")
 
     @field_validator("vector_store_type")
     def validate_vector_store_type(cls, value: str, info: ValidationInfo) -> str:
@@ -270,7 +272,7 @@ class LangChainVectorStore(BaseModel):
             doc_id="doc_id",
             search_kwargs=search_kwargs,
             use_multi_vector_retriever=self.use_multi_vector_retriever,
-            docstore=SQLDocStore(self.doc_store_url) if self.doc_store_url else None
+            docstore=SQLDocStore.from_url(self.doc_store_url) if self.doc_store_url else None
         )
         return vector_retriver_wrapper.retriever
 
@@ -362,7 +364,8 @@ class LangChainVectorStore(BaseModel):
                         await self.delete_documents_from_doc_store(doc_ids, self.doc_store_url)
 
         # prepare the document for embedding
-        documents = self.prepare_documents(data_list)
+        # Chunking runs in a worker thread so that large inputs do not block the event loop
+        documents = await asyncio.to_thread(self.prepare_documents, data_list)
         if not self.use_multi_vector_retriever:
             # If not using MultiVectorRetriever, we can add documents directly
             logger.info("Adding documents to the vector store")
@@ -371,7 +374,7 @@ class LangChainVectorStore(BaseModel):
         else:
             # prepare sub-documents for MultiVectorRetriever
             logger.info("Preparing sub-documents for MultiVectorRetriever")
-            sub_documents = self.preapre_sub_documents(documents)
+            sub_documents = await asyncio.to_thread(self.preapre_sub_documents, documents)
             # If using MultiVectorRetriever, we need to add documents with retry logic
             logger.info("Adding documents to the vector store with retry logic")
             await self.add_doucment_with_retry(self.get_vector_store(), sub_documents)
@@ -388,13 +391,15 @@ class LangChainVectorStore(BaseModel):
         This method splits the content of each document into chunks.
         """
         sub_docs = []
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=self.parent_chunk_size, chunk_overlap=0)
+        # Chunk sizes are measured in tokens of the embedding model
+        text_chunker = TextChunker(self.parent_chunk_size)
         for doc in source_documents:
             doc_id = doc.metadata.get("doc_id", str(uuid.uuid4()))
-            splited_docs = text_splitter.split_documents([doc])
-            if len(splited_docs) == 0:
+            chunks = text_chunker.split_text(doc.page_content)
+            if len(chunks) == 0:
                 raise ValueError("splited_docs is empty")
-            for sub_doc in splited_docs:
+            for chunk in chunks:
+                sub_doc = Document(page_content=chunk, metadata=dict(doc.metadata))
                 sub_doc.metadata["doc_id"] = doc_id
                 sub_docs.append(sub_doc)
 
@@ -410,6 +415,8 @@ class LangChainVectorStore(BaseModel):
         This method converts EmbeddingData to Document objects.
         """
         documents = []
+        # Chunk sizes are measured in tokens of the embedding model
+        text_chunker = TextChunker(self.chunk_size)
         for data in data_list:
             # Create a Document object
             metadata = {}
@@ -424,8 +431,7 @@ class LangChainVectorStore(BaseModel):
             metadata["doc_id"] = doc_id
 
             # split the content into chunks
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=self.chunk_size, chunk_overlap=0)
-            chunks = text_splitter.split_text(data.content)
+            chunks = text_chunker.split_text(data.content)
             for chunk in chunks:
                 document = Document(
                     page_content=chunk,
@@ -450,17 +456,17 @@ class LangChainVectorStore(BaseModel):
             raise ValueError("doc_store_url must be provided.")
 
         # Create a SQLDocStore instance
-        doc_store = SQLDocStore(doc_store_url)
+        doc_store = SQLDocStore.from_url(doc_store_url)
         
         # Add documents to the document store
+        param = []
         for doc in documents:
             # 元のドキュメントをDocStoreに保存
             doc_id = doc.metadata.get("doc_id", None)
             if not doc_id:
                 raise ValueError("Document must have a 'doc_id' in metadata.")
-            param = []
             param.append((doc_id, doc))
-            await doc_store.amset(param)
+        await doc_store.amset(param)
 
     async def delete_documents_from_doc_store(
         self,
@@ -477,7 +483,7 @@ class LangChainVectorStore(BaseModel):
             raise ValueError("doc_store_url must be provided.")
 
         # Create a SQLDocStore instance
-        doc_store = SQLDocStore(doc_store_url)
+        doc_store = SQLDocStore.from_url(doc_store_url)
 
         # Delete documents from the document store
         await doc_store.amdelete(doc_ids)
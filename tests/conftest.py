@@ -0,0 +1,79 @@
+"""
+テスト共通のfixture。
+- APP_DATA_PATHを一時ディレクトリに設定し、メインDB(フォルダ、検索結果キャッシュの世代)を作成する
+- OpenAIのAPIの代わりにHashingEmbeddingsを利用するクライアントを提供する
+"""
+import asyncio
+from typing import Any
+
+import pytest
+
+from ai_chat_lib.cmd_tools.fake_embeddings import HashingEmbeddings
+from ai_chat_lib.cmd_tools.vector_search_benchmark import BenchmarkEmbeddingClient
+from ai_chat_lib.db_modules.main_db_util import MainDBUtil
+from ai_chat_lib.llm_modules.openai_util import OpenAIProps
+from ai_chat_lib.langchain_modules.embedding_data import EmbeddingData
+from ai_chat_lib.langchain_modules.langchain_vector_db_numpy import LangChainVectorDBNumpy
+
+
+class FailingEmbeddings(HashingEmbeddings):
+    """
+    failがTrueの間はEmbeddingの作成に失敗するHashingEmbeddings
+    """
+    def __init__(self, dim: int = 32):
+        super().__init__(dim)
+        self.fail = False
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self.fail:
+            raise RuntimeError("embedding failed")
+        return super().embed_documents(texts)
+
+
+class FakeEmbeddingClient(BenchmarkEmbeddingClient):
+    """
+    テスト毎のFailingEmbeddingsを返すクライアント
+    """
+    def get_embedding_client(self):
+        return get_fake_embeddings(self.embedding_dimensions)
+
+
+_fake_embeddings: dict[int, FailingEmbeddings] = {}
+
+
+def get_fake_embeddings(dim: int) -> FailingEmbeddings:
+    if dim not in _fake_embeddings:
+        _fake_embeddings[dim] = FailingEmbeddings(dim)
+    return _fake_embeddings[dim]
+
+
+@pytest.fixture
+def app_data_path(tmp_path, monkeypatch):
+    path = tmp_path / "app_data"
+    monkeypatch.setenv("APP_DATA_PATH", str(path))
+    asyncio.run(MainDBUtil.init(upgrade=True))
+    _fake_embeddings.clear()
+    return path
+
+
+@pytest.fixture
+def fake_client():
+    return FakeEmbeddingClient(props=OpenAIProps(), embedding_model="hashing", embedding_dimensions=32)
+
+
+@pytest.fixture
+def numpy_vector_db(app_data_path, fake_client):
+    def create(**kwargs: Any) -> LangChainVectorDBNumpy:
+        params: dict[str, Any] = {
+            "langchain_openai_client": fake_client,
+            "vector_db_url": str(app_data_path / "vector_db"),
+            "collection_name": "test",
+            "chunk_size": 200,
+        }
+        params.update(kwargs)
+        return LangChainVectorDBNumpy(**params)
+    return create
+
+
+def create_embedding_data(source_id: str, content: str, folder_path: str = "") -> EmbeddingData:
+    return EmbeddingData(name="test", model="hashing", source_id=source_id, folder_path=folder_path, content=content)
@@ -0,0 +1,43 @@
+"""
+EmbeddingCacheStoreの読み込みと、他プロセスによるスロットの書き換えの検出を確認する。
+"""
+import numpy as np
+
+from ai_chat_lib.langchain_modules.langchain_embedding_cache import EmbeddingCacheStore
+
+
+def test_get_many_returns_cached_vectors(tmp_path):
+    store = EmbeddingCacheStore(str(tmp_path))
+    store.put_many("model", ["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+    assert store.get_many("model", ["a", "c", "b"]) == [[1.0, 2.0], None, [3.0, 4.0]]
+    assert store.hits == 2 and store.misses == 1
+
+
+def test_overwritten_slot_is_treated_as_miss(tmp_path):
+    reader = EmbeddingCacheStore(str(tmp_path))
+    writer = EmbeddingCacheStore(str(tmp_path), max_entries=1)
+    reader.put_many("model", ["a"], [[1.0, 2.0]])
+    assert reader.get_many("model", ["a"]) == [[1.0, 2.0]]
+
+    # 別のストア(別プロセス相当)がスロットの内容だけを書き換えた状態
+    memmap = writer._get_memmap(2, 1)
+    memmap[0] = np.asarray([9.0, 9.0], dtype=np.float32)
+    memmap.flush()
+    assert reader.get_many("model", ["a"]) == [None]
+    assert reader.checksum_mismatches == 1
+
+    # 追い出されて別のキーが書き込まれた場合も、古いキーではヒットしない
+    writer.put_many("model", ["b"], [[5.0, 6.0]])
+    assert reader.get_many("model", ["a", "b"]) == [None, [5.0, 6.0]]
+
+
+def test_last_access_is_updated_in_batches(tmp_path):
+    store = EmbeddingCacheStore(str(tmp_path), max_entries=2)
+    store.put_many("model", ["a"], [[1.0]])
+    store.put_many("model", ["b"], [[2.0]])
+    store.get_many("model", ["a"])
+    # 読み込みでは最終アクセス時刻を即座に更新しない
+    assert len(store._pending_touches) == 1
+    # 書き込み時に反映されるため、最近読み込んだaは追い出されない
+    store.put_many("model", ["c"], [[3.0]])
+    assert store.get_many("model", ["a", "b", "c"]) == [[1.0], None, [3.0]]
@@ -0,0 +1,64 @@
+"""
+フォルダを上の階層に移動した後、Chromaのmetadataに古い深さの祖先フォルダのキーが残らず、
+サブフォルダのfilterで移動後のフォルダのドキュメントのみが検索されることを確認する。
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("langchain_chroma")
+
+from ai_chat_lib.db_modules.content_folder import ContentFolder
+from ai_chat_lib.langchain_modules.langchain_vector_db_chroma import LangChainVectorDBChroma
+
+
+def create_ancestor_metadata(ancestor_ids: list[str]) -> dict[str, str]:
+    return {ContentFolder.get_folder_ancestor_key(depth): ancestor_id for depth, ancestor_id in enumerate(ancestor_ids)}
+
+
+def test_move_folder_up_updates_subfolder_filter(tmp_path, fake_client):
+    vector_db = LangChainVectorDBChroma(
+        langchain_openai_client=fake_client,
+        vector_db_url=str(tmp_path / "chroma"),
+        collection_name="folder_move_test",
+    )
+    # root/A/B/C のフォルダCのドキュメント
+    old_ancestors = ["root", "A", "B", "C"]
+    vector_db.db.add_texts(
+        ["doc1", "doc2"],
+        metadatas=[{"folder_id": "C", "source_id": f"s{i}", **create_ancestor_metadata(old_ancestors)} for i in range(2)],
+        ids=["v1", "v2"],
+    )
+
+    # フォルダBをrootの直下に移動する: root/B/C
+    new_ancestors = ["root", "B", "C"]
+    ids, metadata_list = vector_db._get_document_ids_by_folder_ids(["C"])
+    patch = {"folder_path": "root/B/C", **create_ancestor_metadata(new_ancestors)}
+    asyncio.run(vector_db._apply_metadata_patches(
+        ids, metadata_list, [patch] * len(ids), remove_key_prefix=ContentFolder.folder_ancestor_key_prefix
+    ))
+
+    def get_ids(where: dict[str, str]) -> list[str]:
+        return sorted(vector_db.db.get(where=where)["ids"])  # type: ignore
+
+    # 移動前の深さのキーは削除されている
+    assert get_ids({ContentFolder.get_folder_ancestor_key(3): "C"}) == []
+    assert get_ids({ContentFolder.get_folder_ancestor_key(1): "A"}) == []
+    # 移動後のサブフォルダのfilterで検索できる
+    assert get_ids({ContentFolder.get_folder_ancestor_key(1): "B"}) == ["v1", "v2"]
+    assert get_ids({ContentFolder.get_folder_ancestor_key(2): "C"}) == ["v1", "v2"]
+    assert get_ids({ContentFolder.get_folder_ancestor_key(0): "root"}) == ["v1", "v2"]
+    stored = vector_db.db.get(ids=["v1", "v2"], include=["metadatas", "documents", "embeddings"])  # type: ignore
+    for metadata in stored["metadatas"]:
+        assert metadata["folder_path"] == "root/B/C"
+        assert ContentFolder.get_folder_ancestor_key(3) not in metadata
+    # テキストとEmbeddingは変わらない
+    assert sorted(stored["documents"]) == ["doc1", "doc2"]
+    assert len(stored["embeddings"][0]) == 32
+
+    # キーを削除しない更新(同じ深さのままのmetadataの変更)も反映される
+    ids, metadata_list = vector_db._get_document_ids_by_folder_ids(["C"])
+    asyncio.run(vector_db._apply_metadata_patches(ids, metadata_list, [{"description": "updated"}] * len(ids)))
+    assert get_ids({"description": "updated"}) == ["v1", "v2"]
+    assert get_ids({ContentFolder.get_folder_ancestor_key(2): "C"}) == ["v1", "v2"]
@@ -0,0 +1,54 @@
+"""
+KeywordIndexのmetadataのfilterの変換を確認する。
+"""
+import asyncio
+
+import pytest
+from langchain_core.documents import Document
+
+from ai_chat_lib.langchain_modules.langchain_keyword_index import KeywordIndex, UnsupportedKeywordFilterError
+
+
+@pytest.fixture
+def keyword_index(tmp_path):
+    index = KeywordIndex(str(tmp_path / "keyword_index.db"))
+    documents = [
+        Document(page_content="vector search document one", metadata={"source_id": "a", "folder_id": "f1", "page": 1}),
+        Document(page_content="vector search document two", metadata={"source_id": "b", "folder_id": "f1", "page": 5}),
+        Document(page_content="vector search document three", metadata={"source_id": "c", "folder_id": "f2", "page": 10}),
+    ]
+    index.add_documents(["1", "2", "3"], documents)
+    return index
+
+
+def search_source_ids(index: KeywordIndex, filter: dict) -> list[str]:
+    return sorted(doc.metadata["source_id"] for doc, _ in index.search("document", k=10, filter=filter))
+
+
+@pytest.mark.parametrize("filter, expected", [
+    ({"folder_id": "f1"}, ["a", "b"]),
+    ({"$or": [{"source_id": "a"}, {"folder_id": "f2"}]}, ["a", "c"]),
+    ({"$and": [{"folder_id": "f1"}, {"source_id": {"$ne": "a"}}]}, ["b"]),
+    ({"source_id": {"$nin": ["a", "b"]}}, ["c"]),
+    ({"source_id": {"$in": []}}, []),
+    ({"source_id": {"$nin": []}}, ["a", "b", "c"]),
+    ({"page": {"$gt": 1, "$lte": 10}}, ["b", "c"]),
+    ({"page": {"$lt": 5}}, ["a"]),
+    ({"$or": []}, []),
+])
+def test_filter_operators(keyword_index, filter, expected):
+    assert search_source_ids(keyword_index, filter) == expected
+
+
+def test_unsupported_filter_raises(keyword_index):
+    with pytest.raises(UnsupportedKeywordFilterError):
+        keyword_index.search("document", filter={"source_id": {"$contains": "a"}})
+    with pytest.raises(UnsupportedKeywordFilterError):
+        keyword_index.search("document", filter={"$not": {"source_id": "a"}})
+
+
+def test_unsupported_filter_skips_keyword_search(numpy_vector_db):
+    # キーワード検索で評価できないfilterの場合は、例外を発生させずに空の結果を返す
+    vector_db = numpy_vector_db()
+    results = asyncio.run(vector_db._keyword_search("document", {"k": 4, "filter": {"source_id": {"$contains": "a"}}}))
+    assert results == []
@@ -0,0 +1,59 @@
+"""
+NumpyVectorStoreの量子化と、再スコアリング用のfloat32のファイルの有無を確認する。
+"""
+import os
+
+import numpy as np
+
+from ai_chat_lib.langchain_modules.langchain_vector_db_numpy import NumpyVectorStore
+
+
+def create_vectors(count: int = 200, dim: int = 16) -> np.ndarray:
+    return np.random.default_rng(0).normal(size=(count, dim)).astype(np.float32)
+
+
+def add_vectors(store: NumpyVectorStore, vectors: np.ndarray) -> list[str]:
+    texts = [f"text {i}" for i in range(len(vectors))]
+    return store.add_vectors(vectors.tolist(), texts, [{"i": i} for i in range(len(vectors))])
+
+
+def test_quantized_store_without_full_precision_file(tmp_path):
+    vectors = create_vectors()
+    store = NumpyVectorStore(str(tmp_path / "store"), None, vector_dtype="int8", keep_full_precision=False)
+    add_vectors(store, vectors)
+
+    usage = store.get_disk_usage()
+    assert "vectors.float32" not in usage
+    assert "vectors.int8" in usage
+    # 保存済みのベクトルで検索すると、自身が最上位になる
+    rows = [row for row, _ in store.search_by_vector(vectors[3].tolist(), k=3)]
+    assert rows[0] == 3
+
+    # 別のインスタンスで開いても設定が引き継がれる
+    reopened = NumpyVectorStore(str(tmp_path / "store"), None)
+    assert reopened.keep_full_precision is False
+    assert reopened.search_by_vector(vectors[5].tolist(), k=1)[0][0] == 5
+
+
+def test_precision_report_includes_full_precision_file(tmp_path):
+    vectors = create_vectors()
+    store = NumpyVectorStore(str(tmp_path / "store"), None, vector_dtype="float16")
+    add_vectors(store, vectors)
+    assert "vectors.float32" in store.get_disk_usage()
+
+    report = store.create_precision_report(k=5, num_queries=10)
+    results = {(result["vector_dtype"], result["rescore"]): result for result in report["results"]}
+    assert results[("float16", False)]["disk_ratio"] == 0.5
+    # 再スコアリングする場合はfloat32のファイルも必要になる
+    assert results[("float16", True)]["disk_ratio"] == 1.5
+    assert report["disk_bytes"] >= len(vectors) * 16 * (4 + 2)
+
+    # float32のファイルを削除すると、ディスク使用量は量子化ファイルのみになる
+    store.set_keep_full_precision(False)
+    assert "vectors.float32" not in store.get_disk_usage()
+    assert store.search_by_vector(vectors[7].tolist(), k=1)[0][0] == 7
+    # float32に戻す場合は量子化済みのベクトルからfloat32のファイルを作り直す
+    store.convert_vector_dtype("float32")
+    assert os.path.exists(tmp_path / "store" / "vectors.float32")
+    assert not os.path.exists(tmp_path / "store" / "vectors.float16")
+    assert store.search_by_vector(vectors[9].tolist(), k=1)[0][0] == 9
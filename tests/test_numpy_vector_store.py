@@ -0,0 +1,82 @@
+"""
+NumpyVectorStoreの追加・削除・metadataのfilter・compactを確認する。
+"""
+from typing import Optional
+
+import numpy as np
+import pytest
+
+from ai_chat_lib.langchain_modules.langchain_vector_db_numpy import NumpyVectorStore
+
+
+def create_vectors(count: int, dim: int = 16) -> np.ndarray:
+    return np.random.default_rng(0).normal(size=(count, dim)).astype(np.float32)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = NumpyVectorStore(str(tmp_path / "store"), None)
+    vectors = create_vectors(6)
+    metadatas = [
+        {"source_id": f"s{i}", "folder_id": "f1" if i < 3 else "f2", "page": i}
+        for i in range(6)
+    ]
+    store.add_vectors(vectors.tolist(), [f"text {i}" for i in range(6)], metadatas, [f"id{i}" for i in range(6)])
+    return store
+
+
+def search_ids(store: NumpyVectorStore, vector: np.ndarray, k: int = 6, filter: Optional[dict] = None) -> list[str]:
+    return [store._ids[row] for row, _ in store.search_by_vector(vector.tolist(), k=k, filter=filter)]
+
+
+def test_add_and_search(store):
+    vectors = create_vectors(6)
+    results = store.search_by_vector(vectors[2].tolist(), k=2)
+    assert store._ids[results[0][0]] == "id2"
+    assert results[0][1] == pytest.approx(1.0, abs=1e-5)
+    # 同じidで追加した場合は置き換える
+    store.add_vectors([vectors[0].tolist()], ["replaced"], [{"source_id": "s2"}], ["id2"])
+    ids, documents = store.get_all_documents()
+    assert ids.count("id2") == 1
+    assert documents[ids.index("id2")].page_content == "replaced"
+
+
+def test_delete_excludes_rows_from_search(store):
+    vectors = create_vectors(6)
+    store.delete(["id1", "id4"])
+    assert "id1" not in search_ids(store, vectors[1])
+    ids, _ = store.get_all_documents()
+    assert ids == ["id0", "id2", "id3", "id5"]
+    # 別のインスタンス(別プロセス相当)も削除後の状態を読み込む
+    other = NumpyVectorStore(store.path, None)
+    assert other.get_row_stats() == {"rows": 6, "deleted": 2}
+
+
+@pytest.mark.parametrize("filter, expected", [
+    ({"folder_id": "f1"}, ["id0", "id1", "id2"]),
+    ({"source_id": {"$in": ["s1", "s4"]}}, ["id1", "id4"]),
+    ({"source_id": {"$nin": ["s0", "s1", "s2"]}}, ["id3", "id4", "id5"]),
+    ({"$and": [{"folder_id": "f2"}, {"source_id": {"$ne": "s3"}}]}, ["id4", "id5"]),
+    ({"$or": [{"source_id": "s0"}, {"folder_id": "f2"}]}, ["id0", "id3", "id4", "id5"]),
+])
+def test_filter(store, filter, expected):
+    assert sorted(store.get_by_filter(filter)[0]) == expected
+    assert sorted(search_ids(store, create_vectors(6)[0], filter=filter)) == expected
+
+
+def test_compact_removes_deleted_rows(store):
+    vectors = create_vectors(6)
+    other = NumpyVectorStore(store.path, None)
+    store.delete(["id0", "id3"])
+    assert store.compact() == {"rows_before": 6, "rows_after": 4}
+    assert store.get_row_stats() == {"rows": 4, "deleted": 0}
+    # 行番号を詰めた後も、idとベクトル・metadataの対応は変わらない
+    for i in (1, 2, 4, 5):
+        assert search_ids(store, vectors[i], k=1) == [f"id{i}"]
+    assert store.get_by_filter({"folder_id": "f2"})[0] == ["id4", "id5"]
+    # compact前に開いていた別のインスタンスも詰めた後の行を読み込む
+    assert search_ids(other, vectors[5], k=1) == ["id5"]
+    assert other.get_row_stats() == {"rows": 4, "deleted": 0}
+    # compact後の追加は詰めた行の直後に追記される
+    store.add_vectors([vectors[0].tolist()], ["again"], [{"source_id": "s0"}], ["id0"])
+    assert search_ids(other, vectors[0], k=1) == ["id0"]
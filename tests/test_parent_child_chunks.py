@@ -0,0 +1,28 @@
+"""
+MultiVectorRetrieverを利用する場合の親チャンクと子チャンクの分割を確認する。
+"""
+import asyncio
+
+from conftest import create_embedding_data
+
+
+def test_child_chunks_are_smaller_than_the_parent(numpy_vector_db, app_data_path):
+    # 既定のVectorDBItemの以前の設定(chunk_sizeが親チャンクより大きい)でも、親は複数の子チャンクに分割される
+    vector_db = numpy_vector_db(
+        chunk_size=4096,
+        parent_chunk_size=400,
+        doc_store_url=f"sqlite:///{app_data_path / 'doc_store.db'}",
+    )
+    assert vector_db.get_child_chunk_tokens() == 100
+
+    content = " ".join(f"Sentence number {i} describes the parent child chunking." for i in range(60))
+    asyncio.run(vector_db.add_document(create_embedding_data("a", content)))
+
+    _, documents = vector_db.get_all_documents()
+    parent_ids = {doc.metadata["doc_id"] for doc in documents}
+    assert len(parent_ids) > 1
+    # 子チャンクは親チャンクと同じ内容にならない
+    assert len(documents) > len(parent_ids)
+    parents = vector_db.doc_store.mget(list(parent_ids))
+    parent_texts = {parent.page_content for parent in parents if parent is not None}
+    assert all(doc.page_content not in parent_texts for doc in documents)
@@ -0,0 +1,51 @@
+"""
+祖先フォルダのキーがない(キーの導入前に登録した)チャンクのサブフォルダ検索と、metadataの補完を確認する。
+"""
+import asyncio
+
+from ai_chat_lib.db_modules.content_folder import ContentFolder
+
+from conftest import create_embedding_data
+
+
+async def create_folders(path: str) -> ContentFolder:
+    # get_content_folder_by_pathは存在しない最初の階層のみ作成するため、上の階層から順に作成する
+    names = path.split("/")
+    folder = None
+    for i in range(len(names)):
+        folder = await ContentFolder.get_content_folder_by_path("/".join(names[:i + 1]), create=True)
+    assert folder is not None
+    return folder
+
+
+def test_subfolder_filter_finds_chunks_without_ancestor_keys(numpy_vector_db, monkeypatch):
+    vector_db = numpy_vector_db()
+    prefix = ContentFolder.folder_ancestor_key_prefix
+
+    async def setup():
+        folder_b = await create_folders("root/A/B")
+        folder_a = await ContentFolder.get_content_folder_by_path("root/A")
+        root = await ContentFolder.get_content_folder_by_path("root")
+        await vector_db.add_document(create_embedding_data("s1", "legacy chunk", folder_path="root/A/B"))
+        return root, folder_a, folder_b
+
+    root, folder_a, folder_b = asyncio.run(setup())
+    # 祖先フォルダのキーを削除し、キーの導入前に登録したチャンクの状態にする
+    ids, metadata_list = vector_db.db.get_by_filter({"folder_id": folder_b.id})
+    legacy_metadata_list = [{key: value for key, value in metadata.items() if not key.startswith(prefix)} for metadata in metadata_list]
+    vector_db.db.update_metadatas(ids, legacy_metadata_list)
+
+    def search_subfolder(folder_id: str) -> list[str]:
+        filter = asyncio.run(ContentFolder.get_subfolder_filter(folder_id))
+        return vector_db.db.get_by_filter(filter)[0]
+
+    # 既定ではサブフォルダのfolder_idでも検索する
+    assert search_subfolder(folder_a.id) == ids
+    monkeypatch.setenv("SUBFOLDER_FILTER_FALLBACK", "false")
+    assert search_subfolder(folder_a.id) == []
+
+    # metadataを補完すると、祖先フォルダのキーのみで検索できる
+    result = asyncio.run(vector_db.update_folder_metadata(root.id))
+    assert result == {"folders": 3, "chunks": 1}
+    assert search_subfolder(folder_a.id) == ids
+    assert search_subfolder(root.id) == ids
@@ -0,0 +1,75 @@
+"""
+TextChunkerのトークン数の上限と、文の途中で分割しないことを確認する。
+"""
+import asyncio
+
+import pytest
+
+from ai_chat_lib.langchain_modules.text_chunker import TextChunker, get_encoder
+
+
+def count_tokens(chunker: TextChunker, text: str) -> int:
+    return len(get_encoder(chunker.encoding_name).encode_ordinary(text))
+
+
+def create_text() -> str:
+    english = " ".join(f"This is sentence number {i} about vector search." for i in range(40))
+    japanese = "".join(f"これは{i}番目の日本語の文です。" for i in range(40))
+    return english + "\n" + japanese
+
+
+def test_chunks_do_not_exceed_chunk_tokens():
+    chunker = TextChunker(50)
+    text = create_text()
+    chunks = chunker.split_text(text)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunker, chunk) <= 50 for chunk in chunks)
+    # 重複なしの場合は、連結すると元のテキストに戻る
+    assert "".join(chunks) == text
+
+
+def test_chunks_end_at_sentence_boundaries():
+    chunker = TextChunker(50)
+    for chunk in chunker.split_text(create_text()):
+        assert chunk.rstrip().endswith((".", "。"))
+
+
+def test_long_sentence_is_split_by_tokens():
+    chunker = TextChunker(20)
+    sentence = "word " * 100
+    chunks = chunker.split_text(sentence)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunker, chunk) <= 20 for chunk in chunks)
+    assert "".join(chunks) == sentence
+
+
+def test_overlap_is_limited():
+    chunker = TextChunker(50, overlap_tokens=100)
+    # 重複は最大でchunk_tokensの半分
+    assert chunker.overlap_tokens == 25
+    chunks = chunker.split_text(create_text())
+    assert all(count_tokens(chunker, chunk) <= 50 for chunk in chunks)
+    assert len("".join(chunks)) > len(create_text())
+
+
+def test_chunk_tokens_are_limited_to_the_embedding_model():
+    assert TextChunker(100000).chunk_tokens == TextChunker.max_embedding_tokens
+    with pytest.raises(ValueError):
+        TextChunker(0)
+
+
+def test_parallel_split_respects_chunk_tokens(monkeypatch):
+    # 大きな入力と同じ経路(セグメント毎のプロセスプール)で分割する
+    monkeypatch.setattr(TextChunker, "parallel_threshold_chars", 100)
+    monkeypatch.setattr(TextChunker, "segment_chars", 500)
+    monkeypatch.setattr(TextChunker, "_executor", None)
+    chunker = TextChunker(50)
+    text = "\n".join(create_text() for _ in range(3))
+    try:
+        chunks = asyncio.run(chunker.asplit_text(text))
+    finally:
+        executor = TextChunker._executor
+        if executor is not None:
+            executor.shutdown()
+    assert all(count_tokens(chunker, chunk) <= 50 for chunk in chunks)
+    assert "".join(chunks) == text
@@ -0,0 +1,43 @@
+"""
+VectorSearchExecutorのイベントループ毎のセマフォと、待ち件数の集計を確認する。
+"""
+import asyncio
+import gc
+import threading
+
+from ai_chat_lib.langchain_modules.vector_search_executor import VectorSearchExecutor
+
+
+def test_semaphores_are_released_with_the_event_loop():
+    async def run():
+        return await VectorSearchExecutor.run_in_executor("test@executor", lambda x: x * 2, 21)
+
+    for _ in range(3):
+        assert asyncio.run(run()) == 42
+    gc.collect()
+    # 終了したイベントループのセマフォは残らない
+    assert len(VectorSearchExecutor._semaphores) == 0
+
+
+def test_queue_depth_counts_work_waiting_for_a_thread(monkeypatch):
+    monkeypatch.setenv("VECTOR_SEARCH_MAX_WORKERS", "1")
+    monkeypatch.setattr(VectorSearchExecutor, "_executor", None)
+    release = threading.Event()
+
+    async def run():
+        tasks = [
+            asyncio.create_task(VectorSearchExecutor.run_in_executor(f"test@queue{i}", release.wait, 5))
+            for i in range(3)
+        ]
+        await asyncio.sleep(0.1)
+        # 1スレッドで実行中の1件を除いた2件が待っている
+        depth = VectorSearchExecutor.get_stats()["executor_queue_depth"]
+        release.set()
+        await asyncio.gather(*tasks)
+        return depth
+
+    assert asyncio.run(run()) == 2
+    assert VectorSearchExecutor.get_stats()["executor_queue_depth"] == 0
+    executor = VectorSearchExecutor._executor
+    if executor is not None:
+        executor.shutdown()
@@ -0,0 +1,101 @@
+"""
+VectorWriteQueueの書き込みのまとめ方と、失敗時の動作を確認する。
+"""
+import asyncio
+
+from ai_chat_lib.langchain_modules.vector_write_queue import VectorWriteQueue
+
+from conftest import create_embedding_data, get_fake_embeddings
+
+
+def count_chunks(vector_db, source_id: str) -> int:
+    ids, _ = vector_db._get_document_ids_by_tag("source_id", source_id)
+    return len(ids)
+
+
+def test_coalesces_pending_writes_for_the_same_source(numpy_vector_db):
+    vector_db = numpy_vector_db()
+
+    async def run():
+        queue = VectorWriteQueue.get_queue(vector_db)
+        futures = [
+            queue.enqueue_update(vector_db, create_embedding_data("a", "first version")),
+            queue.enqueue_update(vector_db, create_embedding_data("b", "other source")),
+            queue.enqueue_update(vector_db, create_embedding_data("a", "second version")),
+        ]
+        results = await asyncio.gather(*futures)
+        return results, queue.get_stats()
+
+    results, stats = asyncio.run(run())
+    # まとめられた呼び出し元も最後の書き込みの完了を待つ
+    assert results == ["a", "b", "a"]
+    assert stats["coalesced"] == 1
+    _, documents = vector_db.get_all_documents()
+    assert sorted(doc.page_content for doc in documents) == ["other source", "second version"]
+
+
+def test_delete_removes_all_chunks_of_the_source(numpy_vector_db):
+    vector_db = numpy_vector_db()
+
+    async def run():
+        queue = VectorWriteQueue.get_queue(vector_db)
+        await queue.enqueue_update(vector_db, create_embedding_data("a", "text a"))
+        await queue.enqueue_update(vector_db, create_embedding_data("b", "text b"))
+        await queue.enqueue_delete(vector_db, "a")
+
+    asyncio.run(run())
+    assert count_chunks(vector_db, "a") == 0
+    assert count_chunks(vector_db, "b") == 1
+
+
+def test_failed_embedding_fails_the_futures(numpy_vector_db):
+    vector_db = numpy_vector_db()
+
+    async def run():
+        queue = VectorWriteQueue.get_queue(vector_db)
+        await asyncio.gather(
+            queue.enqueue_update(vector_db, create_embedding_data("a", "text a")),
+            queue.enqueue_update(vector_db, create_embedding_data("b", "text b")),
+        )
+        get_fake_embeddings(32).fail = True
+        return await asyncio.gather(
+            queue.enqueue_update(vector_db, create_embedding_data("a", "new text a")),
+            queue.enqueue_update(vector_db, create_embedding_data("b", "new text b")),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+    # 失敗した更新は成功として扱われない
+    assert all(isinstance(result, Exception) for result in results)
+    # 途中まで登録したチャンクは残らない
+    for source_id in ("a", "b"):
+        assert count_chunks(vector_db, source_id) == 0
+
+
+def test_failure_of_one_source_does_not_fail_the_others(numpy_vector_db):
+    vector_db = numpy_vector_db()
+    embeddings = get_fake_embeddings(32)
+    original = embeddings.embed_documents
+
+    def embed_documents(texts):
+        if any("broken" in text for text in texts):
+            raise RuntimeError("embedding failed")
+        return original(texts)
+
+    embeddings.embed_documents = embed_documents  # type: ignore
+
+    async def run():
+        queue = VectorWriteQueue.get_queue(vector_db)
+        return await asyncio.gather(
+            queue.enqueue_update(vector_db, create_embedding_data("a", "text a")),
+            queue.enqueue_update(vector_db, create_embedding_data("bad", "broken text")),
+            queue.enqueue_update(vector_db, create_embedding_data("c", "text c")),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+    assert results[0] == "a" and results[2] == "c"
+    assert isinstance(results[1], Exception)
+    assert count_chunks(vector_db, "a") == 1
+    assert count_chunks(vector_db, "bad") == 0
+    assert count_chunks(vector_db, "c") == 1